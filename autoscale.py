@@ -0,0 +1,165 @@
+import argparse
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def parse_workers(value):
+    """argparse type for -w/--workers: a positive number or 'auto'"""
+    if value == 'auto':
+        return value
+    try:
+        workers = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or 'auto', got '{value}'")
+    if workers < 1:
+        raise argparse.ArgumentTypeError("workers must be at least 1")
+    return workers
+
+
+def cpu_load():
+    """1-minute load average per CPU, or None where unavailable"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def memory_available_fraction():
+    """Fraction of RAM available for new processes (Linux), or None where unavailable"""
+    try:
+        meminfo = {}
+        with open('/proc/meminfo', 'r', encoding='utf-8') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                meminfo[key] = int(value.split()[0])
+        return meminfo['MemAvailable'] / meminfo['MemTotal']
+    except (OSError, KeyError, ValueError, IndexError, ZeroDivisionError):
+        return None
+
+
+class AdaptiveConcurrency:
+    """
+    Grows or shrinks the number of active ffmpeg jobs within [min_workers, max_workers].
+
+    Every interval it samples host CPU load, available memory, the encode speed
+    reported by running jobs and the aggregate download bandwidth, then changes
+    the scheduler's in-flight limit by one. Each decision is logged with the
+    metrics behind it so the thresholds can be tuned.
+    """
+
+    def __init__(self, scheduler, monitor, min_workers=1, max_workers=8, interval=30.0,
+                 cpu_high=0.9, cpu_low=0.7, memory_low=0.1, speed_floor=1.0,
+                 bandwidth_gain=0.1, bytes_received=None):
+        self.scheduler = scheduler
+        self.monitor = monitor
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+        self.memory_low = memory_low
+        self.speed_floor = speed_floor
+        self.bandwidth_gain = bandwidth_gain
+        # Callable returning total bytes downloaded so far (native fetcher); output written is used otherwise
+        self.bytes_received = bytes_received
+        self.limit = min_workers
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_bytes = None
+        self._last_time = None
+        self._bandwidth_before_growth = None
+
+    def start(self):
+        self.scheduler.set_limit(self.limit)
+        logger.info(f"Autoscale: starting with {self.limit} workers (bounds {self.min_workers}-{self.max_workers})")
+        self._thread = threading.Thread(target=self._loop, name='Autoscale', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"Autoscale: error while sampling: {e}")
+
+    def _bandwidth(self):
+        """Aggregate bytes per second since the previous sample"""
+        # Both counters include finished jobs, so a completion doesn't look like a drop in bandwidth
+        if self.bytes_received is not None:
+            total = self.bytes_received()
+        else:
+            total = self.monitor.bytes_written()
+        now = time.monotonic()
+
+        bandwidth = None
+        if self._last_bytes is not None and now > self._last_time:
+            bandwidth = max(total - self._last_bytes, 0) / (now - self._last_time)
+        self._last_bytes, self._last_time = total, now
+        return bandwidth
+
+    def sample(self):
+        jobs = self.monitor.snapshot()
+        # Live channels (no known duration) run at realtime by nature, so only VOD speeds count
+        speeds = [stats['speed'] for stats in jobs.values() if stats.get('speed') and stats.get('duration')]
+        return {
+            'cpu': cpu_load(),
+            'memory': memory_available_fraction(),
+            'speed': sum(speeds) / len(speeds) if speeds else None,
+            'bandwidth': self._bandwidth(),
+            'running': len(jobs),
+        }
+
+    def decide(self, metrics):
+        """Return (new_limit, reason) for the given metrics"""
+        cpu, memory, speed, bandwidth = metrics['cpu'], metrics['memory'], metrics['speed'], metrics['bandwidth']
+
+        if memory is not None and memory < self.memory_low:
+            return self.limit - 1, 'memory low'
+        if cpu is not None and cpu > self.cpu_high:
+            return self.limit - 1, 'CPU saturated'
+        if speed is not None and speed < self.speed_floor and metrics['running'] > 1:
+            return self.limit - 1, 'jobs slower than realtime'
+
+        if self._bandwidth_before_growth is not None and bandwidth is not None:
+            before, self._bandwidth_before_growth = self._bandwidth_before_growth, None
+            if bandwidth < before * (1 + self.bandwidth_gain):
+                return self.limit - 1, 'network saturated (last increase added no bandwidth)'
+
+        if metrics['running'] < self.limit:
+            return self.limit, 'limit not reached yet'
+        if cpu is not None and cpu > self.cpu_low:
+            return self.limit, 'CPU busy'
+        return self.limit + 1, 'headroom available'
+
+    def step(self):
+        metrics = self.sample()
+        new_limit, reason = self.decide(metrics)
+        new_limit = max(self.min_workers, min(self.max_workers, new_limit))
+
+        def fmt(value, spec, unit=''):
+            return 'n/a' if value is None else format(value, spec) + unit
+
+        bandwidth = metrics['bandwidth']
+        logger.info(
+            f"Autoscale: cpu={fmt(metrics['cpu'], '.2f')} mem_free={fmt(metrics['memory'], '.0%')} "
+            f"speed={fmt(metrics['speed'], '.2f', 'x')} "
+            f"bandwidth={fmt(bandwidth * 8 / 1e6 if bandwidth is not None else None, '.1f', 'Mbps')} "
+            f"running={metrics['running']} limit {self.limit} -> {new_limit} ({reason})"
+        )
+
+        if new_limit > self.limit:
+            self._bandwidth_before_growth = metrics['bandwidth']
+        if new_limit != self.limit:
+            self.limit = new_limit
+            self.scheduler.set_limit(new_limit)
+        return new_limit
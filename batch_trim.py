@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+from pathlib import Path
+
+from ffmpeg_progress import ProgressMonitor, run_ffmpeg
+from fingerprint import FRAME_DISTANCE, dhash
+from media_probe import AD_SKIP_SECONDS
+from scheduler import ProcessTracker, TaskScheduler
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.trim_manifest.jsonl'
+DETECT_WINDOW_SECONDS = 60  # Ads are looked for only at the start of a file
+MIN_AD_SECONDS = 2
+SAMPLE_FPS = 2              # Frames per second hashed when matching --ad-clip
+TRIM_TIMEOUT_SECONDS = 3600
+
+BLACK_PATTERN = re.compile(r'black_start:\s*([\d.]+)\s+black_end:\s*([\d.]+)')
+SILENCE_START_PATTERN = re.compile(r'silence_start:\s*([\d.]+)')
+SILENCE_END_PATTERN = re.compile(r'silence_end:\s*([\d.]+)')
+
+active_processes = ProcessTracker()
+progress_monitor = ProgressMonitor()
+
+
+def parse_ad_length(value):
+    """'auto' or a fixed number of seconds"""
+    if value == 'auto':
+        return value
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected 'auto' or seconds, got '{value}'")
+    if seconds < 0:
+        raise argparse.ArgumentTypeError('ad length must not be negative')
+    return seconds
+
+
+def sample_hashes(path, window=DETECT_WINDOW_SECONDS, fps=SAMPLE_FPS):
+    """dHashes of frames sampled fps times a second from the first window seconds"""
+    cmd = [
+        'ffmpeg', '-v', 'error',
+        '-t', str(window),
+        '-i', str(path),
+        '-vf', f"fps={fps},scale=9:8,format=gray",
+        '-f', 'rawvideo', 'pipe:1'
+    ]
+    process = subprocess.run(cmd, capture_output=True, timeout=TRIM_TIMEOUT_SECONDS)
+    data = process.stdout
+    return [dhash(data[i:i + 72]) for i in range(0, len(data) - 71, 72)]
+
+
+def black_silence_intervals(path, window=DETECT_WINDOW_SECONDS):
+    """(black, silence) interval lists from ffmpeg blackdetect/silencedetect over the first window seconds"""
+    cmd = [
+        'ffmpeg', '-hide_banner', '-nostats',
+        '-t', str(window),
+        '-i', str(path),
+        '-vf', 'blackdetect=d=0.1:pix_th=0.10',
+        '-af', 'silencedetect=n=-50dB:d=0.3',
+        '-f', 'null', '-'
+    ]
+    process = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace',
+                             timeout=TRIM_TIMEOUT_SECONDS)
+    output = process.stderr
+
+    black = [(float(start), float(end)) for start, end in BLACK_PATTERN.findall(output)]
+    starts = [float(s) for s in SILENCE_START_PATTERN.findall(output)]
+    ends = [float(e) for e in SILENCE_END_PATTERN.findall(output)]
+    silence = list(zip(starts, ends + [float(window)] * (len(starts) - len(ends))))
+    return black, silence
+
+
+class AdDetector:
+    """
+    Decides how many seconds to cut from the start of each file.
+
+    - ad_length is a number: always cut that much (the old fixed 12 s);
+    - ad_clips are reference recordings of known ads: where a clip's first
+      frame matches, the file is cut after the matching last frame nearest
+      to the clip's length from there;
+    - ad_length 'auto': the cut is the end of the first black gap in the
+      first window seconds, preferring one that coincides with silence.
+    Files where nothing is found fall back to the default.
+    """
+
+    def __init__(self, ad_length=AD_SKIP_SECONDS, ad_clips=(), default=AD_SKIP_SECONDS,
+                 window=DETECT_WINDOW_SECONDS, min_ad=MIN_AD_SECONDS):
+        self.ad_length = ad_length
+        self.default = default
+        self.window = window
+        self.min_ad = min_ad
+        # A clip is located by its first frame and ends at its last one, about its length later
+        self.clips = []
+        for clip in ad_clips:
+            hashes = sample_hashes(clip, window=window)
+            if hashes:
+                self.clips.append((Path(clip).name, hashes[0], hashes[-1], len(hashes)))
+            else:
+                logger.warning(f"Could not read frames from ad clip {clip}")
+
+    def detect(self, path):
+        """Returns (seconds, method)"""
+        try:
+            if self.clips:
+                seconds = self._match_clips(path)
+                if seconds is not None:
+                    return seconds, 'ad-clip'
+            if self.ad_length == 'auto':
+                seconds = self._black_silence(path)
+                if seconds is not None:
+                    return seconds, 'black/silence'
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"Ad detection failed for {path}: {e}")
+        if self.ad_length == 'auto':
+            return self.default, 'default'
+        return self.ad_length, 'fixed'
+
+    def _match_clips(self, path):
+        hashes = sample_hashes(path, window=self.window)
+
+        def matching(target, start=0):
+            return [i for i in range(start, len(hashes)) if bin(hashes[i] ^ target).count('1') <= FRAME_DISTANCE]
+
+        for name, first, last, length in self.clips:
+            starts = matching(first)
+            if not starts:
+                continue
+            # Clips ending on black or a static card match many frames; the ad ends at the one
+            # closest to where the clip would, not at the last one in the window
+            expected = starts[0] + length - 1
+            endings = matching(last, starts[0])
+            if endings:
+                return (min(endings, key=lambda i: abs(i - expected)) + 1) / SAMPLE_FPS
+        return None
+
+    def _black_silence(self, path):
+        black, silence = black_silence_intervals(path, self.window)
+        candidates = [(start, end) for start, end in black if end >= self.min_ad]
+        for start, end in candidates:
+            if any(s_start < end and s_end > start for s_start, s_end in silence):
+                return end
+        return candidates[0][1] if candidates else None
+
+
+class TrimManifest:
+    """
+    Record of trimmed files (<output_dir>/.trim_manifest.jsonl), one JSON
+    object per line. A source is skipped on later runs while its size and
+    mtime are unchanged and its output still exists.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.records = {}
+
+    def load(self):
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line from an interrupted run
+                    self.records[record['source']] = record
+        return self
+
+    def is_done(self, source, stat, output_file):
+        record = self.records.get(source)
+        return (record is not None and record['size'] == stat.st_size
+                and record['mtime_ns'] == stat.st_mtime_ns and output_file.exists())
+
+    def mark_done(self, source, stat, ad_seconds, method):
+        record = {'source': source, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                  'ad_seconds': ad_seconds, 'method': method}
+        with self.lock:
+            self.records[source] = record
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def trim_file(task, output_dir, detector, manifest):
+    name, source = task
+    output_file = output_dir / name
+    stat = source.stat()
+    if manifest.is_done(name, stat, output_file):
+        return 'skipped'
+
+    ad_seconds, method = detector.detect(source)
+    logger.info(f"Trimming {name}: {ad_seconds:g}s ({method})")
+
+    # Written next to the output and renamed, so a crash never leaves a truncated file behind
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = output_file.with_name(f".{output_file.stem}.trimming{output_file.suffix}")
+    cmd = [
+        'ffmpeg',
+        '-ss', f"{ad_seconds:g}",
+        '-i', str(source),
+        '-map', '0',
+        '-c', 'copy',
+        '-y',
+        '-loglevel', 'error',
+        str(tmp_file)
+    ]
+    try:
+        returncode, stderr = run_ffmpeg(cmd, TRIM_TIMEOUT_SECONDS, job=name,
+                                        monitor=progress_monitor, tracker=active_processes)
+    except subprocess.TimeoutExpired:
+        logger.error(f"Timeout trimming {name}")
+        returncode, stderr = None, ''
+
+    if returncode != 0:
+        if returncode is not None:
+            logger.error(f"Error trimming {name}: {stderr.strip()}")
+        tmp_file.unlink(missing_ok=True)
+        return 'failed'
+
+    os.replace(tmp_file, output_file)
+    manifest.mark_done(name, stat, ad_seconds, method)
+    return 'trimmed'
+
+
+def batch_trim(input_dir, output_dir, pattern='*.mp4', workers=None, detector=None):
+    """Trim every file matching pattern under input_dir into output_dir; returns a result count dict"""
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Stream copy is bound by disk I/O rather than CPU, so run more jobs than cores
+    workers = workers or min(16, (os.cpu_count() or 2) * 2)
+    detector = detector or AdDetector()
+    manifest = TrimManifest(output_dir / MANIFEST_NAME).load()
+
+    tasks = [(str(path.relative_to(input_dir)), path)
+             for path in sorted(input_dir.glob(pattern))
+             if path.is_file() and output_dir.resolve() not in path.resolve().parents]
+    # Threads, not processes: every trim and detection is already its own ffmpeg process that
+    # the workers only wait on, so a process pool would add pickling but no parallelism
+    scheduler = TaskScheduler(trim_file, max_workers=workers,
+                              on_abort=active_processes.terminate_all, thread_name_prefix='Trim')
+    results = scheduler.run(tasks, output_dir, detector, manifest)
+
+    counts = {'trimmed': 0, 'skipped': 0, 'failed': 0, 'not started': len(tasks) - len(results)}
+    for _, result in results:
+        counts[result if result in counts else 'failed'] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cut the leading ads from a directory of videos')
+    parser.add_argument('input_dir', help='Directory with the downloaded videos')
+    parser.add_argument('-o', '--output-dir', default='processed', help='Where trimmed files go (default: processed)')
+    parser.add_argument('--glob', default='*.mp4', help='Files to trim, relative to input_dir (default: *.mp4; '
+                                                        'use "**/*.mp4" for subdirectories)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='Concurrent ffmpeg jobs (default: twice the CPU count, at most 16)')
+    parser.add_argument('--ad-length', type=parse_ad_length, default=AD_SKIP_SECONDS,
+                      help=f"Seconds to cut, or 'auto' to find the end of the ad by black frames/silence "
+                           f"(default: {AD_SKIP_SECONDS})")
+    parser.add_argument('--ad-clip', action='append', default=[],
+                      help='Recording of a known ad; files are cut right after its last frame (repeatable)')
+    parser.add_argument('--window', type=float, default=DETECT_WINDOW_SECONDS,
+                      help=f"Seconds at the start of each file searched for the ad (default: {DETECT_WINDOW_SECONDS})")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+    detector = AdDetector(args.ad_length, args.ad_clip, window=args.window)
+    counts = batch_trim(args.input_dir, args.output_dir, args.glob, args.jobs, detector)
+    logger.info(f"Trimmed: {counts['trimmed']}, already done: {counts['skipped']}, failed: {counts['failed']}"
+                + (f", not started: {counts['not started']}" if counts['not started'] else ''))
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from filenames import FilenameAllocator
+from jobs import JobStore
+from ledger import read_ledger
+from m3u_parser import iter_entries
+
+REPO_DIR = Path(__file__).resolve().parent
+GROUPS = ['新闻', '体育', '电影', '电视剧', '少儿', '纪录片', 'News', 'Sports', 'Movies', 'Music']
+# ffmpeg -encoders as the stub ffmpeg lists it: software encoders only, so no test encodes run
+STUB_ENCODERS = """Encoders:
+ V..... = Video
+ ------
+ V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+ V....D libx265              libx265 H.265 / HEVC (codec hevc)
+"""
+
+
+def write_synthetic_ledger(path, size):
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(size):
+            f.write(f"Show {i}:http://example.com/vod/{i}/index.m3u8\n")
+
+
+def reread_skip_check(path, key):
+    """The old approach: re-read the whole ledger for every task"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return key in set(line.strip() for line in f if line.strip())
+
+
+def bench_ledger(sizes, lookups=1000, reread_limit=20000):
+    """
+    Time skip checks against ledgers of increasing size: the in-memory URL set
+    the scripts used to keep, the job store that replaced it, and re-reading the file
+    """
+    print(f"{'entries':>10} {'ledger us/check':>16} {'jobs.sqlite us/check':>21} {'jobs.sqlite open ms':>20} "
+          f"{'re-read us/check':>17}")
+    rows = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = Path(tmp) / f"completed_{size}.txt"
+            write_synthetic_ledger(path, size)
+
+            ledger = {url for _, url, _ in read_ledger(path)}
+            probes = [f"http://example.com/vod/{(i * 7919) % (size * 2)}/index.m3u8" for i in range(lookups)]
+
+            start = time.perf_counter()
+            for url in probes:
+                url in ledger
+            ledger_cost = (time.perf_counter() - start) / lookups * 1e6
+
+            store = JobStore(Path(tmp) / f"jobs_{size}.sqlite", legacy_ledger=path).load()
+            store.close()
+            start = time.perf_counter()
+            store.load()  # What a run pays at startup once the ledger is imported
+            open_cost = (time.perf_counter() - start) * 1e3
+            start = time.perf_counter()
+            for url in probes:
+                store.status(url)
+            store_cost = (time.perf_counter() - start) / lookups * 1e6
+            store.close()
+
+            reread_cost = None
+            if size <= reread_limit:
+                reread_probes = probes[:20]
+                start = time.perf_counter()
+                for url in reread_probes:
+                    reread_skip_check(path, f"Show 0:{url}")
+                reread_cost = (time.perf_counter() - start) / len(reread_probes) * 1e6
+
+            reread_text = f"{reread_cost:17.1f}" if reread_cost is not None else f"{'skipped':>17}"
+            print(f"{size:>10} {ledger_cost:16.3f} {store_cost:21.3f} {open_cost:20.1f} {reread_text}")
+            rows.append({'name': 'ledger', 'size': size, 'us_per_check': ledger_cost,
+                         'jobs_us_per_check': store_cost, 'jobs_open_ms': open_cost,
+                         'reread_us_per_check': reread_cost})
+    return rows
+
+
+def exists_probe_allocate(output_dir, clean_name):
+    """The old approach: stat name, name-2, name-3, ... until one is free"""
+    counter = 1
+    output_file = output_dir / f"{clean_name}.mp4"
+    while output_file.exists():
+        counter += 1
+        output_file = output_dir / f"{clean_name}-{counter}.mp4"
+    output_file.touch()
+
+
+def bench_filenames(collisions, step=100):
+    """Time filename allocation as the number of same-named episodes grows"""
+    print(f"{'collisions':>10} {'allocator us/name':>18} {'exists() us/name':>17}")
+    rows = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        allocator = FilenameAllocator(Path(tmp) / 'allocator').scan()
+        probe_dir = Path(tmp) / 'probe'
+        probe_dir.mkdir()
+
+        done = 0
+        # Each size is reached by allocating on top of the previous one, so they are run in order
+        for target in sorted(set(size for size in collisions if size > 0)):
+            while done < target:
+                # The cost reported is that of the last batch, which is partial for sizes off the step
+                batch = min(step, target - done)
+                done += batch
+                start = time.perf_counter()
+                for _ in range(batch):
+                    allocator.allocate('Episode')
+                allocator_cost = (time.perf_counter() - start) / batch * 1e6
+
+                start = time.perf_counter()
+                for _ in range(batch):
+                    exists_probe_allocate(probe_dir, 'Episode')
+                probe_cost = (time.perf_counter() - start) / batch * 1e6
+            print(f"{done:>10} {allocator_cost:18.1f} {probe_cost:17.1f}")
+            rows.append({'name': 'filenames', 'size': done, 'us_per_name': allocator_cost,
+                         'exists_us_per_name': probe_cost})
+    return rows
+
+
+def write_synthetic_playlist(path, size, groups=50, base_url='http://example.com', duplicates=20):
+    """
+    A playlist with the attributes real provider lists carry. Every
+    duplicates-th entry re-lists an earlier stream under a tokenized https URL
+    and a differently numbered title, so deduplication has work to do.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'#EXTM3U x-tvg-url="{base_url}/epg.xml"\n')
+        for i in range(size):
+            group = f"{GROUPS[i % len(GROUPS)]} {i % groups}"
+            name, url = f"Channel {i}", f"{base_url}/live/{i}/index.m3u8"
+            if duplicates and i and i % duplicates == 0:
+                original = i // 2
+                name = f"Channel {original} 第0{original % 9 + 1}集"
+                url = f"{base_url.replace('http://', 'https://')}/live/{original}/index.m3u8?token={i:x}"
+            duration = -1 if i % 3 else 1800 + i % 3600
+            f.write(f'#EXTINF:{duration} tvg-id="ch{i}.cn" tvg-name="{name}" tvg-logo="{base_url}/logo/{i}.png" '
+                    f'tvg-chno="{i + 1}" tvg-language="Chinese" group-title="{group}",[{group}] {name}\n')
+            if i % 7 == 0:
+                f.write('#EXTVLCOPT:http-user-agent=Mozilla/5.0\n')
+            f.write(f"{url}\n")
+
+
+def bench_parser(sizes):
+    """Parse synthetic playlists of increasing size; peak memory should not grow with size"""
+    print(f"{'entries':>10} {'seconds':>8} {'entries/s':>10} {'peak KiB':>9}")
+    rows = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = Path(tmp) / f"playlist_{size}.m3u"
+            write_synthetic_playlist(path, size)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            count = sum(1 for _ in iter_entries(path))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f"{count:>10} {elapsed:8.2f} {count / elapsed:10.0f} {peak / 1024:9.0f}")
+            rows.append({'name': 'iter_entries', 'size': count, 'seconds': elapsed, 'peak_kib': peak / 1024})
+            path.unlink()
+    return rows
+
+
+def max_rss_kib(usage):
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return usage.ru_maxrss / 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def run_playlist_tool(tool, playlist, work_dir, connection):
+    """Runs in a fresh interpreter so ru_maxrss is the peak of this one tool"""
+    os.chdir(work_dir)  # split writes {category}.m3u and the downloader its log into the current directory
+    baseline = max_rss_kib(resource.getrusage(resource.RUSAGE_SELF))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if tool == 'parse_m3u_file':
+            from m3u_parser_downloader import parse_m3u_file
+            parse_m3u_file(playlist)
+        elif tool == 'filter_m3u':
+            from filter_m3u import filter_m3u
+            filter_m3u(playlist, f"{GROUPS[0]} 0, {GROUPS[1]} 1", 'filtered.m3u')
+        elif tool == 'split_m3u_by_category':
+            from split_m3u_by_category import split_m3u_by_category
+            split_m3u_by_category(playlist)
+        elif tool == 'extract_categories':
+            from extract_categories import extract_categories
+            extract_categories(playlist)
+        elif tool == 'find_duplicates':
+            from dedup import MATCH_KEYS
+            from find_duplicates import find_duplicates
+            find_duplicates(playlist, 'duplicates.txt', 'deduplicated.m3u', by=MATCH_KEYS)
+        elapsed = time.perf_counter() - start
+    connection.send((elapsed, baseline, max_rss_kib(resource.getrusage(resource.RUSAGE_SELF))))
+
+
+PLAYLIST_TOOLS = ['parse_m3u_file', 'filter_m3u', 'split_m3u_by_category', 'extract_categories', 'find_duplicates']
+
+
+def bench_playlist_tools(sizes, tools=PLAYLIST_TOOLS):
+    """Wall time and peak RSS of each playlist script, one fresh process per run"""
+    print(f"{'tool':<22} {'entries':>10} {'seconds':>8} {'entries/s':>10} {'peak RSS MiB':>13} {'growth MiB':>11}")
+    rows = []
+    context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            playlist = Path(tmp) / f"playlist_{size}.m3u"
+            write_synthetic_playlist(playlist, size)
+            for tool in tools:
+                work_dir = Path(tmp) / tool
+                work_dir.mkdir()
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=run_playlist_tool, args=(tool, str(playlist), str(work_dir), sender))
+                process.start()
+                elapsed, baseline, peak = receiver.recv()
+                process.join()
+                shutil.rmtree(work_dir)
+
+                print(f"{tool:<22} {size:>10} {elapsed:8.2f} {size / elapsed:10.0f} "
+                      f"{peak / 1024:13.1f} {(peak - baseline) / 1024:11.1f}")
+                rows.append({'name': tool, 'size': size, 'seconds': elapsed,
+                             'peak_rss_kib': peak, 'rss_growth_kib': peak - baseline})
+            playlist.unlink()
+    return rows
+
+
+class HLSFixtureHandler(BaseHTTPRequestHandler):
+    """/live/<n>/index.m3u8 is a VOD playlist of server.segments segments of server.segment_size bytes"""
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'live' and parts[2] == 'index.m3u8':
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6', '#EXT-X-MEDIA-SEQUENCE:0']
+            for k in range(self.server.segments):
+                lines += ['#EXTINF:6.0,', f"seg{k}.ts"]
+            lines.append('#EXT-X-ENDLIST')
+            body, content_type = ('\n'.join(lines) + '\n').encode(), 'application/vnd.apple.mpegurl'
+        elif len(parts) == 3 and parts[0] == 'live' and parts[2].endswith('.ts'):
+            body, content_type = self.server.segment, 'video/mp2t'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Stands in for ffmpeg: lists encoders, or copies the -i input (a playlist URL and its
+# segments, a concat list of local segments, or stdin) into the output file while
+# writing -progress blocks like the real one
+STUB_FFMPEG = '''
+import os, sys, time, urllib.request
+from urllib.parse import urljoin
+args = sys.argv[1:]
+if '-encoders' in args:
+    sys.stdout.write(os.environ['BENCH_STUB_ENCODERS'])
+    sys.exit(0)
+start = time.perf_counter()
+source = args[args.index('-i') + 1]
+
+def pieces():
+    if source == 'pipe:0':
+        yield from iter(lambda: sys.stdin.buffer.read(1024 * 1024), b'')
+    elif source.endswith('.ffconcat'):
+        for line in open(source).read().splitlines()[1:]:
+            with open(os.path.join(os.path.dirname(source), line[6:-1]), 'rb') as f:
+                yield f.read()
+    else:
+        with urllib.request.urlopen(source) as response:
+            playlist = response.read().decode()
+        for line in playlist.splitlines():
+            if line and not line.startswith('#'):
+                with urllib.request.urlopen(urljoin(source, line)) as response:
+                    yield response.read()
+
+size = 0
+with open(args[-1], 'wb') as output:
+    for data in pieces():
+        size += output.write(data)
+        print(f"total_size={size}\\nout_time_us={size}\\nspeed=50x\\nprogress=continue", flush=True)
+        time.sleep(float(os.environ['BENCH_SEGMENT_DELAY']))
+print("progress=end", flush=True)
+with open(os.environ['BENCH_JOB_LOG'], 'a') as log:
+    log.write(f"{time.perf_counter() - start}\\n")
+'''
+STUB_FFPROBE = '''
+import json
+print(json.dumps({"streams": [{"codec_type": "video", "codec_name": "h264"},
+                              {"codec_type": "audio", "codec_name": "aac"}],
+                  "format": {"duration": "60.0"}}))
+'''
+
+
+def write_stub(path, source):
+    path.write_text(f"#!{sys.executable}\n{source}", encoding='utf-8')
+    path.chmod(0o755)
+
+
+PIPELINE_FETCH = {'ffmpeg': [], 'native': ['--native-fetch'], 'pipe': ['--pipe']}
+
+
+def bench_pipeline(sizes, workers=4, segments=4, segment_size=64 * 1024, segment_delay=0.01, fetch='ffmpeg'):
+    """
+    Run the whole downloader on playlists served by a local HLS fixture
+    with stub ffmpeg/ffprobe. The stubs do the HTTP work of a remux in a few
+    milliseconds, so the time beyond their own (spread over the workers)
+    is the downloader's overhead: startup, scheduling, probes, bookkeeping
+    and starting the stub processes themselves. fetch picks who downloads
+    the segments: the stub itself (as ffmpeg would), the native fetcher
+    into downloads/.segments, or the native fetcher into the stub's stdin.
+    """
+    print(f"{'entries':>10} {'workers':>7} {'seconds':>8} {'jobs/s':>8} {'job seconds':>11} "
+          f"{'overhead s':>10} {'ms/job':>7} {'peak RSS MiB':>13}")
+    rows = []
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), HLSFixtureHandler)
+    server.daemon_threads = True
+    server.segments, server.segment = segments, os.urandom(segment_size)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            bin_dir = Path(tmp) / 'bin'
+            bin_dir.mkdir()
+            write_stub(bin_dir / 'ffmpeg', STUB_FFMPEG)
+            write_stub(bin_dir / 'ffprobe', STUB_FFPROBE)
+
+            for size in sizes:
+                work_dir = Path(tmp) / f"run_{size}"
+                work_dir.mkdir()
+                playlist = work_dir / 'playlist.m3u'
+                write_synthetic_playlist(playlist, size, base_url=base_url, duplicates=0)
+                job_log = work_dir / 'jobs.txt'
+                env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+                           BENCH_JOB_LOG=str(job_log), BENCH_SEGMENT_DELAY=str(segment_delay),
+                           BENCH_STUB_ENCODERS=STUB_ENCODERS)
+
+                start = time.perf_counter()
+                process = subprocess.Popen(
+                    [sys.executable, str(REPO_DIR / 'm3u_parser_downloader.py'), str(playlist),
+                     '-w', str(workers), '--retries', '0', *PIPELINE_FETCH[fetch]],
+                    cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                # wait4 gives the rusage of this one downloader, not of every child so far
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                elapsed = time.perf_counter() - start
+
+                job_times = [float(line) for line in job_log.read_text().split()] if job_log.exists() else []
+                completed = 0
+                if (work_dir / 'jobs.sqlite').exists():
+                    with contextlib.closing(sqlite3.connect(work_dir / 'jobs.sqlite')) as db:
+                        completed = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'done'").fetchone()[0]
+                if process.returncode != 0 or completed != size:
+                    print(f"Warning: {completed} of {size} entries completed (exit code {process.returncode}), "
+                          f"see {work_dir / 'download_log.log'}")
+                job_seconds = sum(job_times)
+                overhead = elapsed - job_seconds / workers
+                peak = max_rss_kib(usage)
+
+                print(f"{size:>10} {workers:>7} {elapsed:8.2f} {completed / elapsed:8.1f} {job_seconds:11.2f} "
+                      f"{overhead:10.2f} {overhead / size * 1000:7.1f} {peak / 1024:13.1f}")
+                rows.append({'name': 'pipeline', 'fetch': fetch, 'size': size, 'workers': workers, 'seconds': elapsed,
+                             'completed': completed, 'job_seconds': job_seconds, 'overhead_seconds': overhead,
+                             'peak_rss_kib': peak})
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return rows
+
+
+def write_results(path, benchmark, arguments, rows):
+    report = {
+        'benchmark': benchmark,
+        'arguments': arguments,
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': rows,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Results saved to: {path}")
+
+
+# Lower is better for these; everything else in a row is context
+COMPARED_METRICS = ['seconds', 'peak_rss_kib', 'peak_kib', 'overhead_seconds', 'us_per_check', 'jobs_us_per_check',
+                    'jobs_open_ms', 'us_per_name']
+
+
+def result_key(row):
+    """Rows are compared by benchmark, fetch mode and size; pipeline rows from before --fetch read with ffmpeg"""
+    fetch = row.get('fetch', 'ffmpeg' if row['name'] == 'pipeline' else None)
+    return row['name'], fetch, row['size']
+
+
+def compare_results(baseline_path, current_path, threshold=10.0):
+    """
+    Print how every metric changed between two result files. Returns the
+    number of metrics that got worse by more than threshold percent.
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {result_key(row): row for row in json.load(f)['results']}
+    with open(current_path, 'r', encoding='utf-8') as f:
+        current = json.load(f)['results']
+
+    print(f"{'benchmark':<22} {'size':>10} {'metric':<17} {'before':>12} {'after':>12} {'change':>8}")
+    regressions = 0
+    for row in current:
+        before = baseline.get(result_key(row))
+        if before is None:
+            continue
+        name = f"{row['name']} ({row['fetch']})" if row.get('fetch') else row['name']
+        for metric in COMPARED_METRICS:
+            old, new = before.get(metric), row.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            flag = ''
+            if change > threshold:
+                regressions += 1
+                flag = '  REGRESSION'
+            print(f"{name:<22} {row['size']:>10} {metric:<17} {old:12.2f} {new:12.2f} {change:+7.1f}%{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the downloader scripts')
+    parser.add_argument('benchmark', choices=['ledger', 'filenames', 'parser', 'playlist', 'pipeline', 'compare'],
+                        help='What to benchmark, or compare two result files')
+    parser.add_argument('files', nargs='*', help='compare: baseline and current result files')
+    parser.add_argument('--sizes', default=None,
+                      help='Comma-separated sizes to benchmark (ledger entries, collisions or playlist entries)')
+    parser.add_argument('--lookups', type=int, default=1000, help='Skip checks per ledger size')
+    parser.add_argument('--tools', default=','.join(PLAYLIST_TOOLS),
+                      help='playlist: comma-separated scripts to time (default: all)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='pipeline: downloader workers (default: 4)')
+    parser.add_argument('--fetch', choices=PIPELINE_FETCH, default='ffmpeg',
+                      help='pipeline: who downloads the segments: ffmpeg, the native fetcher into files, or '
+                           'the native fetcher piping into ffmpeg (default: ffmpeg)')
+    parser.add_argument('--json', default=None, help='Also write the results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                      help='compare: percent slowdown counted as a regression (default: 10)')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'compare':
+        if len(args.files) != 2:
+            parser.error('compare needs a baseline and a current result file')
+        regressions = compare_results(args.files[0], args.files[1], args.threshold)
+        if regressions:
+            print(f"{regressions} metrics regressed by more than {args.threshold:.0f}%")
+        sys.exit(1 if regressions else 0)
+
+    if args.benchmark == 'ledger':
+        rows = bench_ledger([int(s) for s in (args.sizes or '1000,10000,100000,1000000').split(',')], args.lookups)
+    elif args.benchmark == 'filenames':
+        rows = bench_filenames([int(s) for s in (args.sizes or '100,500,1000,2000').split(',')])
+    elif args.benchmark == 'parser':
+        rows = bench_parser([int(s) for s in (args.sizes or '10000,100000,1000000').split(',')])
+    elif args.benchmark == 'playlist':
+        rows = bench_playlist_tools([int(s) for s in (args.sizes or '1000,10000,100000,1000000').split(',')],
+                                    [t.strip() for t in args.tools.split(',') if t.strip()])
+    elif args.benchmark == 'pipeline':
+        rows = bench_pipeline([int(s) for s in (args.sizes or '20,100').split(',')], args.workers,
+                              fetch=args.fetch)
+
+    if args.json:
+        write_results(args.json, args.benchmark, {k: v for k, v in vars(args).items() if k not in ('json', 'files')},
+                      rows)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import re
+import unicodedata
+from array import array
+from collections import Counter, namedtuple
+
+from m3u_parser import M3UReader
+
+# Query parameters that only carry auth tokens, signatures or expiry times;
+# mirrors of one stream differ only in these. Generic names such as t, e, key
+# or uid select the channel on many IPTV panels, so they are only dropped when
+# asked for (extra_token_params)
+TOKEN_PARAMS = frozenset({
+    'token', 'access_token', 'auth', 'auth_key', 'authkey', 'sign', 'signature', 'sig',
+    'expires', 'expire', 'wssecret', 'wstime', 'txsecret', 'txtime', 'hdnts', 'hdnea', 'policy',
+    'key-pair-id',
+})
+TOKEN_PARAM_PREFIXES = ('x-amz-', 'x-goog-')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# scheme://host[:port]/path?query, split without urllib's per-call overhead
+URL_PATTERN = re.compile(r'^([A-Za-z][A-Za-z0-9+.-]*)://(?:[^@/?#]*@)?([^/?#:]*)(?::(\d*))?([^?#]*)(?:\?([^#]*))?')
+# "cdn3.example.com", "edge-12.example.com" -> "cdn.example.com", "edge.example.com"
+CDN_LABEL_PATTERN = re.compile(r'^([a-z]+)[-_]?\d+\.(?=[^.]+\.[^.]+)')
+DUPLICATE_SLASHES = re.compile(r'/{2,}')
+
+# Episode numbering variants ("第01集", "S01E02", "EP 1", "E01"), matched after NFKC + casefold
+EPISODE_PATTERN = re.compile(
+    r'第\s*0*(\d+)\s*[集话話期回]|\bs\s*0*(\d+)\s*e\s*0*(\d+)\b|\b(?:episode|ep|e)\s*\.?\s*0*(\d+)\b')
+SEPARATORS = re.compile(r'[\W_]+')
+
+MATCH_KEYS = ('url', 'title')
+# Entries sharing a title may still be different streams, so title matching is opt-in
+DEFAULT_MATCH = ('url',)
+
+DuplicateMatch = namedtuple('DuplicateMatch', [
+    'line',       # Line number of the dropped entry
+    'name',
+    'url',
+    'kept_line',  # Line number of the first entry with the same key
+    'reason',     # 'url' or 'title'
+])
+
+
+def normalize_url(url, host_aliases=None, token_params=TOKEN_PARAMS):
+    """
+    Canonical form of a stream URL for duplicate detection: http/https and
+    default ports folded, CDN node numbers and aliased hosts collapsed,
+    token parameters dropped and the remaining query sorted.
+    """
+    url = url.strip()
+    match = URL_PATTERN.match(url)
+    if not match:
+        return url
+    scheme, host, port, path, query = match.groups()
+    scheme = scheme.lower()
+    host = host.lower()
+
+    if host_aliases:
+        host = host_aliases.get(host, host)
+    if not host[-1:].isdigit():  # Leave IP addresses alone
+        host = CDN_LABEL_PATTERN.sub(r'\1.', host, 1)
+    if port and int(port) != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    if scheme == 'https':
+        scheme = 'http'
+
+    if '//' in path:
+        path = DUPLICATE_SLASHES.sub('/', path)
+    normalized = f"{scheme}://{host}{path or '/'}"
+
+    if query:
+        params = sorted(
+            param for param in query.split('&')
+            if param and param.partition('=')[0].lower() not in token_params
+            and not param.lower().startswith(TOKEN_PARAM_PREFIXES)
+        )
+        if params:
+            normalized += '?' + '&'.join(params)
+    return normalized
+
+
+def extra_token_params(names):
+    """TOKEN_PARAMS plus the given parameter names"""
+    return TOKEN_PARAMS | frozenset(name.strip().lower() for name in names if name.strip())
+
+
+def _episode(match):
+    episode, season, season_episode, short = match.groups()
+    if season is not None:
+        return f" s{season}e{season_episode} "
+    return f" e{episode or short} "
+
+
+def normalize_title(title):
+    """
+    Canonical form of a title: full-width characters folded (NFKC), case
+    folded, episode numbering unified ("第01集", "EP 1", "E01" -> "e1") and
+    punctuation/whitespace collapsed.
+    """
+    text = unicodedata.normalize('NFKC', title).casefold()
+    text = EPISODE_PATTERN.sub(_episode, text)
+    return ' '.join(SEPARATORS.sub(' ', text).split())
+
+
+def key_hash(text):
+    """64-bit hash of a normalized key; 0 is reserved for empty table slots"""
+    value = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+    return value or 1
+
+
+class KeyTable:
+    """
+    Open-addressing hash table from 64-bit key hashes to line numbers.
+
+    Keys and values live in two flat arrays (16 bytes per slot at <= 50% load)
+    instead of a dict of Python ints and strings, so millions of entries fit
+    in a few tens of MB.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        self._allocate(capacity)
+        self.count = 0
+
+    def _allocate(self, capacity):
+        self.keys = array('Q', bytes(8 * capacity))
+        self.values = array('q', bytes(8 * capacity))
+        self.mask = capacity - 1
+
+    def _slot(self, key):
+        keys, mask = self.keys, self.mask
+        i = key & mask
+        while True:
+            k = keys[i]
+            if k == 0 or k == key:
+                return i
+            i = (i + 1) & mask
+
+    def get(self, key):
+        i = self._slot(key)
+        return self.values[i] if self.keys[i] == key else None
+
+    def add(self, key, value):
+        i = self._slot(key)
+        if self.keys[i] == key:
+            self.values[i] = value
+            return
+
+        self.keys[i] = key
+        self.values[i] = value
+        self.count += 1
+        if self.count * 2 > self.mask:
+            self._grow()
+
+    def _grow(self):
+        old_keys, old_values = self.keys, self.values
+        self._allocate(len(old_keys) * 2)
+        for key, value in zip(old_keys, old_values):
+            if key:
+                i = self._slot(key)
+                self.keys[i] = key
+                self.values[i] = value
+
+    def __len__(self):
+        return self.count
+
+
+class Deduplicator:
+    """
+    Streaming duplicate detector: check() each entry in input order and the
+    first entry of every normalized URL (and with by including 'title',
+    title) is kept, later ones are reported as DuplicateMatch.
+    """
+
+    def __init__(self, by=DEFAULT_MATCH, host_aliases=None, token_params=TOKEN_PARAMS):
+        unknown = set(by) - set(MATCH_KEYS)
+        if unknown:
+            raise ValueError(f"unknown match keys: {', '.join(sorted(unknown))}")
+        self.by = tuple(by)
+        self.host_aliases = host_aliases
+        self.token_params = token_params
+        self.tables = {key: KeyTable() for key in self.by}
+        self.counts = Counter()
+
+    def check(self, line, name, url):
+        """Record an entry; returns a DuplicateMatch if an earlier entry matches it, else None"""
+        self.counts['entries'] += 1
+        keys = []
+        if 'url' in self.by and url:
+            keys.append(('url', normalize_url(url, self.host_aliases, self.token_params)))
+        if 'title' in self.by and name:
+            title = normalize_title(name)
+            if title:
+                keys.append(('title', title))
+
+        hashes = [(reason, key_hash(key)) for reason, key in keys]
+        for reason, key in hashes:
+            kept = self.tables[reason].get(key)
+            if kept is not None:
+                self.counts[reason] += 1
+                return DuplicateMatch(line, name, url, kept, reason)
+
+        # Only kept entries register their keys, so kept_line always points at a kept entry
+        for reason, key in hashes:
+            self.tables[reason].add(key, line)
+        return None
+
+
+def is_playlist(path):
+    return str(path).lower().endswith(('.m3u', '.m3u8'))
+
+
+class TaskReader:
+    """
+    Iterates (line, name, url, lines) over a task file ("name,url" per line)
+    or an M3U playlist; lines is the original text to copy to a deduplicated
+    file. As with M3UReader, a playlist's header lines are in .headers once
+    the first entry has been yielded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.headers = []
+
+    def __iter__(self):
+        if is_playlist(self.path):
+            reader = M3UReader(self.path)
+            self.headers = reader.headers
+            line = None
+            for entry in reader:
+                if line is None:
+                    line = len(reader.headers) + 1
+                lines = entry.lines
+                if not lines[-1].endswith('\n'):
+                    lines = lines[:-1] + (lines[-1] + '\n',)
+                yield line, entry.name, entry.url, lines
+                line += len(entry.lines)
+            return
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    name, url = line.split(',', 1)
+                except ValueError:
+                    print(f"Warning: Invalid format at line {line_num}: {line}")
+                    continue
+                url = url.strip()
+                yield line_num, name, url, (f"{name},{url}\n",)
+
+
+def dedup_file(input_file, report=None, output_file=None, deduplicator=None):
+    """
+    One streaming pass over input_file: duplicates are passed to report (a
+    callable taking a DuplicateMatch) and everything else is written to
+    output_file. Returns the Deduplicator, whose counts hold the totals.
+    """
+    deduplicator = deduplicator or Deduplicator()
+    reader = TaskReader(input_file)
+    out = open(output_file, 'w', encoding='utf-8', newline='') if output_file else None
+    try:
+        header_written = False
+        for line, name, url, lines in reader:
+            if out is not None and not header_written:
+                out.writelines(reader.headers)
+                header_written = True
+
+            match = deduplicator.check(line, name, url)
+            if match is not None:
+                if report is not None:
+                    report(match)
+            elif out is not None:
+                out.writelines(lines)
+
+        if out is not None and not header_written:
+            out.writelines(reader.headers)
+    finally:
+        if out is not None:
+            out.close()
+    return deduplicator
+
+
+def parse_host_aliases(values):
+    """Parse ["mirror.example.net=example.com", ...] into a dict"""
+    aliases = {}
+    for value in values:
+        alias, sep, host = value.partition('=')
+        if not sep or not alias or not host:
+            raise argparse.ArgumentTypeError(f"expected alias=host, got '{value}'")
+        aliases[alias.lower()] = host.lower()
+    return aliases
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find and drop duplicate streams by normalized URL (and title)')
+    parser.add_argument('input_file', help='Task file (name,url per line) or .m3u playlist')
+    parser.add_argument('-o', '--output', help='Write the deduplicated task file/playlist here')
+    parser.add_argument('-r', '--report', help='Write one line per dropped duplicate here')
+    parser.add_argument('--by', default=','.join(DEFAULT_MATCH),
+                      help=f"Comma-separated keys to match on: url, title (default: {','.join(DEFAULT_MATCH)})")
+    parser.add_argument('--host-alias', action='append', default=[],
+                      help='Treat a mirror host as another, e.g. "cdn.mirror.net=example.com" (repeatable)')
+    parser.add_argument('--token-param', action='append', default=[],
+                      help='Also ignore this query parameter when comparing URLs, e.g. "t" (repeatable)')
+    args = parser.parse_args()
+
+    deduplicator = Deduplicator([k.strip() for k in args.by.split(',') if k.strip()],
+                                parse_host_aliases(args.host_alias), extra_token_params(args.token_param))
+    report_file = open(args.report, 'w', encoding='utf-8') if args.report else None
+    try:
+        def report(match):
+            if report_file is not None:
+                report_file.write(f"Line {match.line}: {match.name},{match.url} "
+                                  f"(same {match.reason} as line {match.kept_line})\n")
+        dedup_file(args.input_file, report, args.output, deduplicator)
+    finally:
+        if report_file is not None:
+            report_file.close()
+
+    counts = deduplicator.counts
+    print(f"{counts['entries']} entries, {counts['url'] + counts['title']} duplicates "
+          f"({counts['url']} by URL, {counts['title']} by title)")
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import re
+import subprocess
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+ENCODER_TEST_TIMEOUT = 20
+ENCODER_MAX_FAILURES = 2  # Encoder errors (not stream errors) before a profile is dropped for the run
+
+# name: what --encoder and the logs call it; encoder: the ffmpeg -c:v value;
+# args: output options after -c:v; input_args: options before -i (hardware devices)
+EncoderProfile = namedtuple('EncoderProfile', ['name', 'encoder', 'args', 'input_args'])
+
+# Fastest first: hardware HEVC, hardware H.264, then the software encoders
+BUILTIN_PROFILES = [
+    EncoderProfile('hevc_nvenc', 'hevc_nvenc', ('-preset', 'p4', '-tag:v', 'hvc1'), ()),
+    EncoderProfile('hevc_amf', 'hevc_amf', ('-quality', 'speed', '-tag:v', 'hvc1'), ()),
+    EncoderProfile('hevc_qsv', 'hevc_qsv', ('-preset', 'faster', '-tag:v', 'hvc1'), ()),
+    EncoderProfile('hevc_videotoolbox', 'hevc_videotoolbox', ('-tag:v', 'hvc1'), ()),
+    EncoderProfile('hevc_vaapi', 'hevc_vaapi', ('-vf', 'format=nv12,hwupload', '-tag:v', 'hvc1'),
+                   ('-vaapi_device', '/dev/dri/renderD128')),
+    EncoderProfile('h264_nvenc', 'h264_nvenc', ('-preset', 'p4'), ()),
+    EncoderProfile('h264_amf', 'h264_amf', ('-quality', 'speed'), ()),
+    EncoderProfile('h264_qsv', 'h264_qsv', ('-preset', 'faster'), ()),
+    EncoderProfile('h264_videotoolbox', 'h264_videotoolbox', (), ()),
+    EncoderProfile('h264_vaapi', 'h264_vaapi', ('-vf', 'format=nv12,hwupload'),
+                   ('-vaapi_device', '/dev/dri/renderD128')),
+    EncoderProfile('libx265', 'libx265', ('-preset', 'fast', '-crf', '26', '-tag:v', 'hvc1'), ()),
+    EncoderProfile('libx264', 'libx264', ('-preset', 'veryfast', '-crf', '23'), ()),
+]
+SOFTWARE_ENCODERS = {'libx265', 'libx264'}
+
+ENCODER_LINE_PATTERN = re.compile(r'^\s*V\S*\s+(\S+)')
+# ffmpeg errors that mean the encoder itself couldn't run, as opposed to a bad or unreachable source
+ENCODER_ERROR_PATTERN = re.compile(
+    r'Error while opening encoder|Could not open encoder|Unknown encoder|Encoder not found|'
+    r'Error initializing output stream|Cannot load \S*(?:nvcuda|nvidia|amfrt)|No NVENC capable devices|'
+    r'OpenEncodeSession\w* failed|Failed to (?:initialise|create) VAAPI|Device creation failed|'
+    r'Error creating a MFX session|InitializeEncoder failed|No capable devices found',
+    re.IGNORECASE)
+
+
+def quality_args(encoder, crf=None, preset=None, bitrate=None):
+    """
+    Translate profile settings into the options of the given encoder.
+    crf is the constant-quality value in whatever scale the encoder uses
+    (CRF for x264/x265, CQ for NVENC, global_quality for QSV, QP for AMF/VAAPI).
+    """
+    args = []
+    if bitrate:
+        args += ['-b:v', str(bitrate)]
+    if crf is not None:
+        if encoder in SOFTWARE_ENCODERS:
+            args += ['-crf', str(crf)]
+        elif encoder.endswith('_nvenc'):
+            args += ['-rc', 'vbr', '-cq', str(crf)]
+        elif encoder.endswith('_qsv'):
+            args += ['-global_quality', str(crf)]
+        elif encoder.endswith('_amf'):
+            args += ['-rc', 'cqp', '-qp_i', str(crf), '-qp_p', str(crf)]
+        elif encoder.endswith('_vaapi'):
+            args += ['-rc_mode', 'CQP', '-qp', str(crf)]
+        else:
+            logger.warning(f"{encoder} has no constant-quality mode; ignoring crf, use bitrate instead")
+    if preset:
+        if encoder.endswith('_amf'):
+            args += ['-quality', str(preset)]
+        elif encoder in SOFTWARE_ENCODERS or encoder.endswith(('_nvenc', '_qsv')):
+            args += ['-preset', str(preset)]
+        else:
+            logger.warning(f"{encoder} has no presets; ignoring preset '{preset}'")
+    return args
+
+
+def make_profile(data):
+    """
+    Build a profile from a user definition such as
+    {"name": "archive", "encoder": "libx265", "crf": 22, "preset": "slow"}.
+    Device and upload options of the matching built-in backend are kept;
+    "args" adds raw ffmpeg output options.
+    """
+    encoder = data['encoder']
+    builtin = next((p for p in BUILTIN_PROFILES if p.encoder == encoder), None)
+    # The built-in backend's upload filter is kept; its quality and preset options are not
+    args = []
+    if builtin is not None and '-vf' in builtin.args:
+        args += ['-vf', builtin.args[builtin.args.index('-vf') + 1]]
+    args += quality_args(encoder, data.get('crf'), data.get('preset'), data.get('bitrate'))
+    args += [str(arg) for arg in data.get('args', [])]
+    if encoder.startswith('hevc') or encoder == 'libx265':
+        args += ['-tag:v', 'hvc1']
+    input_args = tuple(data.get('input_args', builtin.input_args if builtin else ()))
+    return EncoderProfile(data.get('name', encoder), encoder, tuple(args), input_args)
+
+
+def load_profiles(path):
+    """User profiles from a JSON file: a list of definitions, or {"profiles": [...]}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('profiles', [])
+    return [make_profile(item) for item in data]
+
+
+def list_encoders(timeout=ENCODER_TEST_TIMEOUT):
+    """Names of the video encoders in this ffmpeg build (ffmpeg -encoders), or None if ffmpeg can't run"""
+    try:
+        process = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True,
+                                 encoding='utf-8', errors='replace', timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Could not list ffmpeg encoders: {e}")
+        return None
+    names = set()
+    in_list = False
+    for line in process.stdout.splitlines():
+        if line.strip().startswith('------'):
+            in_list = True
+        elif in_list:
+            match = ENCODER_LINE_PATTERN.match(line)
+            if match:
+                names.add(match.group(1))
+    return names
+
+
+def encoder_works(profile, timeout=ENCODER_TEST_TIMEOUT):
+    """Encode a few frames of a test pattern: a hardware encoder is listed even where the device is missing"""
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        *profile.input_args,
+        '-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=25:duration=0.2',
+        '-c:v', profile.encoder, *profile.args,
+        '-f', 'null', '-'
+    ]
+    try:
+        process = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace',
+                                 timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.info(f"Encoder {profile.name} unusable: {e}")
+        return False
+    if process.returncode != 0:
+        logger.info(f"Encoder {profile.name} unusable: {(process.stderr.strip().splitlines() or ['failed'])[-1]}")
+        return False
+    return True
+
+
+def is_encoder_error(stderr):
+    return bool(ENCODER_ERROR_PATTERN.search(stderr or ''))
+
+
+class EncoderSelector:
+    """
+    The ordered chain of encoder profiles jobs transcode with.
+
+    select() probes ffmpeg once: profiles whose encoder isn't in this build
+    are dropped and hardware ones must pass a short test encode. A job
+    tries the chain in order and moves on when an encoder fails to open;
+    a profile that fails like that max_failures times in a row is dropped
+    for the rest of the run (the last one is always kept).
+    """
+
+    def __init__(self, max_failures=ENCODER_MAX_FAILURES):
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+        self.profiles = [p for p in BUILTIN_PROFILES if p.encoder in SOFTWARE_ENCODERS]
+        self.failures = {}
+        self._selected = False
+
+    def select(self, preference='auto', profiles_file=None):
+        """
+        Build the chain from preference: 'auto' (user profiles first, then
+        the built-ins fastest first) or comma-separated profile names.
+        Later calls are no-ops.
+        """
+        with self.lock:
+            if self._selected:
+                return self
+            user_profiles = load_profiles(profiles_file) if profiles_file else []
+            known = {p.name: p for p in BUILTIN_PROFILES}
+            known.update((p.name, p) for p in user_profiles)
+
+            if preference in (None, '', 'auto'):
+                candidates = user_profiles + [p for p in BUILTIN_PROFILES
+                                              if p.name not in {u.name for u in user_profiles}]
+            else:
+                candidates = []
+                for name in preference.split(','):
+                    name = name.strip()
+                    if name not in known:
+                        raise ValueError(f"Unknown encoder profile '{name}', expected one of "
+                                         f"{', '.join(known)}")
+                    candidates.append(known[name])
+
+            available = list_encoders()
+            if available is None:
+                logger.warning("Encoder probe failed; using the encoder order as given")
+                chain = candidates
+            else:
+                chain = [p for p in candidates if p.encoder in available
+                         and (p.encoder in SOFTWARE_ENCODERS or encoder_works(p))]
+                if not chain:
+                    logger.warning(f"None of {', '.join(p.name for p in candidates)} works with this ffmpeg; "
+                                   f"trying them anyway")
+                    chain = candidates
+
+            self.profiles = chain
+            self._selected = True
+            logger.info(f"Encoders: {' -> '.join(p.name for p in chain)}")
+        return self
+
+    def chain(self):
+        with self.lock:
+            return list(self.profiles)
+
+    def failed(self, profile, stderr):
+        """
+        Record a failed transcode. Returns True if the encoder itself failed,
+        i.e. the job should try the next profile.
+        """
+        if not is_encoder_error(stderr):
+            return False
+        with self.lock:
+            count = self.failures[profile.name] = self.failures.get(profile.name, 0) + 1
+            if count >= self.max_failures and profile in self.profiles and len(self.profiles) > 1:
+                self.profiles.remove(profile)
+                logger.warning(f"Encoder {profile.name} failed {count} times in a row; "
+                               f"using {' -> '.join(p.name for p in self.profiles)} from now on")
+        return True
+
+    def succeeded(self, profile):
+        with self.lock:
+            self.failures.pop(profile.name, None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show which encoder profiles work with this ffmpeg')
+    parser.add_argument('--encoder', default='auto', help="'auto' or comma-separated profile names")
+    parser.add_argument('--encoder-profiles', default=None, help='JSON file with user-defined profiles')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    selector = EncoderSelector().select(args.encoder, args.encoder_profiles)
+    for profile in selector.chain():
+        print(f"{profile.name}: -c:v {profile.encoder} {' '.join(profile.args)}")
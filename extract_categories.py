@@ -1,17 +1,18 @@
-import re
 import argparse
 from pathlib import Path
 
-def extract_categories(m3u_file):
-    category_pattern = re.compile(r'\[(.*?)\]')
-    categories = set()
+from m3u_parser import iter_entries
+from playlist_index import PlaylistIndex
 
-    with open(m3u_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.startswith('#EXTINF'):
-                match = category_pattern.search(line)
-                if match:
-                    categories.add(match.group(1))
+def extract_categories(m3u_file, use_index=False):
+    if use_index:
+        with PlaylistIndex(m3u_file) as index:
+            categories = set(index.categories())
+    else:
+        categories = set()
+        for entry in iter_entries(m3u_file):
+            if entry.category is not None:
+                categories.add(entry.category)
     
     print("Unique categories found:")
     for category in sorted(categories):
@@ -20,6 +21,8 @@ def extract_categories(m3u_file):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract unique categories from M3U file')
     parser.add_argument('input_file', type=Path, help='Path to M3U file')
+    parser.add_argument('--index', action='store_true',
+                        help='Query the <input_file>.index.sqlite sidecar (built or refreshed as needed) instead of rescanning')
     args = parser.parse_args()
     
-    extract_categories(args.input_file) 
\ No newline at end of file
+    extract_categories(args.input_file, args.index) 
\ No newline at end of file
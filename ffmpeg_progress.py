@@ -0,0 +1,441 @@
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STALL_SECONDS = 180  # Kill a job whose output hasn't advanced for this long
+POLL_SECONDS = 1.0
+PIPE_BUFFER = 1024 * 1024  # Kernel buffer of the pipe segments are fed through (Linux)
+
+BITRATE_PATTERN = re.compile(r'([\d.]+)\s*kbits/s')
+
+
+class FFmpegStalled(subprocess.TimeoutExpired):
+    """ffmpeg stopped making progress and was killed before the overall timeout"""
+
+    def __str__(self):
+        return f"ffmpeg made no progress for {self.timeout:.0f} seconds"
+
+
+def parse_speed(value):
+    """Parse ffmpeg's speed field, e.g. '1.53x' or 'N/A'"""
+    try:
+        return float(value.strip().rstrip('x'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_bitrate(value):
+    """Parse ffmpeg's bitrate field, e.g. '2450.3kbits/s', into kbit/s"""
+    match = BITRATE_PATTERN.match(value or '')
+    return float(match.group(1)) if match else None
+
+
+def parse_out_time(fields):
+    """Output position in seconds; out_time_ms is in microseconds too (an old ffmpeg quirk)"""
+    for key in ('out_time_us', 'out_time_ms'):
+        try:
+            return int(fields[key]) / 1e6
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+class ProgressMonitor:
+    """
+    Thread-safe view of the latest ffmpeg -progress report of every running job,
+    plus counters for finished ones.
+
+    A job counts as progressing while its output position or size grows;
+    run_ffmpeg kills jobs idle for longer than stall_timeout.
+    """
+
+    def __init__(self, stall_timeout=DEFAULT_STALL_SECONDS):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.stall_timeout = stall_timeout
+        self.outcomes = {'completed': 0, 'failed': 0, 'stalled': 0, 'timeout': 0}
+        self.finished_seconds = 0.0  # Wall time of completed jobs, for the run ETA
+        self.finished_bytes = 0
+
+    def start(self, job, duration=None):
+        """Register a job; duration is the expected output length in seconds, used for its ETA"""
+        now = time.monotonic()
+        with self.lock:
+            self.jobs[job] = {'started': now, 'updated': now, 'progressed': now, 'duration': duration,
+                              'speed': None, 'bitrate': None, 'total_size': 0, 'position': None}
+
+    def update(self, job, fields):
+        now = time.monotonic()
+        with self.lock:
+            stats = self.jobs.get(job)
+            if stats is None:
+                stats = self.jobs[job] = {'started': now, 'progressed': now, 'duration': None,
+                                          'total_size': 0, 'position': None}
+            stats['speed'] = parse_speed(fields.get('speed'))
+            stats['bitrate'] = parse_bitrate(fields.get('bitrate'))
+            try:
+                size = int(fields.get('total_size', 0))
+            except ValueError:
+                size = stats['total_size']
+            position = parse_out_time(fields)
+
+            if size > stats['total_size'] or (position or 0) > (stats['position'] or 0):
+                stats['progressed'] = now
+            stats['total_size'] = max(size, stats['total_size'])
+            if position is not None:
+                stats['position'] = position
+            stats['updated'] = now
+
+    def idle(self, job):
+        """Seconds since the job last made progress"""
+        with self.lock:
+            stats = self.jobs.get(job)
+            return time.monotonic() - stats['progressed'] if stats else 0.0
+
+    def finish(self, job, outcome='completed'):
+        with self.lock:
+            stats = self.jobs.pop(job, None)
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            if stats is not None:
+                self.finished_bytes += stats.get('total_size', 0)
+                if outcome == 'completed':
+                    self.finished_seconds += time.monotonic() - stats['started']
+
+    def snapshot(self):
+        with self.lock:
+            return {job: dict(stats) for job, stats in self.jobs.items()}
+
+    def totals(self):
+        with self.lock:
+            return dict(self.outcomes), self.finished_seconds, self.finished_bytes
+
+    def bytes_written(self):
+        """Output bytes of finished and running jobs together, a counter that only grows"""
+        with self.lock:
+            return self.finished_bytes + sum(stats.get('total_size', 0) for stats in self.jobs.values())
+
+
+def job_eta(stats):
+    """Seconds until the job's output reaches its expected duration, or None"""
+    duration, position, speed = stats.get('duration'), stats.get('position'), stats.get('speed')
+    if not duration or position is None or not speed:
+        return None
+    return max(duration - position, 0) / speed
+
+
+def read_progress(stream, job, monitor):
+    """Consume key=value blocks from ffmpeg -progress; each block ends with progress=..."""
+    fields = {}
+    for line in stream:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        fields[key] = value
+        if key == 'progress':
+            if monitor is not None:
+                monitor.update(job, fields)
+            fields = {}
+
+
+def kill_session(process):
+    """Kill ffmpeg together with anything it spawned, so its pipes close promptly"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        process.kill()
+
+
+def open_input_pipe():
+    """(read_fd, write_fd) of a pipe for ffmpeg's stdin, with a large buffer where the OS allows it"""
+    read_fd, write_fd = os.pipe()
+    if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, PIPE_BUFFER)
+        except OSError:
+            pass  # Above /proc/sys/fs/pipe-max-size; the default buffer works, with more wakeups
+    return read_fd, write_fd
+
+
+def run_ffmpeg(cmd, timeout, job=None, monitor=None, tracker=None, duration=None, feed=None):
+    """
+    Run an ffmpeg command with -progress reporting into monitor.
+    Returns (returncode, stderr). Raises subprocess.TimeoutExpired after
+    killing the process if it runs longer than timeout, or FFmpegStalled
+    if its output stops advancing for monitor.stall_timeout seconds.
+
+    feed(fd), if given, writes ffmpeg's input (pipe:0) to the pipe fd from
+    a thread of its own. If it raises, ffmpeg is killed, since the output
+    would be cut short, and the error is raised here.
+    """
+    cmd = [cmd[0], '-progress', 'pipe:1', '-nostats'] + list(cmd[1:])
+
+    read_fd = write_fd = None
+    if feed is not None:
+        read_fd, write_fd = open_input_pipe()
+    # In its own session so Ctrl+C drains the queue instead of killing running jobs
+    try:
+        process = subprocess.Popen(
+            cmd,
+            stdin=read_fd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            errors='replace',
+            start_new_session=True
+        )
+    except OSError:
+        if write_fd is not None:
+            os.close(write_fd)
+        raise
+    finally:
+        if read_fd is not None:
+            os.close(read_fd)
+    if tracker is not None:
+        tracker.add(process)
+    if monitor is not None:
+        monitor.start(job, duration)
+    stall_timeout = monitor.stall_timeout if monitor is not None else None
+
+    stderr_lines = []
+    feed_errors = []
+
+    def feed_input():
+        try:
+            feed(write_fd)
+        except BrokenPipeError:
+            pass  # ffmpeg stopped reading; its exit status tells why
+        except Exception as e:
+            feed_errors.append(e)
+            kill_session(process)
+        finally:
+            os.close(write_fd)
+
+    readers = [
+        threading.Thread(target=read_progress, args=(process.stdout, job, monitor), daemon=True),
+        threading.Thread(target=stderr_lines.extend, args=(process.stderr,), daemon=True),
+    ]
+    if feed is not None:
+        readers.append(threading.Thread(target=feed_input, name=f"{threading.current_thread().name}-feed",
+                                        daemon=True))
+    for reader in readers:
+        reader.start()
+
+    outcome = 'failed'
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                process.wait(timeout=POLL_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if time.monotonic() >= deadline:
+                outcome = 'timeout'
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            if stall_timeout and monitor.idle(job) > stall_timeout:
+                outcome = 'stalled'
+                raise FFmpegStalled(cmd, stall_timeout)
+        if process.returncode == 0:
+            outcome = 'completed'
+    except subprocess.TimeoutExpired:
+        kill_session(process)
+        process.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        process.stdout.close()
+        process.stderr.close()
+        if tracker is not None:
+            tracker.discard(process)
+        if monitor is not None:
+            monitor.finish(job, outcome)
+
+    if feed_errors:
+        raise feed_errors[0]
+    return process.returncode, ''.join(stderr_lines)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f}{unit}" if unit != 'B' else f"{size}B"
+        size /= 1024
+
+
+class ProgressReporter:
+    """
+    Periodically turns a ProgressMonitor into a terminal dashboard and/or a
+    metrics file: JSON lines (one snapshot per line) or, for a path ending in
+    .prom, Prometheus text format rewritten in place (node_exporter textfile style).
+
+    progress, if given, returns (finished_tasks, total_tasks) for the run ETA.
+    """
+
+    def __init__(self, monitor, interval=5.0, dashboard=False, metrics_file=None, progress=None,
+                 stream=None):
+        self.monitor = monitor
+        self.interval = interval
+        self.dashboard = dashboard
+        self.metrics_file = metrics_file
+        self.progress = progress
+        self.stream = stream or sys.stderr
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_bytes = None
+        self._last_time = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='Progress', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()  # Final numbers
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                logger.error(f"Progress report failed: {e}")
+
+    def sample(self):
+        jobs = self.monitor.snapshot()
+        outcomes, finished_seconds, finished_bytes = self.monitor.totals()
+        now = time.monotonic()
+
+        total_bytes = finished_bytes + sum(stats.get('total_size', 0) for stats in jobs.values())
+        throughput = None
+        if self._last_bytes is not None and now > self._last_time:
+            throughput = max(total_bytes - self._last_bytes, 0) / (now - self._last_time)
+        self._last_bytes, self._last_time = total_bytes, now
+
+        rows = []
+        for job, stats in sorted(jobs.items(), key=lambda item: item[1]['started']):
+            rows.append({
+                'job': job,
+                'speed': stats.get('speed'),
+                'bitrate_kbps': stats.get('bitrate'),
+                'size': stats.get('total_size', 0),
+                'position': stats.get('position'),
+                'duration': stats.get('duration'),
+                'eta': job_eta(stats),
+                'idle': round(now - stats['progressed'], 1),
+                'elapsed': round(now - stats['started'], 1),
+            })
+
+        # Run ETA: queued tasks at the average completed job time, spread over the running jobs
+        run_eta = None
+        if self.progress is not None and outcomes['completed']:
+            finished, total = self.progress()
+            queued = max(total - finished - len(rows), 0)
+            average = finished_seconds / outcomes['completed']
+            running_left = sum(row['eta'] if row['eta'] is not None else max(average - row['elapsed'], 0)
+                               for row in rows)
+            run_eta = (queued * average + running_left) / max(len(rows), 1)
+
+        return {
+            'time': round(time.time(), 3),
+            'running': len(rows),
+            **outcomes,
+            'throughput_bytes_per_second': round(throughput, 1) if throughput is not None else None,
+            'run_eta': round(run_eta, 1) if run_eta is not None else None,
+            'jobs': rows,
+        }
+
+    def report(self):
+        sample = self.sample()
+        if self.dashboard:
+            self.stream.write(render_dashboard(sample, clear=self.stream.isatty()))
+            self.stream.flush()
+        if self.metrics_file:
+            if str(self.metrics_file).endswith('.prom'):
+                write_atomic(self.metrics_file, render_prometheus(sample))
+            else:
+                with open(self.metrics_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(sample, ensure_ascii=False) + '\n')
+
+
+def render_dashboard(sample, clear=True, name_width=40):
+    throughput = sample['throughput_bytes_per_second']
+    lines = [
+        f"Jobs: {sample['running']} running, {sample['completed']} done, {sample['failed']} failed, "
+        f"{sample['stalled']} stalled, {sample['timeout']} timed out | "
+        f"throughput {format_size(throughput) + '/s' if throughput is not None else '-'} | "
+        f"run ETA {format_duration(sample['run_eta'])}",
+        f"{'JOB':<{name_width}} {'SPEED':>6} {'BITRATE':>11} {'SIZE':>9} {'POSITION':>9} {'ETA':>9} {'IDLE':>6}",
+    ]
+    for row in sample['jobs']:
+        name = str(row['job'])
+        if len(name) > name_width:
+            name = name[:name_width - 1] + '…'
+        speed = f"{row['speed']:.2f}x" if row['speed'] is not None else '-'
+        bitrate = f"{row['bitrate_kbps']:.0f}kb/s" if row['bitrate_kbps'] is not None else '-'
+        lines.append(f"{name:<{name_width}} {speed:>6} {bitrate:>11} {format_size(row['size']):>9} "
+                     f"{format_duration(row['position']):>9} {format_duration(row['eta']):>9} "
+                     f"{row['idle']:>5.0f}s")
+    text = '\n'.join(lines) + '\n'
+    return ('\x1b[H\x1b[2J' + text) if clear else (text + '\n')
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def render_prometheus(sample):
+    lines = [
+        '# HELP ffmpeg_jobs_running ffmpeg jobs currently running',
+        '# TYPE ffmpeg_jobs_running gauge',
+        f"ffmpeg_jobs_running {sample['running']}",
+        '# HELP ffmpeg_jobs_finished_total ffmpeg jobs finished, by outcome',
+        '# TYPE ffmpeg_jobs_finished_total counter',
+    ]
+    for outcome in ('completed', 'failed', 'stalled', 'timeout'):
+        lines.append(f'ffmpeg_jobs_finished_total{{outcome="{outcome}"}} {sample[outcome]}')
+    if sample['throughput_bytes_per_second'] is not None:
+        lines += ['# TYPE ffmpeg_throughput_bytes_per_second gauge',
+                  f"ffmpeg_throughput_bytes_per_second {sample['throughput_bytes_per_second']}"]
+    if sample['run_eta'] is not None:
+        lines += ['# TYPE ffmpeg_run_eta_seconds gauge', f"ffmpeg_run_eta_seconds {sample['run_eta']}"]
+
+    per_job = [('speed', 'ffmpeg_job_speed_ratio'), ('bitrate_kbps', 'ffmpeg_job_bitrate_kbps'),
+               ('size', 'ffmpeg_job_output_bytes'), ('position', 'ffmpeg_job_position_seconds'),
+               ('eta', 'ffmpeg_job_eta_seconds'), ('idle', 'ffmpeg_job_idle_seconds')]
+    for field, metric in per_job:
+        lines.append(f"# TYPE {metric} gauge")
+        for row in sample['jobs']:
+            if row[field] is not None:
+                lines.append(f'{metric}{{job="{_label(row["job"])}"}} {row[field]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,86 @@
+import os
+import re
+import threading
+from pathlib import Path
+
+SUFFIX_PATTERN = re.compile(r'^(.*)-(\d+)$')
+
+
+class FilenameAllocator:
+    """
+    Hands out unique output filenames without probing the filesystem.
+
+    The output directory is scanned once; after that a per-base-name counter
+    kept in memory gives the next free "-N" suffix directly. Names are reserved
+    with O_CREAT | O_EXCL, so a file created behind our back is never reused.
+    """
+
+    def __init__(self, output_dir, extension='.mp4', lock=None):
+        self.output_dir = Path(output_dir)
+        self.extension = extension
+        self.lock = lock or threading.Lock()
+        # Highest counter in use per base name; "Name" counts as 1, "Name-3" as 3
+        self.counters = {}
+        self._scanned = False
+
+    def _note(self, stem):
+        self.counters[stem] = max(self.counters.get(stem, 0), 1)
+        match = SUFFIX_PATTERN.match(stem)
+        if match:
+            base, counter = match.group(1), int(match.group(2))
+            self.counters[base] = max(self.counters.get(base, 0), counter)
+
+    def scan(self):
+        """Read the output directory once; later calls are no-ops"""
+        with self.lock:
+            if self._scanned:
+                return self
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            with os.scandir(self.output_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(self.extension):
+                        self._note(entry.name[:-len(self.extension)])
+            self._scanned = True
+        return self
+
+    def allocate(self, clean_name):
+        """
+        Reserve a unique name based on clean_name.
+        Returns (final_name, output_file).
+        """
+        if not self._scanned:
+            self.scan()
+
+        with self.lock:
+            counter = self.counters.get(clean_name, 0)
+            while True:
+                counter += 1
+                final_name = clean_name if counter == 1 else f"{clean_name}-{counter}"
+                output_file = self.output_dir / f"{final_name}{self.extension}"
+                try:
+                    fd = os.open(output_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    # Created outside this process since the scan; keep counting
+                    self._note(final_name)
+                    continue
+                os.close(fd)
+                self.counters[clean_name] = counter
+                self._note(final_name)
+                return final_name, output_file
+
+    def release(self, output_file):
+        """
+        Give back a name from allocate() whose download failed and remove
+        the file. If it was the latest name for its base, the counter is
+        wound back so a retry gets the same name instead of the next "-N".
+        """
+        output_file = Path(output_file)
+        stem = output_file.name[:-len(self.extension)]
+        with self.lock:
+            output_file.unlink(missing_ok=True)
+            # A counter left too low only costs allocate() an extra O_EXCL attempt
+            match = SUFFIX_PATTERN.match(stem)
+            if match and self.counters.get(match.group(1)) == int(match.group(2)):
+                self.counters[match.group(1)] -= 1
+            elif self.counters.get(stem) == 1:
+                self.counters[stem] = 0
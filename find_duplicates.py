@@ -1,55 +1,64 @@
 #!/usr/bin/env python3
+import os
 import sys
-from collections import defaultdict
 import argparse
 from datetime import datetime
 
-def find_duplicates(input_file, output_file=None):
+from dedup import (DEFAULT_MATCH, TOKEN_PARAMS, Deduplicator, DuplicateMatch, TaskReader, dedup_file,
+                   extra_token_params, parse_host_aliases)
+
+def duplicate_groups(input_file, dedup_output=None, deduplicator=None, dropped_only=False):
+    """
+    Entries that share a normalized key, as a list of groups in input order.
+    Each group is a list of DuplicateMatch, the kept entry first (its reason
+    is None) followed by the dropped ones; with dropped_only the kept entry
+    is left out, which saves a second pass over the input.
+    """
+    groups = {}
+    dedup_file(input_file, lambda match: groups.setdefault(match.kept_line, []).append(match),
+               dedup_output, deduplicator)
+    if groups and not dropped_only:
+        for line, name, url, _ in TaskReader(input_file):
+            if line in groups:
+                groups[line].insert(0, DuplicateMatch(line, name, url, line, None))
+    return [groups[line] for line in sorted(groups)]
+
+def write_entries(f, input_file, groups):
+    """name,url per line for every entry of every group"""
+    for group in groups:
+        for match in group:
+            f.write(f"{match.name},{match.url}\n")
+
+def find_duplicates(input_file, output_file=None, dedup_output=None, by=DEFAULT_MATCH, host_aliases=None,
+                    token_params=TOKEN_PARAMS, dropped_only=False, write_report=write_entries):
     # If no output file specified, create one with timestamp
     if output_file is None:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = f"duplicates_{timestamp}.txt"
     
-    # Dictionary to store filename occurrences with line numbers and URLs
-    filename_occurrences = defaultdict(list)
+    # Entries are matched by normalized URL (and title, if asked) in a streaming pass
+    deduplicator = Deduplicator(by, host_aliases, token_params)
     
     try:
-        # Read input file
-        with open(input_file, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                try:
-                    name, url = line.split(',', 1)
-                    filename_occurrences[name].append({
-                        'line_number': line_num,
-                        'url': url.strip()
-                    })
-                except ValueError:
-                    print(f"Warning: Invalid format at line {line_num}: {line}")
-                    continue
-        
-        # Write duplicates to output file in name,url format
+        groups = duplicate_groups(input_file, dedup_output, deduplicator, dropped_only)
         with open(output_file, 'w', encoding='utf-8') as f:
-            for name, occurrences in filename_occurrences.items():
-                if len(occurrences) > 1:  # Only write duplicates
-                    for occurrence in occurrences:
-                        f.write(f"{name},{occurrence['url']}\n")
+            write_report(f, input_file, groups)
+            empty = f.tell() == 0
         
         # Print summary
-        duplicate_count = sum(1 for occurrences in filename_occurrences.values() if len(occurrences) > 1)
+        duplicate_count = deduplicator.counts['url'] + deduplicator.counts['title']
         if duplicate_count > 0:
-            print(f"Found {duplicate_count} duplicated filenames. Results saved to: {output_file}")
+            print(f"Found {len(groups)} duplicated entries ({duplicate_count} to drop). "
+                  f"Results saved to: {output_file}")
         else:
             print("No duplicates found.")
+        if empty:
             # Remove output file if it's empty
-            try:
-                import os
-                os.remove(output_file)
-            except:
-                pass
+            os.remove(output_file)
+        elif duplicate_count == 0:
+            print(f"Results saved to: {output_file}")
+        if dedup_output:
+            print(f"Deduplicated list saved to: {dedup_output}")
             
     except FileNotFoundError:
         print(f"Error: File '{input_file}' not found.")
@@ -58,10 +67,25 @@ def find_duplicates(input_file, output_file=None):
         print(f"Error processing file: {str(e)}")
         sys.exit(1)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Find duplicate filenames in a text file')
-    parser.add_argument('input_file', help='Input file containing names and URLs (format: name,url)')
+def add_arguments(parser):
+    parser.add_argument('input_file', help='Input file containing names and URLs (format: name,url) or an .m3u playlist')
     parser.add_argument('-o', '--output', help='Output file path (optional, default: duplicates_TIMESTAMP.txt)')
-    
-    args = parser.parse_args()
-    find_duplicates(args.input_file, args.output) 
\ No newline at end of file
+    parser.add_argument('-d', '--dedup-output', help='Also write the input without duplicates to this file')
+    parser.add_argument('--by', default=','.join(DEFAULT_MATCH),
+                        help=f"Match on normalized url, title or both (default: {','.join(DEFAULT_MATCH)})")
+    parser.add_argument('--host-alias', action='append', default=[],
+                        help='Treat a mirror host as another, e.g. "cdn.mirror.net=example.com" (repeatable)')
+    parser.add_argument('--token-param', action='append', default=[],
+                        help='Also ignore this query parameter when comparing URLs, e.g. "t" (repeatable)')
+    parser.add_argument('--dropped-only', action='store_true',
+                        help='Only list the entries -d drops, not the first entry of each group that it keeps')
+
+def run(args, write_report=write_entries):
+    find_duplicates(args.input_file, args.output, args.dedup_output,
+                    [k.strip() for k in args.by.split(',') if k.strip()], parse_host_aliases(args.host_alias),
+                    extra_token_params(args.token_param), args.dropped_only, write_report)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find duplicate entries in a text file')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from hls_fetcher import HLSError
+from media_probe import AD_SKIP_SECONDS, probe_streams
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_ACTIONS = ('link', 'skip')
+SEGMENT_SAMPLES = 3       # Segments hashed per stream, taken right after the ad window
+FRAME_POSITIONS = (0.2, 0.4, 0.6, 0.8)  # Fractions of the duration sampled for the visual hash
+FRAME_DISTANCE = 10       # Max differing bits (of 64) per frame for two files to match
+DURATION_TOLERANCE = 2.0  # Seconds; only files this close in length are compared
+FLAT_FRAME_RANGE = 16     # Frames whose gray levels span less than this (black, slates) can't tell files apart
+FRAME_TIMEOUT_SECONDS = 60
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    url TEXT,
+    segment_hash TEXT,
+    duration REAL,
+    frames TEXT,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS fingerprints_segment ON fingerprints (segment_hash);
+CREATE INDEX IF NOT EXISTS fingerprints_duration ON fingerprints (duration);
+"""
+
+
+def dhash(pixels, width=9, height=8):
+    """64-bit difference hash of a width x height grayscale frame"""
+    value = 0
+    for row in range(height):
+        offset = row * width
+        for col in range(width - 1):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def frame_hash(path, position, timeout=FRAME_TIMEOUT_SECONDS):
+    """dHash of the frame at position seconds, or None if ffmpeg couldn't decode one or it is near-uniform"""
+    cmd = [
+        'ffmpeg', '-v', 'error',
+        '-ss', f"{position:.3f}",
+        '-i', str(path),
+        '-frames:v', '1',
+        '-vf', 'scale=9:8,format=gray',
+        '-f', 'rawvideo', 'pipe:1'
+    ]
+    try:
+        process = subprocess.run(cmd, capture_output=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Frame sampling failed for {path}: {e}")
+        return None
+    if process.returncode != 0 or len(process.stdout) < 72:
+        return None
+    pixels = process.stdout[:72]
+    if max(pixels) - min(pixels) < FLAT_FRAME_RANGE:
+        logger.debug(f"Near-uniform frame at {position:.1f}s of {path}, not usable for matching")
+        return None
+    return dhash(pixels)
+
+
+def visual_fingerprint(path, duration):
+    """Frame hashes at FRAME_POSITIONS of an encoded file, or None"""
+    if not duration or duration <= 0:
+        return None
+    hashes = [frame_hash(path, duration * position) for position in FRAME_POSITIONS]
+    if any(h is None for h in hashes):
+        return None
+    return hashes
+
+
+def frames_match(a, b, max_distance=FRAME_DISTANCE):
+    # An all-zero hash is what a flat frame gives; fingerprints indexed before flat frames were rejected may have one
+    if not all(a) or not all(b):
+        return False
+    return len(a) == len(b) and all(bin(x ^ y).count('1') <= max_distance for x, y in zip(a, b))
+
+
+def encode_frames(frames):
+    return ','.join(f"{h:016x}" for h in frames)
+
+
+def decode_frames(text):
+    return [int(h, 16) for h in text.split(',')] if text else None
+
+
+class ContentIndex:
+    """
+    Persistent index of content fingerprints of finished downloads
+    (downloads/.fingerprints.sqlite), looked up by indexed columns so it
+    never needs to rescan the output directory.
+
+    Two fingerprints are kept per file:
+    - segment_hash: sha256 of the first SEGMENT_SAMPLES HLS segments after
+      the ad window, computed before downloading, so a stream another
+      provider already delivered is never fetched or encoded;
+    - frames: dHashes of frames sampled from the encoded file, compared
+      within DURATION_TOLERANCE seconds, which catches re-encoded copies.
+
+    A match is either hard-linked to the new output name ('link') or
+    dropped ('skip').
+    """
+
+    def __init__(self, path, fetcher=None, action='link', segment_samples=SEGMENT_SAMPLES):
+        if action not in DUPLICATE_ACTIONS:
+            raise ValueError(f"action must be one of {', '.join(DUPLICATE_ACTIONS)}")
+        self.path = Path(path)
+        self.fetcher = fetcher
+        self.action = action
+        self.segment_samples = segment_samples
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.stats = {'segment': 0, 'visual': 0}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def segment_fingerprint(self, url):
+        """Hash of the first segments after the ad window, or None if the stream can't be sampled"""
+        if self.fetcher is None:
+            return None
+        try:
+            return self.fetcher.run(self._segment_fingerprint(url))
+        except (HLSError, OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+            logger.debug(f"No segment fingerprint for {url}: {e}")
+            return None
+
+    async def _segment_fingerprint(self, url):
+        playlist = await self.fetcher.load_media_playlist(url)
+        segments = playlist.segments
+        start, elapsed = 0, 0.0
+        while start < len(segments) and elapsed < AD_SKIP_SECONDS:
+            elapsed += segments[start].duration
+            start += 1
+
+        sample = segments[start:start + self.segment_samples]
+        if len(sample) < self.segment_samples:
+            return None  # Too short to tell apart from other streams reliably
+        bodies = await asyncio.gather(*(self.fetcher.fetch_bytes(segment.uri) for segment in sample))
+
+        digest = hashlib.sha256()
+        for body in bodies:
+            digest.update(hashlib.sha256(body).digest())
+        return digest.hexdigest()
+
+    def _existing(self, rows):
+        """First row whose file still exists; stale rows are dropped"""
+        for row in rows:
+            if os.path.exists(row[0]):
+                return row
+            self.db.execute('DELETE FROM fingerprints WHERE path = ?', (row[0],))
+        return None
+
+    def find_segment(self, segment_hash):
+        """Path of a finished download with this segment fingerprint, or None"""
+        if segment_hash is None:
+            return None
+        with self.lock, self.db:
+            row = self._existing(self.db.execute(
+                'SELECT path FROM fingerprints WHERE segment_hash = ?', (segment_hash,)).fetchall())
+            if row:
+                self.stats['segment'] += 1
+        return Path(row[0]) if row else None
+
+    def find_visual(self, frames, duration):
+        """Path of a finished download that looks the same, or None"""
+        if frames is None:
+            return None
+        with self.lock, self.db:
+            rows = self.db.execute(
+                'SELECT path, frames FROM fingerprints WHERE duration BETWEEN ? AND ? AND frames IS NOT NULL',
+                (duration - DURATION_TOLERANCE, duration + DURATION_TOLERANCE)).fetchall()
+            row = self._existing(row for row in rows if frames_match(frames, decode_frames(row[1])))
+            if row:
+                self.stats['visual'] += 1
+        return Path(row[0]) if row else None
+
+    def add(self, path, url=None, segment_hash=None, duration=None, frames=None):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?)',
+                            (str(path), url, segment_hash, duration,
+                             encode_frames(frames) if frames else None, time.time()))
+
+    def check_encoded(self, output_file, url=None, segment_hash=None):
+        """
+        Fingerprint a freshly encoded file. If an earlier download looks the
+        same, apply the action to output_file and return the earlier path;
+        otherwise index the file and return None.
+        """
+        probe = probe_streams(str(output_file))
+        duration = probe and probe['duration']
+        frames = visual_fingerprint(output_file, duration)
+
+        original = self.find_visual(frames, duration)
+        if original is not None and original != Path(output_file):
+            self.resolve(original, output_file)
+            return original
+
+        self.add(output_file, url, segment_hash, duration, frames)
+        return None
+
+    def resolve(self, original, output_file):
+        """
+        Make output_file a hard link to original ('link', falling back to
+        'skip' across filesystems) or remove it ('skip').
+        Returns True if output_file exists afterwards.
+        """
+        output_file = Path(output_file)
+        if self.action == 'link':
+            tmp_path = output_file.with_name(output_file.name + '.link')
+            try:
+                os.link(original, tmp_path)
+                os.replace(tmp_path, output_file)
+                # The link carries the same fingerprints, so lookups survive deleting the original
+                with self.lock, self.db:
+                    self.db.execute('INSERT OR REPLACE INTO fingerprints '
+                                    'SELECT ?, url, segment_hash, duration, frames, ? FROM fingerprints '
+                                    'WHERE path = ?', (str(output_file), time.time(), str(original)))
+                return True
+            except OSError as e:
+                logger.warning(f"Could not hard-link {output_file} to {original}: {e}")
+                try:
+                    tmp_path.unlink()
+                except OSError:
+                    pass
+        try:
+            output_file.unlink()
+        except OSError:
+            pass
+        return False
+
+
+def backfill(index, directory, extension='.mp4'):
+    """Add visual fingerprints for files in directory the index doesn't know yet"""
+    with index.lock:
+        known = set(row[0] for row in index.db.execute('SELECT path FROM fingerprints'))
+    added = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            path = Path(directory) / entry.name
+            if not entry.name.endswith(extension) or str(path) in known or not entry.is_file():
+                continue
+            probe = probe_streams(str(path))
+            duration = probe and probe['duration']
+            index.add(path, duration=duration, frames=visual_fingerprint(path, duration))
+            added += 1
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the content fingerprint index of finished downloads')
+    parser.add_argument('command', choices=['backfill', 'stats'],
+                      help='backfill: fingerprint files not yet indexed; stats: show index size')
+    parser.add_argument('--downloads', default='downloads', help='Download directory (default: downloads)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    index = ContentIndex(Path(args.downloads) / '.fingerprints.sqlite')
+    try:
+        if args.command == 'backfill':
+            print(f"Fingerprinted {backfill(index, args.downloads)} files")
+        print(f"{len(index)} files in {index.path}")
+    finally:
+        index.close()
@@ -0,0 +1,645 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import ssl
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (m3u-downloader)'
+CHECKPOINT_NAME = 'checkpoint.json'
+READ_CHUNK = 64 * 1024  # Response bodies are read, counted and throttled in pieces of this size
+PIPE_SOURCE = 'pipe:0'  # What ffmpeg reads when segments are streamed into its stdin
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+Segment = namedtuple('Segment', ['index', 'uri', 'duration'])
+
+
+class HLSError(Exception):
+    """Raised when a playlist or segment can't be downloaded"""
+
+
+class HLSUnsupported(HLSError):
+    """Raised for sources the native fetcher doesn't handle; ffmpeg should read the URL itself"""
+
+
+class HTTPError(HLSError):
+    def __init__(self, url, status):
+        super().__init__(f"HTTP {status} for {url}")
+        self.url = url
+        self.status = status
+
+
+def parse_attributes(text):
+    """Parse an HLS attribute list such as BANDWIDTH=800000,RESOLUTION=1280x720"""
+    return {key: value.strip('"') for key, value in ATTRIBUTE_PATTERN.findall(text)}
+
+
+class Playlist:
+    """A parsed HLS playlist: either a master playlist (variants) or a media playlist (segments)"""
+
+    def __init__(self, url):
+        self.url = url
+        self.variants = []
+        self.segments = []
+        self.init_uri = None
+        self.encrypted = False
+        self.byte_ranges = False
+        self.ended = False  # #EXT-X-ENDLIST or a VOD playlist: no segments will be added
+
+    @property
+    def is_master(self):
+        return bool(self.variants)
+
+    @property
+    def duration(self):
+        return sum(segment.duration for segment in self.segments)
+
+
+def parse_playlist(text, url):
+    """Parse playlist text fetched from url; relative URIs are resolved against it"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or not lines[0].startswith('#EXTM3U'):
+        raise HLSUnsupported(f"Not an HLS playlist: {url}")
+
+    playlist = Playlist(url)
+    pending_variant = None
+    pending_duration = None
+
+    for line in lines[1:]:
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            pending_variant = parse_attributes(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            try:
+                pending_duration = float(line.split(':', 1)[1].split(',', 1)[0])
+            except ValueError:
+                pending_duration = 0.0
+        elif line.startswith('#EXT-X-KEY:'):
+            if parse_attributes(line.split(':', 1)[1]).get('METHOD', 'NONE') != 'NONE':
+                playlist.encrypted = True
+        elif line.startswith('#EXT-X-MAP:'):
+            map_uri = parse_attributes(line.split(':', 1)[1]).get('URI')
+            if map_uri:
+                playlist.init_uri = urljoin(url, map_uri)
+        elif line.startswith('#EXT-X-BYTERANGE'):
+            playlist.byte_ranges = True
+        elif line == '#EXT-X-ENDLIST' or line == '#EXT-X-PLAYLIST-TYPE:VOD':
+            playlist.ended = True
+        elif line.startswith('#'):
+            continue
+        elif pending_variant is not None:
+            pending_variant['URI'] = urljoin(url, line)
+            playlist.variants.append(pending_variant)
+            pending_variant = None
+        else:
+            index = len(playlist.segments)
+            playlist.segments.append(Segment(index, urljoin(url, line), pending_duration or 0.0))
+            pending_duration = None
+
+    return playlist
+
+
+class HTTPResponse:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.url = None
+
+
+class RateLimiter:
+    """
+    Token bucket for the coroutines of one event loop: take(n) returns once
+    n more bytes fit into `rate` bytes per second. Up to a second's worth
+    may be taken in a burst; waiters are served in order.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self, amount):
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt lets a chunk larger than the bucket through after a proportional wait
+            self.tokens -= amount
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class ConnectionPool:
+    """
+    Minimal asyncio HTTP/1.1 client with keep-alive connections pooled per
+    host and a per-host limit on concurrent requests.
+
+    bandwidth and host_bandwidth (bytes per second) cap what all requests
+    together, and the requests to any one host, may download. timeout
+    applies to connecting, to the response headers and to every body read,
+    so a throttled download isn't cut off while it waits its turn.
+    """
+
+    def __init__(self, max_per_host=4, timeout=30, bandwidth=None, host_bandwidth=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.host_bandwidth = host_bandwidth
+        self._idle = defaultdict(list)
+        self._limits = {}
+        self._rates = {}
+        self.bandwidth = RateLimiter(bandwidth) if bandwidth else None
+        self.bytes_received = 0
+        self._ssl_context = ssl.create_default_context()
+
+    def host_limit(self, host):
+        if host not in self._limits:
+            self._limits[host] = asyncio.Semaphore(self.max_per_host)
+        return self._limits[host]
+
+    async def throttle(self, host, amount):
+        """Wait until amount bytes from host fit into the bandwidth budgets"""
+        if self.host_bandwidth:
+            if host not in self._rates:
+                self._rates[host] = RateLimiter(self.host_bandwidth)
+            await self._rates[host].take(amount)
+        if self.bandwidth is not None:
+            await self.bandwidth.take(amount)
+
+    async def request(self, url, method='GET', headers=None, max_redirects=5, head_only=False):
+        """
+        With head_only only the status line and headers are read and the
+        connection is dropped, for probes of servers that may send an
+        endless body.
+        """
+        for _ in range(max_redirects + 1):
+            response = await self._request_once(url, method, headers or {}, head_only)
+            location = response.headers.get('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            response.url = url
+            return response
+        raise HLSError(f"Too many redirects for {url}")
+
+    async def get(self, url, headers=None):
+        response = await self.request(url, headers=headers)
+        if response.status != 200:
+            raise HTTPError(url, response.status)
+        return response
+
+    async def _connect(self, scheme, host, port):
+        if scheme == 'https':
+            return await asyncio.open_connection(host, port, ssl=self._ssl_context, server_hostname=host)
+        return await asyncio.open_connection(host, port)
+
+    async def _request_once(self, url, method, headers, head_only=False):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https') or not parts.hostname:
+            raise HLSUnsupported(f"Unsupported URL: {url}")
+
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, host, port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        host_header = host if parts.port is None else f"{host}:{port}"
+        request_headers = {'Host': host_header, 'User-Agent': USER_AGENT,
+                           'Accept': '*/*', 'Connection': 'keep-alive'}
+        request_headers.update(headers)
+        head = f"{method} {target} HTTP/1.1\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in request_headers.items())
+        head += '\r\n'
+
+        async with self.host_limit(host):
+            while True:
+                reused = bool(self._idle[key])
+                reader, writer = self._idle[key].pop() if reused else \
+                    await asyncio.wait_for(self._connect(*key), self.timeout)
+                try:
+                    writer.write(head.encode('latin-1'))
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+                    response, keep_alive = await self._read_response(reader, method, host, head_only)
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    writer.close()
+                    if reused:
+                        # The server closed an idle keep-alive connection; retry on a fresh one
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+
+                if keep_alive:
+                    self._idle[key].append((reader, writer))
+                else:
+                    writer.close()
+                return response
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed before response')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return version, int(status), headers
+
+    async def _read_body(self, reader, host, size=None):
+        """size bytes of body, or everything up to EOF; read in throttled chunks"""
+        chunks = []
+        while size is None or size > 0:
+            wanted = READ_CHUNK if size is None else min(size, READ_CHUNK)
+            await self.throttle(host, wanted)
+            if size is None:
+                chunk = await asyncio.wait_for(reader.read(wanted), self.timeout)
+                if not chunk:
+                    break
+            else:
+                chunk = await asyncio.wait_for(reader.readexactly(wanted), self.timeout)
+                size -= len(chunk)
+            self.bytes_received += len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def _read_response(self, reader, method, host, head_only=False):
+        version, status, headers = await asyncio.wait_for(self._read_head(reader), self.timeout)
+        if head_only:
+            # The body is left unread, so the connection can't be reused
+            return HTTPResponse(status, headers, b''), False
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' and (version != 'HTTP/1.0' or connection == 'keep-alive')
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await asyncio.wait_for(reader.readline(), self.timeout)) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await self._read_body(reader, host, size))
+                await asyncio.wait_for(reader.readexactly(2), self.timeout)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self._read_body(reader, host, int(headers['content-length']))
+        else:
+            body = await self._read_body(reader, host)
+            keep_alive = False
+
+        return HTTPResponse(status, headers, body), keep_alive
+
+    async def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class HLSFetcher:
+    """
+    Downloads HLS media playlists natively: segments are fetched concurrently
+    over pooled keep-alive connections and ffmpeg is only used afterwards to
+    concat/trim the local files. open_stream() instead hands the segments to
+    ffmpeg's stdin as they arrive, so none are written to disk (and none
+    can be resumed).
+
+    A single event loop runs in a background thread so that every worker
+    thread shares the same connection pool, per-host limits and bandwidth
+    budgets (bytes per second, all hosts together and per host).
+    """
+
+    def __init__(self, max_per_host=4, timeout=30, retries=3, bandwidth=None, host_bandwidth=None,
+                 streaming=False):
+        self.max_per_host = max_per_host
+        self.streaming = streaming  # Jobs use open_stream() instead of download()
+        self.timeout = timeout
+        self.retries = retries
+        self.bandwidth = bandwidth
+        self.host_bandwidth = host_bandwidth
+        self.loop = None
+        self.pool = None
+        self._thread = None
+
+    def start(self):
+        if self.loop is not None:
+            return self
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='HLSFetcher', daemon=True)
+        self._thread.start()
+        self.pool = self.run(self._make_pool())
+        return self
+
+    async def _make_pool(self):
+        return ConnectionPool(self.max_per_host, self.timeout, self.bandwidth, self.host_bandwidth)
+
+    def run(self, coro):
+        """Run a coroutine on the fetcher loop from any thread and wait for the result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        if self.loop is None:
+            return
+        self.run(self.pool.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def download(self, url, work_dir):
+        """
+        Download all segments of url into work_dir.
+        Returns (input_path, input_args) to hand to ffmpeg.
+        """
+        return self.run(self._download(url, Path(work_dir)))
+
+    async def load_media_playlist(self, url):
+        response = await self.pool.get(url)
+        playlist = parse_playlist(response.body.decode('utf-8', errors='replace'), response.url)
+        if playlist.is_master:
+            # Same choice ffmpeg makes on its own: the highest bandwidth variant
+            variant = max(playlist.variants, key=lambda v: int(v.get('BANDWIDTH', 0) or 0))
+            response = await self.pool.get(variant['URI'])
+            playlist = parse_playlist(response.body.decode('utf-8', errors='replace'), response.url)
+            if playlist.is_master:
+                raise HLSUnsupported(f"Nested master playlist: {url}")
+
+        if playlist.encrypted:
+            raise HLSUnsupported(f"Encrypted playlist: {url}")
+        if playlist.byte_ranges:
+            raise HLSUnsupported(f"Byte-range playlist: {url}")
+        if not playlist.ended:
+            # Only the current window of a live playlist is listed; ffmpeg keeps reloading it
+            raise HLSUnsupported(f"Live playlist (no #EXT-X-ENDLIST): {url}")
+        if not playlist.segments:
+            raise HLSError(f"Playlist has no segments: {url}")
+        return playlist
+
+    async def fetch_bytes(self, url):
+        last_error = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                return (await self.pool.get(url)).body
+            except HTTPError as e:
+                last_error = e
+                if e.status < 500 and e.status != 429:
+                    raise
+            except (asyncio.TimeoutError, ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                last_error = e
+            await asyncio.sleep(attempt)
+        raise HLSError(f"Failed to fetch {url} after {self.retries} attempts: {last_error}")
+
+    def open_stream(self, url):
+        """
+        Load the media playlist of url for streaming into ffmpeg.
+        Returns (input_args, feed): feed(fd) writes the segments in order to
+        the pipe fd as they arrive, with at most read_ahead of them in memory.
+        """
+        playlist = self.run(self.load_media_playlist(url))
+        # fMP4 fragments follow their init segment into the same stream
+        input_args = ['-f', 'mp4'] if playlist.init_uri else ['-f', 'mpegts']
+        return input_args, lambda fd: self.run(self._feed(playlist, fd))
+
+    async def _feed(self, playlist, fd, read_ahead=None):
+        uris = iter(([playlist.init_uri] if playlist.init_uri else []) + [s.uri for s in playlist.segments])
+        pending = deque()
+
+        def schedule():
+            uri = next(uris, None)
+            if uri is not None:
+                pending.append(asyncio.ensure_future(self.fetch_bytes(uri)))
+
+        for _ in range(read_ahead or 2 * self.max_per_host):
+            schedule()
+        size = 0
+        try:
+            while pending:
+                data = await pending.popleft()
+                schedule()
+                await asyncio.to_thread(write_all, fd, data)
+                size += len(data)
+        finally:
+            for task in pending:
+                task.cancel()
+        logger.info(f"Streamed {len(playlist.segments)} segments ({size / 1e6:.1f} MB) into ffmpeg "
+                    f"for {playlist.url}")
+        return size
+
+    async def _fetch_segment(self, segment, path, checkpoint):
+        data = await self.fetch_bytes(segment.uri)
+        # Disk writes and hashing off the loop, which every worker's transfers share
+        checksum = await asyncio.to_thread(store_segment, path, data)
+        checkpoint.record(segment, len(data), checksum)
+        return len(data)
+
+    async def _download(self, url, work_dir):
+        work_dir.mkdir(parents=True, exist_ok=True)
+        playlist = await self.load_media_playlist(url)
+
+        extension = '.m4s' if playlist.init_uri else '.ts'
+        paths = [work_dir / f"{segment.index:06d}{extension}" for segment in playlist.segments]
+
+        # Only fetch segments the checkpoint can't vouch for
+        checkpoint = SegmentCheckpoint(work_dir, url).load()
+        missing = await asyncio.to_thread(checkpoint.missing_segments, playlist.segments, paths)
+        if len(missing) < len(paths):
+            logger.info(f"Resuming {url}: {len(paths) - len(missing)}/{len(paths)} segments already downloaded")
+
+        # A fixed set of fetchers works through the queue, so a long VOD isn't one task per segment
+        queue = asyncio.Queue()
+        for item in missing:
+            queue.put_nowait(item)
+        results = []
+
+        async def fetch_queued():
+            while not queue.empty():
+                segment, path = queue.get_nowait()
+                try:
+                    results.append(await self._fetch_segment(segment, path, checkpoint))
+                except Exception as e:
+                    results.append(e)
+
+        try:
+            await asyncio.gather(*(fetch_queued() for _ in range(min(len(missing), 2 * self.max_per_host))))
+        finally:
+            checkpoint.save()
+
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise HLSError(f"{len(errors)} of {len(paths)} segments failed for {url}: {errors[0]}")
+        logger.info(f"Fetched {len(missing)} segments ({sum(results) / 1e6:.1f} MB) for {url}")
+
+        return await asyncio.to_thread(assemble_segments, work_dir, paths,
+                                       await self.fetch_bytes(playlist.init_uri) if playlist.init_uri else None)
+
+
+class SegmentCheckpoint:
+    """
+    On-disk record of the segments already downloaded for one stream:
+    their byte sizes and SHA-256 checksums, so a restarted run only
+    fetches what is missing.
+    """
+
+    def __init__(self, work_dir, url, save_interval=2.0):
+        self.path = Path(work_dir) / CHECKPOINT_NAME
+        self.url = url
+        self.save_interval = save_interval
+        self.segments = {}
+        self._last_save = time.monotonic()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('url') == self.url:
+                self.segments = data.get('segments', {})
+        except (OSError, ValueError):
+            self.segments = {}
+        return self
+
+    def missing_segments(self, segments, paths):
+        """Return (segment, path) pairs whose file is absent or doesn't match the checkpoint"""
+        missing = []
+        for segment, path in zip(segments, paths):
+            record = self.segments.get(str(segment.index))
+            if record and record['uri'] == segment_key(segment.uri) and file_matches(path, record):
+                continue
+            self.segments.pop(str(segment.index), None)
+            missing.append((segment, path))
+        return missing
+
+    def record(self, segment, size, checksum):
+        self.segments[str(segment.index)] = {'uri': segment_key(segment.uri), 'size': size, 'sha256': checksum}
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        self._last_save = time.monotonic()
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'url': self.url, 'segments': self.segments}, f)
+        tmp_path.replace(self.path)
+
+
+def store_segment(path, data):
+    """Write a segment through a temporary file; returns its SHA-256"""
+    tmp_path = path.with_suffix('.part')
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+    return hashlib.sha256(data).hexdigest()
+
+
+def segment_key(uri):
+    """Segment URI without the query string, which often carries expiring tokens"""
+    return uri.split('?', 1)[0]
+
+
+def file_matches(path, record):
+    try:
+        if path.stat().st_size != record['size']:
+            return False
+    except OSError:
+        return False
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest() == record['sha256']
+
+
+def assemble_segments(work_dir, paths, init_data=None):
+    """
+    Hand the downloaded segments to ffmpeg in playlist order.
+    MPEG-TS segments are listed for ffmpeg's concat demuxer; fragmented MP4
+    segments only play behind their init segment, so they are joined into one file.
+    Returns (input_path, input_args).
+    """
+    if init_data is not None:
+        source = work_dir / 'source.mp4'
+        with open(source, 'wb') as out:
+            out.write(init_data)
+            for path in paths:
+                with open(path, 'rb') as f:
+                    while True:
+                        chunk = f.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+        return source, []
+
+    concat_list = work_dir / 'segments.ffconcat'
+    with open(concat_list, 'w', encoding='utf-8') as f:
+        f.write('ffconcat version 1.0\n')
+        for path in paths:
+            f.write(f"file '{path.name}'\n")
+    return concat_list, ['-f', 'concat', '-safe', '0']
+
+
+def fetch_or_fallback(fetcher, url, work_dir):
+    """
+    Download url with the native fetcher if one is given.
+    Falls back to (url, []) so ffmpeg reads the stream itself when the
+    fetcher is disabled or doesn't handle the source. Other errors are
+    raised so the checkpoint in work_dir survives for the next run.
+    """
+    if fetcher is None:
+        return url, []
+    try:
+        return fetcher.download(url, work_dir)
+    except HLSUnsupported as e:
+        logger.warning(f"Native fetch not possible, ffmpeg will read the URL directly: {e}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return url, []
+
+
+def write_all(fd, data):
+    """Write data to a pipe fd; a partial write continues from a memoryview instead of a copy"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def stream_or_fallback(fetcher, url):
+    """
+    Like fetch_or_fallback, but nothing is written to disk: returns
+    (source, input_args, feed) where feed streams the segments into
+    ffmpeg's stdin, or (url, [], None) for ffmpeg to read the URL itself.
+    """
+    if fetcher is None:
+        return url, [], None
+    try:
+        input_args, feed = fetcher.open_stream(url)
+    except HLSUnsupported as e:
+        logger.warning(f"Native fetch not possible, ffmpeg will read the URL directly: {e}")
+        return url, [], None
+    return PIPE_SOURCE, input_args, feed
+
+
+def work_dir_for(url, root):
+    """Per-stream segment directory, stable across runs so downloads can resume"""
+    return Path(root) / hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
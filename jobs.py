@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from hls_fetcher import CHECKPOINT_NAME
+from ledger import read_ledger
+
+logger = logging.getLogger(__name__)
+
+JOBS_FILE = 'jobs.sqlite'
+LEGACY_LEDGER = 'completed_downloads.txt'
+STATUSES = ('running', 'done', 'failed', 'partial', 'interrupted')
+ERROR_LIMIT = 2000  # Characters of ffmpeg error output kept per job
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS jobs (
+    url TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    group_title TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    started REAL,
+    finished REAL,
+    elapsed REAL,
+    output TEXT,
+    mode TEXT,
+    content_hash TEXT,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_finished ON jobs (status, finished);
+CREATE INDEX IF NOT EXISTS jobs_content_hash ON jobs (content_hash);
+"""
+
+COLUMNS = ('url', 'name', 'group_title', 'status', 'attempts', 'worker', 'started', 'finished', 'elapsed',
+           'output', 'mode', 'content_hash', 'error', 'updated')
+
+
+def checkpoint_urls(partial_dir):
+    """URLs of the streams with a segment checkpoint under partial_dir"""
+    if partial_dir is None or not Path(partial_dir).is_dir():
+        return []
+    urls = []
+    for checkpoint in Path(partial_dir).glob(f"*/{CHECKPOINT_NAME}"):
+        try:
+            with open(checkpoint, 'r', encoding='utf-8') as f:
+                url = json.load(f).get('url')
+        except (OSError, ValueError):
+            continue
+        if url:
+            urls.append(url)
+    return urls
+
+
+class JobStore:
+    """
+    Run state of every stream in jobs.sqlite (WAL): status, attempts,
+    timings, output file, remux/transcode mode and the last error.
+
+    Replaces completed_downloads.txt for the skip checks: each check is an
+    indexed lookup, so startup doesn't read the whole history. On first use
+    an existing completed_downloads.txt is imported; segment checkpoints
+    under partial_dir mark their streams 'partial' so they are resumed.
+    Jobs still 'running' from a run that died are marked 'interrupted'.
+    """
+
+    def __init__(self, path=JOBS_FILE, lock=None, partial_dir=None, legacy_ledger=LEGACY_LEDGER):
+        self.path = Path(path)
+        self.lock = lock or threading.Lock()
+        self.partial_dir = Path(partial_dir) if partial_dir else None
+        self.legacy_ledger = Path(legacy_ledger) if legacy_ledger else None
+        self.db = None
+
+    def load(self):
+        """Open the database (once) and reconcile it with the previous run"""
+        with self.lock:
+            if self.db is not None:
+                return self
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript(SCHEMA)
+            empty = self.db.execute('SELECT 1 FROM jobs LIMIT 1').fetchone() is None
+            with self.db:
+                interrupted = self.db.execute("UPDATE jobs SET status = 'interrupted', updated = ? "
+                                              "WHERE status = 'running'", (time.time(),)).rowcount
+        if interrupted:
+            logger.info(f"{interrupted} jobs were still running when the last run stopped")
+        if empty and self.legacy_ledger is not None and self.legacy_ledger.exists():
+            imported, _ = self.import_ledger(self.legacy_ledger)
+            logger.info(f"Imported {imported} completed downloads from {self.legacy_ledger} into {self.path}; "
+                        f"that file is no longer updated")
+        self._load_partial()
+        return self
+
+    def _load_partial(self):
+        for url in checkpoint_urls(self.partial_dir):
+            self.mark_partial(url)
+
+    def import_ledger(self, path):
+        """
+        Add the entries of a completed_downloads.txt-style file as done jobs.
+        Returns (imported, skipped): URLs already in the store and bare names
+        written by old versions (no URL to key them by) are skipped.
+        """
+        path = Path(path)
+        finished = path.stat().st_mtime
+        rows, skipped = [], 0
+        for name, url, content_hash in read_ledger(path):
+            if not url:
+                skipped += 1
+                continue
+            rows.append((url, name, content_hash, f"downloads/{name}.mp4", finished, time.time()))
+        with self.lock, self.db:
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO jobs (url, name, status, content_hash, output, finished, "
+                                "updated) VALUES (?, ?, 'done', ?, ?, ?, ?)", rows)
+            imported = self.db.total_changes - before
+        return imported, skipped + len(rows) - imported
+
+    def status(self, url):
+        """Return 'done', 'partial' or None for a stream URL"""
+        with self.lock:
+            row = self.db.execute('SELECT status FROM jobs WHERE url = ?', (url,)).fetchone()
+        if row is None or row[0] not in ('done', 'partial'):
+            return None
+        return row[0]
+
+    def is_completed(self, url, content_hash=None):
+        if self.status(url) == 'done':
+            return True
+        if content_hash is None:
+            return False
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM jobs WHERE content_hash = ? AND status = 'done'",
+                                   (content_hash,)).fetchone() is not None
+
+    def __contains__(self, url):
+        return self.status(url) == 'done'
+
+    def __len__(self):
+        """Number of completed downloads"""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'done'").fetchone()[0]
+
+    def mark_started(self, name, url, group=None, worker=None):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO jobs (url, name, group_title, status, attempts, worker, started, updated) "
+                "VALUES (?, ?, ?, 'running', 1, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET name = excluded.name, "
+                "group_title = COALESCE(excluded.group_title, group_title), status = 'running', "
+                "attempts = attempts + 1, worker = excluded.worker, started = excluded.started, "
+                "finished = NULL, elapsed = NULL, error = NULL, updated = excluded.updated",
+                (url, name, group, worker, now, now))
+
+    def mark_completed(self, name, url, content_hash=None, output=None, mode=None):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO jobs (url, name, status, finished, output, mode, content_hash, updated) "
+                "VALUES (?, ?, 'done', ?, ?, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET name = excluded.name, status = 'done', "
+                "finished = excluded.finished, elapsed = excluded.finished - started, "
+                "output = COALESCE(excluded.output, output), mode = COALESCE(excluded.mode, mode), "
+                "content_hash = COALESCE(excluded.content_hash, content_hash), error = NULL, "
+                "updated = excluded.updated",
+                (url, name, now, str(output) if output else None, mode, content_hash, now))
+
+    def mark_failed(self, url, error):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET status = 'failed', finished = ?, elapsed = ? - started, error = ?, "
+                            "updated = ? WHERE url = ? AND status != 'done'",
+                            (now, now, (error or 'failed')[-ERROR_LIMIT:], now, url))
+
+    def mark_partial(self, url):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO jobs (url, status, updated) VALUES (?, 'partial', ?) "
+                            "ON CONFLICT (url) DO UPDATE SET status = 'partial', updated = excluded.updated "
+                            "WHERE status != 'done'", (url, now))
+
+    def query(self, status=None, since=None, search=None, limit=None):
+        """Jobs as dicts, most recently updated first"""
+        clauses, params = [], []
+        if status:
+            clauses.append('status = ?')
+            params.append(status)
+        if since:
+            clauses.append('updated >= ?')
+            params.append(since)
+        if search:
+            clauses.append('(url LIKE ? OR name LIKE ?)')
+            params += [f"%{search}%"] * 2
+        sql = f"SELECT {', '.join(COLUMNS)} FROM jobs"
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY updated DESC'
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self.lock:
+            return [dict(zip(COLUMNS, row)) for row in self.db.execute(sql, params)]
+
+    def summary(self, since=None):
+        """{status: (jobs, attempts, seconds)}"""
+        with self.lock:
+            rows = self.db.execute('SELECT status, COUNT(*), SUM(attempts), SUM(elapsed) FROM jobs '
+                                   'WHERE updated >= ? GROUP BY status', (since or 0,))
+            return {status: (count, attempts or 0, elapsed or 0.0) for status, count, attempts, elapsed in rows}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def __enter__(self):
+        return self.load()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def parse_since(value):
+    """argparse type: '12h', '30m', '2d' ago, or an ISO date/time; returns a timestamp"""
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd])$', value.strip())
+    if match:
+        amount, unit = match.groups()
+        return time.time() - float(amount) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit]
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected e.g. 12h, 2d or 2024-05-01T20:00, got '{value}'")
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M') if timestamp else '-'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the job database of the downloader')
+    parser.add_argument('command', nargs='?', default='summary', choices=['summary', 'list', 'show', 'import'],
+                      help='summary: jobs per status; list: one line per job; show: all fields of matching jobs; '
+                           'import: add completed_downloads.txt-style files')
+    parser.add_argument('args', nargs='*', help='show: URL or name fragment; import: ledger files')
+    parser.add_argument('--db', default=JOBS_FILE, help=f"Job database (default: {JOBS_FILE})")
+    parser.add_argument('--status', choices=STATUSES, default=None, help='Only jobs with this status')
+    parser.add_argument('--since', type=parse_since, default=None,
+                      help='Only jobs updated since, e.g. 12h, 2d or 2024-05-01T20:00')
+    parser.add_argument('--limit', type=int, default=50, help='list: at most this many jobs (default: 50, 0: all)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # The importer is explicit here; don't pick up a ledger file implicitly
+    with JobStore(args.db, legacy_ledger=None) as store:
+        if args.command == 'import':
+            for path in args.args:
+                imported, skipped = store.import_ledger(path)
+                print(f"{path}: imported {imported}, skipped {skipped}")
+        elif args.command == 'summary':
+            for status, (count, attempts, elapsed) in sorted(store.summary(args.since).items()):
+                print(f"{status:<12} {count:>8} jobs {attempts:>8} attempts {elapsed / 3600:8.1f} h")
+        elif args.command == 'list':
+            for job in store.query(args.status, args.since, limit=args.limit):
+                error = (job['error'] or '').strip().splitlines()
+                print(f"{format_time(job['updated'])}  {job['status']:<11} {job['attempts']:>2}x  "
+                      f"{job['name'] or job['url']}" + (f"  -- {error[-1]}" if error else ''))
+        else:
+            for job in store.query(args.status, args.since, search=' '.join(args.args) or None, limit=args.limit):
+                for column in COLUMNS:
+                    value = job[column]
+                    if column in ('started', 'finished', 'updated'):
+                        value = format_time(value)
+                    elif column == 'elapsed' and value is not None:
+                        value = f"{value:.1f}s"
+                    print(f"{column:>13}: {value if value is not None else '-'}")
+                print()
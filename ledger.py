@@ -0,0 +1,32 @@
+# Reader for completed_downloads.txt, the list of finished downloads kept before jobs.sqlite.
+# Nothing writes it any more; JobStore imports it once (see jobs.py) and `jobs.py import` on request.
+
+
+def parse_ledger_line(line):
+    """
+    Parse one completed_downloads.txt line.
+    Lines are "name:url", optionally followed by a tab and a content hash.
+    Returns (name, url, content_hash) or None for blank lines.
+    """
+    line = line.strip()
+    if not line:
+        return None
+
+    record, _, content_hash = line.partition('\t')
+    # Names are cleaned by get_unique_filename and never contain ':',
+    # so the first colon always separates the name from the URL.
+    name, sep, url = record.partition(':')
+    if not sep:
+        # Bare name written by an old version of the scripts
+        return record, '', content_hash or None
+
+    return name, url, content_hash or None
+
+
+def read_ledger(path):
+    """Yield (name, url, content_hash) for each entry of a completed_downloads.txt file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parsed = parse_ledger_line(line)
+            if parsed is not None:
+                yield parsed
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import argparse
+import re
+from collections import Counter, OrderedDict
+from pathlib import Path
+
+from m3u_parser import M3UReader
+
+PLACEHOLDERS = ('category', 'group')
+UNSAFE_FILENAME_PATTERN = re.compile(r'[\\/*?:"<>|]')
+
+
+def safe_filename(value):
+    """Sanitize a category/group for use in a filename, keeping Chinese characters"""
+    return UNSAFE_FILENAME_PATTERN.sub('_', value)
+
+
+class OutputRule:
+    """
+    One output of a single-pass run.
+
+    template is the output path and may contain {category} (the [bracketed]
+    category) and {group} (group-title); an entry without a value for a
+    placeholder is skipped by that rule. categories optionally restricts the
+    rule to entries whose category is in the set.
+    """
+
+    def __init__(self, template, categories=None):
+        self.template = str(template)
+        self.fields = [field for field in PLACEHOLDERS if '{' + field + '}' in self.template]
+        self.categories = set(categories) if categories else None
+
+    def target(self, entry):
+        """Return the output path for entry, or None if the rule doesn't take it"""
+        if self.categories is not None and entry.category not in self.categories:
+            return None
+
+        path = self.template
+        for field in self.fields:
+            value = entry.category if field == 'category' else entry.group_title
+            if not value:
+                return None
+            path = path.replace('{' + field + '}', safe_filename(value))
+        return path
+
+
+class WriterPool:
+    """
+    Buffered output files with at most max_open handles open at once.
+    The least recently used handle is closed when the cap is reached and the
+    file is reopened for append the next time it is written to.
+    """
+
+    def __init__(self, headers, max_open=64, buffer_size=1 << 16):
+        self.headers = headers
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.handles = OrderedDict()
+        self.created = set()
+
+    def write(self, path, lines):
+        f = self.handles.get(path)
+        if f is not None:
+            self.handles.move_to_end(path)
+        else:
+            if len(self.handles) >= self.max_open:
+                _, oldest = self.handles.popitem(last=False)
+                oldest.close()
+
+            if path in self.created:
+                f = open(path, 'a', encoding='utf-8', newline='', buffering=self.buffer_size)
+            else:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                f = open(path, 'w', encoding='utf-8', newline='', buffering=self.buffer_size)
+                f.writelines(self.headers)
+                self.created.add(path)
+            self.handles[path] = f
+
+        f.writelines(lines)
+
+    def close(self):
+        while self.handles:
+            _, f = self.handles.popitem()
+            f.close()
+
+
+def run_rules(input_file, rules, max_open=64, index_file=None, reader=None):
+    """
+    Stream input_file once and write every entry to each rule's output.
+    Optionally write a category index ("category<TAB>entries", sorted).
+    reader replaces parsing input_file, e.g. with entries looked up in a
+    PlaylistIndex.
+    Returns a Counter of entries written per output path.
+    """
+    reader = reader if reader is not None else M3UReader(input_file)
+    pool = WriterPool(reader.headers, max_open=max_open)
+    written = Counter()
+    categories = Counter()
+
+    try:
+        for entry in reader:
+            if entry.category:
+                categories[entry.category] += 1
+
+            lines = entry.lines
+            if not lines[-1].endswith('\n'):  # Ensure proper line ending
+                lines = lines[:-1] + (lines[-1] + '\n',)
+
+            for rule in rules:
+                path = rule.target(entry)
+                if path is not None:
+                    pool.write(path, lines)
+                    written[path] += 1
+
+        # Fixed outputs (e.g. a filtered master list) exist even when nothing matched
+        for rule in rules:
+            if not rule.fields and rule.template not in pool.created:
+                pool.write(rule.template, [])
+    finally:
+        pool.close()
+
+    if index_file is not None:
+        Path(index_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(index_file, 'w', encoding='utf-8') as f:
+            for category in sorted(categories):
+                f.write(f"{category}\t{categories[category]}\n")
+
+    return written
+
+
+def parse_filter_spec(spec):
+    """Parse "output.m3u=cat1,cat2" into an OutputRule"""
+    path, sep, categories = spec.rpartition('=')
+    if not sep or not path:
+        raise argparse.ArgumentTypeError(f"expected output=category1,category2, got '{spec}'")
+    return OutputRule(path, [c.strip() for c in categories.split(',') if c.strip()])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split and filter an M3U file into many outputs in one pass')
+    parser.add_argument('input_file', help='Input M3U file path')
+    parser.add_argument('--split', action='append', default=[], type=OutputRule,
+                      help='Output template, e.g. "by_category/{category}.m3u" or "{group}.m3u" (repeatable)')
+    parser.add_argument('--filter', action='append', default=[], type=parse_filter_spec,
+                      help='Filtered list, e.g. "news.m3u=新闻,体育" (repeatable)')
+    parser.add_argument('--index', help='Write a category index (category<TAB>entries) to this file')
+    parser.add_argument('--max-open', type=int, default=64,
+                      help='Maximum number of output files open at once (default: 64)')
+    args = parser.parse_args()
+
+    rules = args.split + args.filter
+    if not rules and not args.index:
+        parser.error('nothing to do: give at least one --split, --filter or --index')
+
+    written = run_rules(args.input_file, rules, max_open=args.max_open, index_file=args.index)
+    print(f"Wrote {sum(written.values())} entries to {len(written)} files")
@@ -0,0 +1,117 @@
+import re
+from collections import namedtuple
+
+# Precompiled once and shared by every script that reads M3U playlists.
+# EXTINF_PATTERN splits a line into duration, attribute block and name in one match.
+EXTINF_PATTERN = re.compile(r'#EXTINF:\s*(-?\d+(?:\.\d+)?)?((?:\s*[\w-]+="[^"]*")*)\s*,?(.*)')
+ATTRIBUTE_PATTERN = re.compile(r'([\w-]+)="([^"]*)"')
+CATEGORY_PATTERN = re.compile(r'\[(.*?)\]')
+
+M3UEntry = namedtuple('M3UEntry', [
+    'name',         # Display name after the comma
+    'url',          # First non-comment line after #EXTINF, or None
+    'group_title',  # group-title="..." or None
+    'category',     # First [bracketed] text on the #EXTINF line, or None
+    'duration',     # EXTINF duration in seconds, -1 for live streams
+    'tvg_id',
+    'tvg_name',
+    'tvg_logo',
+    'lines',        # Original lines of the entry, line endings included
+    'offset',       # Byte offset of the #EXTINF line in the file
+    'size',         # Size of the entry in bytes
+])
+
+
+def parse_extinf(line):
+    """
+    Parse one #EXTINF line.
+    Returns (duration, attributes, name).
+    """
+    match = EXTINF_PATTERN.match(line)
+    if not match:
+        return -1.0, {}, ''
+    duration, attribute_block, name = match.groups()
+    attributes = dict(ATTRIBUTE_PATTERN.findall(attribute_block)) if attribute_block else {}
+    return float(duration) if duration else -1.0, attributes, name.strip()
+
+
+def make_entry(lines, offset=None, size=None):
+    extinf = lines[0]
+    duration, attributes, name = parse_extinf(extinf.rstrip('\r\n'))
+    category = CATEGORY_PATTERN.search(extinf)
+
+    url = None
+    for line in lines[1:]:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            url = line
+            break
+
+    return M3UEntry(
+        name=name,
+        url=url,
+        group_title=attributes.get('group-title'),
+        category=category.group(1) if category else None,
+        duration=duration,
+        tvg_id=attributes.get('tvg-id'),
+        tvg_name=attributes.get('tvg-name'),
+        tvg_logo=attributes.get('tvg-logo'),
+        lines=tuple(lines),
+        offset=offset,
+        size=size,
+    )
+
+
+class M3UReader:
+    """
+    Streaming M3U parser: iterating yields one M3UEntry per #EXTINF block
+    without holding the playlist in memory.
+
+    Lines before the first #EXTINF are collected in .headers, which is
+    complete by the time the first entry is yielded. start lets a caller
+    resume parsing at a byte offset where an entry begins.
+    """
+
+    def __init__(self, path, encoding='utf-8', start=0):
+        self.path = path
+        self.encoding = encoding
+        self.start = start
+        self.headers = []
+        self.header_size = 0
+
+    def __iter__(self):
+        self.headers.clear()
+        encoding = self.encoding
+        current = None
+        entry_offset = offset = self.start
+
+        # Binary mode so byte offsets are known; line endings are normalized as in text mode
+        with open(self.path, 'rb') as f:
+            f.seek(self.start)
+            for raw in f:
+                line = raw.decode(encoding)
+                if line.endswith('\r\n'):
+                    line = line[:-2] + '\n'
+
+                if line.startswith('#EXTINF'):
+                    if current is not None:
+                        yield make_entry(current, entry_offset, offset - entry_offset)
+                    else:
+                        self.header_size = offset
+                    current = [line]
+                    entry_offset = offset
+                elif current is not None:
+                    current.append(line)
+                else:
+                    self.headers.append(line)
+                offset += len(raw)
+
+        if current is not None:
+            yield make_entry(current, entry_offset, offset - entry_offset)
+        else:
+            self.header_size = offset
+
+
+def iter_entries(path, encoding='utf-8'):
+    """Yield M3UEntry records from path, one at a time"""
+    return iter(M3UReader(path, encoding))
@@ -1,12 +1,31 @@
 import os
+import shutil
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
 import logging
 from pathlib import Path
 import threading
-import re
+from collections import namedtuple
 from datetime import datetime
 
+from autoscale import AdaptiveConcurrency, parse_workers
+from encoders import EncoderSelector
+from ffmpeg_progress import DEFAULT_STALL_SECONDS, FFmpegStalled, ProgressMonitor, ProgressReporter, run_ffmpeg
+from filenames import FilenameAllocator
+from fingerprint import DUPLICATE_ACTIONS, ContentIndex
+from hls_fetcher import CHECKPOINT_NAME, HLSFetcher, HTTPError, fetch_or_fallback, stream_or_fallback, work_dir_for
+from jobs import JobStore
+from m3u_parser import iter_entries
+from media_probe import AD_SKIP_SECONDS, ModeStats, build_ffmpeg_command, describe_probe, probe_streams
+from profiling import profiler
+from preflight import DEFAULT_TTL, PREFLIGHT_MODES, deprioritize, run_preflight
+from retry import (DEFAULT_BREAKER_COOLDOWN, DEFAULT_BREAKER_FAILURES, DEFAULT_RETRIES, DEFAULT_RETRY_DELAY,
+                   Failure, RetryPolicy, is_transient_error, is_transient_output)
+from scheduler import ORDERS, ProcessTracker, TaskScheduler, parse_weights, priority_key
+from variants import DEFAULT_TTL as VARIANT_TTL, VariantResolver, parse_variant_policy
+from watch import PlaylistWatcher
+from work_queue import (DEFAULT_LEASE, QUEUE_FILE, Coordinator, CoordinatorClient, QueueWorker, RemoteLedger,
+                        WorkQueue, parse_address)
+
 # Set up logging with thread safety
 logging.basicConfig(
     level=logging.INFO,
@@ -22,92 +41,103 @@ logger = logging.getLogger(__name__)
 file_lock = threading.Lock()
 filename_lock = threading.Lock()  # New lock for filename generation
 
+encoders = EncoderSelector()  # Used only when the source can't be stream-copied
+mode_stats = ModeStats()
+active_processes = ProcessTracker()
+progress_monitor = ProgressMonitor()
+
+PlaylistTask = namedtuple('PlaylistTask', ['name', 'url', 'group', 'duration'])
+
+def entry_task(entry):
+    """PlaylistTask for a playlist entry, or None if it has no http(s) URL"""
+    if not entry.url or not entry.url.startswith('http'):
+        return None
+    # Combine group-title and name
+    group_title = entry.group_title or "未分类"
+    title = f"{group_title}-{entry.name or '未命名'}"
+    return PlaylistTask(title, entry.url, group_title, entry.duration)
+
 def parse_m3u_file(file_path):
     """
     Parse M3U file and extract title and URL pairs.
-    Returns list of tuples (title, url)
+    Returns list of PlaylistTask (title, url, group, duration)
     """
-    entries = []
-    current_title = None
-    
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#EXTM3U') or line.startswith('#EXT-X-APP') or line.startswith('#EXT-X-APTV-TYPE'):
-                    continue
-                    
-                if line.startswith('#EXTINF'):
-                    # Extract group-title and name
-                    group_match = re.search(r'group-title="([^"]+)"', line)
-                    group_title = group_match.group(1) if group_match else "未分类"
-                    
-                    # Extract the name part after the group-title
-                    name_match = re.search(r'group-title="[^"]+"\s*,\s*(.+)$', line)
-                    name = name_match.group(1) if name_match else "未命名"
-                    
-                    # Combine group-title and name
-                    current_title = f"{group_title}-{name}"
-                else:
-                    # This should be a URL line
-                    if current_title and line.startswith('http'):
-                        entries.append((current_title, line))
-                        current_title = None
-                        
+        return [task for task in map(entry_task, iter_entries(file_path)) if task is not None]
     except Exception as e:
         logger.error(f"Error parsing M3U file: {str(e)}")
         return []
-        
-    return entries
 
-def load_completed_downloads():
-    completed_file = Path('completed_downloads.txt')
-    if not completed_file.exists():
-        return set()
-    
-    with file_lock:
-        try:
-            with open(completed_file, 'r', encoding='utf-8') as f:
-                return set(line.strip() for line in f if line.strip())
-        except Exception as e:
-            logger.error(f"Error reading completed downloads file: {str(e)}")
-            return set()
-
-def mark_as_completed(name):
-    with file_lock:
-        try:
-            with open('completed_downloads.txt', 'a', encoding='utf-8') as f:
-                f.write(f"{name}\n")
-        except Exception as e:
-            logger.error(f"Error writing to completed downloads file: {str(e)}")
+def parse_task_line(line):
+    """PlaylistTask for a "name,url" line, or None"""
+    name, sep, url = line.strip().partition(',')
+    if sep and url.strip():
+        return PlaylistTask(name.strip(), url.strip(), None, None)
+    return None
+
+def parse_task_file(file_path):
+    """
+    Parse a task file with one "name,url" per line.
+    Returns list of PlaylistTask (name, url, None, None)
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return [task for task in map(parse_task_line, f) if task is not None]
+    except Exception as e:
+        logger.error(f"Error reading input file: {str(e)}")
+        return []
+
+def is_playlist(input_file):
+    return input_file.lower().split('?')[0].endswith(('.m3u', '.m3u8'))
+
+def load_tasks(input_file, skip_names=()):
+    """
+    Tasks from an .m3u/.m3u8 playlist or a "name,url" task file, without
+    entries whose name contains one of skip_names. Returns (tasks, skipped).
+    """
+    if is_playlist(input_file):
+        tasks = parse_m3u_file(input_file)
+    else:
+        tasks = parse_task_file(input_file)
+    if not skip_names:
+        return tasks, 0
+    kept = [task for task in tasks if not any(word in task[0] for word in skip_names)]
+    return kept, len(tasks) - len(kept)
+
+def iter_tasks(input_file, skip_names=()):
+    """
+    Like load_tasks, one task at a time; errors are raised instead of
+    logged, so a caller reading a changing file can tell a bad read from
+    an empty one.
+    """
+    if is_playlist(input_file):
+        tasks = map(entry_task, iter_entries(input_file))
+        yield from (task for task in tasks if task is not None and not any(word in task[0] for word in skip_names))
+        return
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for task in map(parse_task_line, f):
+            if task is not None and not any(word in task[0] for word in skip_names):
+                yield task
+
+# Opened once in the process function and shared by all worker threads
+job_store = JobStore('jobs.sqlite', lock=file_lock, partial_dir=Path('downloads') / '.segments')
+# Scans downloads/ once, then allocates names from in-memory counters
+filename_allocator = FilenameAllocator(Path('downloads'), lock=filename_lock)
 
 def get_unique_filename(base_name, output_dir):
     """
     Generate a unique filename by appending a sequence number if needed.
     Returns (unique_clean_name, output_file_path)
-    Thread-safe implementation using a lock.
+    Thread-safe: the allocator reserves names under filename_lock.
     """
     # Clean filename - remove invalid characters
     clean_name = "".join(c for c in base_name if c.isalnum() or c in (' ', '-', '_')).strip()
     
-    with filename_lock:  # Ensure thread-safe filename generation
-        # Check if base filename exists
-        counter = 1
-        final_name = clean_name
-        output_file = output_dir / f"{final_name}.mp4"
-        
-        while output_file.exists():
-            counter += 1
-            final_name = f"{clean_name}-{counter}"
-            output_file = output_dir / f"{final_name}.mp4"
-        
-        # Create an empty file to "reserve" the filename
-        output_file.touch()
-        
-    return final_name, output_file
+    with profiler.stage('filename'):
+        return filename_allocator.allocate(clean_name)
 
-def download_and_encode(task):
-    name, url = task
+def download_and_encode(task, remux=True, fetcher=None, content_index=None, resolver=None):
+    name, url = task[0], task[1]
     output_dir = Path('downloads')
     TIMEOUT_SECONDS = 18000  # 3 hours in seconds
     
@@ -117,104 +147,560 @@ def download_and_encode(task):
     # Create output directory if it doesn't exist
     output_dir.mkdir(exist_ok=True)
     
+    # Skip if already processed with this exact URL; partial downloads are resumed
+    with profiler.stage('skip check'):
+        status = job_store.status(url)
+    if status == 'done':
+        logger.info(f"Thread {thread_name}: Skipping {name} as it was already processed")
+        return False
+    if status == 'partial':
+        logger.info(f"Thread {thread_name}: Resuming partially downloaded {name}")
+    job_store.mark_started(name, url, getattr(task, 'group', None))
+    
+    # Same content already downloaded from another provider? Checked before fetching the stream
+    with profiler.stage('fingerprint'):
+        segment_hash = content_index.segment_fingerprint(url) if content_index is not None else None
+        original = content_index.find_segment(segment_hash) if segment_hash else None
+    if original is not None:
+        unique_name, output, action = original.stem, original, content_index.action
+        if action == 'link':
+            link_name, output_file = get_unique_filename(name, output_dir)
+            # A failed link leaves nothing at output_file, so the job falls back to pointing at the original
+            if content_index.resolve(original, output_file):
+                unique_name, output = link_name, output_file
+            else:
+                action = 'skip'
+        logger.info(f"Thread {thread_name}: {name} has the same content as {original}, "
+                    f"not downloading ({action})")
+        job_store.mark_completed(unique_name, url, segment_hash, output=output, mode=f"duplicate ({action})")
+        return True
+    
     # Get unique filename
     unique_name, output_file = get_unique_filename(name, output_dir)
     
-    # Skip if already processed with this exact URL
-    completed_downloads = load_completed_downloads()
-    if f"{unique_name}:{url}" in completed_downloads:
-        logger.info(f"Thread {thread_name}: Skipping {name} as it was already processed")
-        return False
+    # A master playlist is narrowed down to the variant the policy picks, before ffmpeg sees it
+    with profiler.stage('variant'):
+        source_url = resolver.resolve(url, next(iter(encoders.chain()), None)) if resolver is not None else url
     
-    # FFmpeg command
-    cmd = [
-        'ffmpeg',
-        '-i', url,
-        '-ss', '12',           # Skip the first 11 seconds (frame-accurate)
-        '-c:v', 'hevc_amf',     # Use H.265 codec
-        '-c:a', 'aac',         # Audio codec
-        '-b:a', '128k',        # Audio bitrate
-        '-y',                  # Overwrite output file if exists
-        '-loglevel', 'error',  # Reduce FFmpeg output
-        str(output_file)
-    ]
+    # Probe the source once: compatible codecs are remuxed, the rest transcoded
+    with profiler.stage('probe'):
+        probe = probe_streams(source_url) if remux else None
+    reason = describe_probe(probe) if remux else 'remux disabled'
+    work_dir = work_dir_for(url, output_dir / '.segments')
     
     try:
-        logger.info(f"Thread {thread_name}: Starting {name} -> {unique_name}")
         start_time = datetime.now()
-        
-        # Create process with specific encoding settings
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            errors='replace'
-        )
+        # With the native fetcher, ffmpeg only concats/trims the local segments,
+        # or reads them from its stdin as they arrive when streaming
+        feed = None
+        with profiler.stage('fetch'):
+            if fetcher is not None and fetcher.streaming:
+                source, input_args, feed = stream_or_fallback(fetcher, source_url)
+            else:
+                source, input_args = fetch_or_fallback(fetcher, source_url, work_dir)
         
         # Wait for process to complete with timeout
         try:
-            stdout, stderr = process.communicate(timeout=TIMEOUT_SECONDS)
-            if process.returncode != 0:
+            # Expected output length, for the job's ETA on the dashboard
+            expected = probe['duration'] - AD_SKIP_SECONDS if probe and probe['duration'] else None
+            # A transcode moves down the encoder chain when an encoder can't open
+            profiles = encoders.chain()
+            for attempt, profile in enumerate(profiles, 1):
+                cmd, mode = build_ffmpeg_command(source, output_file, profile, probe, input_args)
+                detail = f"{reason}, {profile.name}" if mode == 'transcode' else reason
+                logger.info(f"Thread {thread_name}: Starting {name} -> {unique_name} [{mode}: {detail}]")
+                # A streamed source is fetched again if the next encoder has to be tried
+                with profiler.stage('ffmpeg', mode=mode, encoder=profile.name if mode == 'transcode' else None):
+                    returncode, stderr = run_ffmpeg(cmd, TIMEOUT_SECONDS, job=unique_name,
+                                                    monitor=progress_monitor, tracker=active_processes,
+                                                    duration=expected, feed=feed)
+                if (returncode == 0 or mode == 'remux' or not encoders.failed(profile, stderr)
+                        or attempt == len(profiles)):
+                    break
+                logger.warning(f"Thread {thread_name}: Encoder {profile.name} failed for {name}, "
+                               f"trying {profiles[attempt].name}")
+            if returncode != 0:
                 logger.error(f"Thread {thread_name}: Error processing {name}: {stderr}")
-                return False
+                job_store.mark_failed(url, f"ffmpeg exited with {returncode} [{mode}: {detail}]: {stderr.strip()}")
+                if is_transient_output(stderr):
+                    filename_allocator.release(output_file)
+                    return Failure(f"ffmpeg exited with {returncode}", transient=True)
+                return Failure(f"ffmpeg exited with {returncode}", permanent=True)
                 
             logger.info(f"Thread {thread_name}: Completed {unique_name}")
+            if mode == 'transcode':
+                encoders.succeeded(profile)
             # Store both name and URL to prevent duplicate downloads
-            mark_as_completed(f"{unique_name}:{url}")
+            if content_index is not None:
+                original = content_index.check_encoded(output_file, url, segment_hash)
+                if original is not None:
+                    logger.info(f"Thread {thread_name}: {unique_name} looks the same as {original}, "
+                                f"keeping one copy ({content_index.action})")
+            with profiler.stage('record'):
+                # With 'skip' the duplicate was removed and the original is the copy to point at
+                job_store.mark_completed(unique_name, url, segment_hash,
+                                         output=output_file if output_file.exists() else original,
+                                         mode=f"{mode}: {detail}")
+            elapsed = (datetime.now() - start_time).total_seconds()
+            mode_stats.record(unique_name, mode, detail, elapsed, probe and probe['duration'])
             return True
             
-        except subprocess.TimeoutExpired:
-            process.kill()
+        except subprocess.TimeoutExpired as e:
             duration = datetime.now() - start_time
-            logger.error(f"Thread {thread_name}: Timeout after {duration} processing {name}. Process terminated.")
+            cause = 'Stalled (no progress)' if isinstance(e, FFmpegStalled) else 'Timeout'
+            logger.error(f"Thread {thread_name}: {cause} after {duration} processing {name}. Process terminated.")
+            job_store.mark_failed(url, f"{cause} after {duration}")
             if output_file.exists():
                 try:
-                    output_file.unlink()
+                    filename_allocator.release(output_file)
                     logger.info(f"Thread {thread_name}: Cleaned up partial file for {name}")
                 except Exception as clean_error:
                     logger.error(f"Thread {thread_name}: Error cleaning up partial file for {name}: {clean_error}")
-            return False
+            # A stall is worth another try; a job that ran for the whole timeout would only do it again
+            stalled = isinstance(e, FFmpegStalled)
+            return Failure(cause, transient=stalled, permanent=not stalled)
             
     except Exception as e:
         logger.error(f"Thread {thread_name}: Unexpected error processing {name}: {str(e)}")
+        job_store.mark_failed(url, f"{type(e).__name__}: {e}")
+        if is_transient_error(e):
+            filename_allocator.release(output_file)
+            return Failure(str(e), transient=True)
+        if isinstance(e, HTTPError):
+            return Failure(str(e), permanent=True)
         return False
+    finally:
+        # Keep checkpointed segments of failed downloads so the next run resumes them
+        if url in job_store:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        elif (work_dir / CHECKPOINT_NAME).exists():
+            job_store.mark_partial(url)
+            logger.info(f"Thread {thread_name}: Kept downloaded segments of {name} for the next run")
+
+def start_profiling(cpu=False, memory=False):
+    """--profile: stage timers, waits on file_lock/filename_lock, optionally cProfile and tracemalloc"""
+    profiler.enable(cpu, memory)
+    job_store.lock = profiler.wrap_lock(file_lock, 'file_lock')
+    filename_allocator.lock = profiler.wrap_lock(filename_lock, 'filename_lock')
+
+def save_profile(prefix):
+    report = profiler.save(prefix)
+    logger.info(f"Profile (also in {prefix}.txt, trace in {prefix}.trace.json):\n{report}")
 
-def process_m3u_file(input_file, max_workers=3):
-    # Parse M3U file
-    tasks = parse_m3u_file(input_file)
+def start_fetcher(segment_concurrency=4, max_bandwidth=None, host_bandwidth=None, pipe=False):
+    """Native HLS fetcher; the bandwidth budgets are in Mbps, pipe streams segments into ffmpeg"""
+    return HLSFetcher(max_per_host=segment_concurrency,
+                      bandwidth=max_bandwidth * 1e6 / 8 if max_bandwidth else None,
+                      host_bandwidth=host_bandwidth * 1e6 / 8 if host_bandwidth else None,
+                      streaming=pipe).start()
+
+def process_m3u_file(input_file, max_workers=3, remux=True, native_fetch=False, segment_concurrency=4,
+                     order='playlist', weights=None, min_workers=1, max_auto_workers=8, dedup_content=None,
+                     preflight=None, preflight_ttl=DEFAULT_TTL,
+                     dashboard=False, metrics_file=None, stall_timeout=DEFAULT_STALL_SECONDS,
+                     retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY,
+                     breaker_failures=DEFAULT_BREAKER_FAILURES, breaker_cooldown=DEFAULT_BREAKER_COOLDOWN,
+                     skip_names=(), encoder='auto', encoder_profiles=None,
+                     max_bandwidth=None, host_bandwidth=None, host_jobs=None,
+                     variant_policy=None, variant_ttl=VARIANT_TTL, watch=None, pipe=False,
+                     profile=None, profile_cpu=False, profile_memory=False):
+    """
+    Download every entry of input_file. With watch (seconds), input_file
+    (a path or URL) is polled instead and the run keeps going, queueing the
+    entries that are new or changed in each refreshed version, until Ctrl+C.
+    With profile, a timing report and trace are written to profile.*.
+    """
+    if profile:
+        start_profiling(profile_cpu, profile_memory)
+    # Parse the playlist or task file; a watched one is read by the watcher
+    with profiler.stage('parse'):
+        tasks, skipped = load_tasks(input_file, skip_names) if not watch else ([], 0)
     
-    if not tasks:
-        logger.error("No valid entries found in the M3U file")
+    if not tasks and not watch:
+        logger.error("No valid entries found in the input file")
         return
         
     # Process tasks with thread pool
-    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='FFmpeg') as executor:
-        futures = [executor.submit(download_and_encode, task) for task in tasks]
-        results = [f.result() for f in futures]
+    with profiler.stage('job store load'):
+        job_store.load()
+    logger.info(f"Loaded {len(job_store)} completed downloads")
+    with profiler.stage('filename scan'):
+        filename_allocator.scan()
+    with profiler.stage('encoder probe'):
+        encoders.select(encoder, encoder_profiles)
+    
+    key = priority_key(order, weights)
+    unhealthy = set()
+    if preflight == 'deprioritize':
+        key = deprioritize(key, unhealthy)
+    dropped = 0
+
+    def screen(batch):
+        # Check URLs up front so dead entries don't hold a worker slot until ffmpeg gives up
+        nonlocal dropped
+        if not preflight:
+            return batch
+        pending = [task for task in batch if job_store.status(task[1]) != 'done']
+        with profiler.stage('preflight', entries=len(pending)):
+            unhealthy.update(run_preflight(pending, mode=preflight, ttl=preflight_ttl)[1])
+        if preflight != 'drop':
+            return batch
+        kept = [task for task in batch if task[1] not in unhealthy]
+        dropped += len(batch) - len(kept)
+        return kept
+
+    tasks = screen(tasks)
+    
+    if (max_bandwidth or host_bandwidth) and not native_fetch:
+        # ffmpeg reading a URL can't be throttled; the native fetcher's downloads can
+        logger.info("Bandwidth limits apply to natively fetched segments, enabling --native-fetch")
+        native_fetch = True
+    fetcher = start_fetcher(segment_concurrency, max_bandwidth, host_bandwidth, pipe) if native_fetch or pipe else None
+    # Segment fingerprints need an HTTP client even when ffmpeg fetches the streams
+    content_index = None
+    if dedup_content:
+        content_index = ContentIndex(Path('downloads') / '.fingerprints.sqlite',
+                                     fetcher or start_fetcher(segment_concurrency, max_bandwidth, host_bandwidth),
+                                     action=dedup_content)
+    # Master playlists resolve to one variant by policy; without one ffmpeg chooses
+    resolver = VariantResolver(variant_policy, ttl=variant_ttl) if variant_policy else None
+    
+    # 'auto' sizes the pool for the upper bound and lets the autoscaler set the active limit
+    pool_size = max_auto_workers if max_workers == 'auto' else max_workers
+    # Transient failures come back after a backoff; a host failing repeatedly is paused on its own
+    retry_policy = RetryPolicy(retries, retry_delay, breaker_failures=breaker_failures,
+                               breaker_cooldown=breaker_cooldown)
+    scheduler = TaskScheduler(download_and_encode, max_workers=pool_size,
+                              key=key, on_abort=active_processes.terminate_all, retry=retry_policy,
+                              max_per_host=host_jobs)
+    progress_monitor.stall_timeout = stall_timeout or None
+    reporter = None
+    if dashboard or metrics_file:
+        reporter = ProgressReporter(progress_monitor, interval=2.0 if dashboard else 10.0, dashboard=dashboard,
+                                    metrics_file=metrics_file, progress=scheduler.progress).start()
+    watcher = None
+    if watch:
+        queued = set()
+
+        def dispatch(batch):
+            # Runs on the watcher thread; the scheduler picks the tasks up from there
+            fresh = []
+            for task in batch:
+                if task[1] not in queued and job_store.status(task[1]) != 'done':
+                    queued.add(task[1])
+                    fresh.append(task)
+            fresh = screen(fresh)
+            if fresh:
+                logger.info(f"Queueing {len(fresh)} entries from {input_file}")
+                scheduler.add(fresh)
+
+        watcher = PlaylistWatcher(input_file, lambda path: iter_tasks(path, skip_names), dispatch,
+                                  interval=watch).start()
+    autoscaler = None
+    if max_workers == 'auto':
+        autoscaler = AdaptiveConcurrency(
+            scheduler, progress_monitor, min_workers=min_workers, max_workers=max_auto_workers,
+            bytes_received=(lambda: fetcher.pool.bytes_received) if fetcher is not None else None
+        ).start()
+    
+    try:
+        results = [result for _, result in scheduler.run(tasks, remux, fetcher, content_index, resolver,
+                                                         follow=bool(watch))]
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if autoscaler is not None:
+            autoscaler.stop()
+        if reporter is not None:
+            reporter.stop()
+        job_store.close()
+        if resolver is not None:
+            resolver.close()
+        if content_index is not None:
+            content_index.close()
+            if content_index.fetcher is not fetcher:
+                content_index.fetcher.close()
+        if fetcher is not None:
+            fetcher.close()
     
     # Summary
-    total = len(tasks)
+    total = scheduler.total
     successful = sum(1 for r in results if r)
-    failed = total - successful
+    failed = len(results) - successful
     
     logger.info(f"\nDownload Summary:")
     logger.info(f"Total tasks: {total}")
     logger.info(f"Successful: {successful}")
     logger.info(f"Failed: {failed}")
+    if skipped:
+        logger.info(f"Skipped by name: {skipped}")
+    if dropped:
+        logger.info(f"Dropped by pre-flight check: {dropped}")
+    if len(results) < total:
+        logger.info(f"Not started (interrupted): {total - len(results)}")
+    if retry_policy.stats['retried'] or retry_policy.stats['circuits opened']:
+        logger.info(f"Retries: {retry_policy.stats['retried']}, "
+                    f"host circuits opened: {retry_policy.stats['circuits opened']}")
+    if content_index is not None:
+        logger.info(f"Duplicate content: {content_index.stats['segment']} found before download, "
+                    f"{content_index.stats['visual']} after encode")
+    if resolver is not None:
+        logger.info(f"Variants: {resolver.stats['resolved']} playlists resolved, "
+                    f"{resolver.stats['cached']} cached choices")
+    mode_stats.log_summary(logger)
+    if profile:
+        save_profile(profile)
 
-if __name__ == "__main__":
+def serve_m3u_file(input_file, address, order='playlist', weights=None, lease=DEFAULT_LEASE,
+                   retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY,
+                   breaker_failures=DEFAULT_BREAKER_FAILURES, breaker_cooldown=DEFAULT_BREAKER_COOLDOWN,
+                   skip_names=(), host_jobs=None):
+    """
+    Coordinator mode: queue the playlist and lease its entries to workers
+    (run_worker) until every entry is done or failed. host_jobs caps the
+    entries of one host running on all workers together.
+    """
+    tasks, _ = load_tasks(input_file, skip_names)
+    if not tasks:
+        logger.error("No valid entries found in the input file")
+        return
+
+    job_store.load()
+    logger.info(f"Loaded {len(job_store)} completed downloads")
+    pending = [task for task in tasks if job_store.status(task[1]) != 'done']
+
+    # Retries and host circuit breakers are decided here, once for all workers
+    retry_policy = RetryPolicy(retries, retry_delay, breaker_failures=breaker_failures,
+                               breaker_cooldown=breaker_cooldown)
+    queue = WorkQueue(QUEUE_FILE, policy=retry_policy, lease=lease, max_per_host=host_jobs)
+    added = queue.add_tasks(pending, priority_key(order, weights))
+    logger.info(f"Queued {added} new entries ({len(tasks) - len(pending)} already downloaded)")
+
+    coordinator = Coordinator(queue, job_store, *address).start()
+    try:
+        counts = coordinator.wait()
+    except KeyboardInterrupt:
+        counts = queue.counts()
+        logger.warning("Coordinator stopped; the queue is kept and resumes on the next start")
+    finally:
+        coordinator.stop()
+        job_store.close()
+        queue.close()
+
+    logger.info("\nQueue Summary:")
+    logger.info(f"Done: {counts['done']}")
+    logger.info(f"Failed: {counts['failed']}")
+    if counts['pending'] or counts['leased']:
+        logger.info(f"Unfinished: {counts['pending'] + counts['leased']}")
+
+def run_worker(coordinator_url, max_workers=3, remux=True, native_fetch=False, segment_concurrency=4,
+               dedup_content=None, dashboard=False, metrics_file=None, stall_timeout=DEFAULT_STALL_SECONDS,
+               encoder='auto', encoder_profiles=None, max_bandwidth=None, host_bandwidth=None,
+               variant_policy=None, variant_ttl=VARIANT_TTL, pipe=False,
+               profile=None, profile_cpu=False, profile_memory=False):
+    """
+    Worker mode: claim entries from a coordinator (serve_m3u_file), download
+    them into the local downloads/ and report the results back.
+    """
+    global job_store
+    # Job state goes to the coordinator's job store along with each result
+    job_store = RemoteLedger(partial_dir=Path('downloads') / '.segments', lock=file_lock).load()
+    if profile:
+        start_profiling(profile_cpu, profile_memory)
+    with profiler.stage('filename scan'):
+        filename_allocator.scan()
+    with profiler.stage('encoder probe'):
+        encoders.select(encoder, encoder_profiles)
+
+    client = CoordinatorClient(coordinator_url)
+    logger.info(f"Worker {client.worker} with {max_workers} jobs, coordinator {client.url}")
+
+    if (max_bandwidth or host_bandwidth) and not native_fetch:
+        logger.info("Bandwidth limits apply to natively fetched segments, enabling --native-fetch")
+        native_fetch = True
+    fetcher = start_fetcher(segment_concurrency, max_bandwidth, host_bandwidth, pipe) if native_fetch or pipe else None
+    content_index = None
+    if dedup_content:
+        content_index = ContentIndex(Path('downloads') / '.fingerprints.sqlite',
+                                     fetcher or start_fetcher(segment_concurrency, max_bandwidth, host_bandwidth),
+                                     action=dedup_content)
+    resolver = VariantResolver(variant_policy, ttl=variant_ttl) if variant_policy else None
+
+    worker = QueueWorker(client, download_and_encode, max_workers=max_workers,
+                         make_task=lambda task: PlaylistTask(task['name'], task['url'], task['group'],
+                                                             task['duration']),
+                         ledger=job_store, on_abort=active_processes.terminate_all)
+    progress_monitor.stall_timeout = stall_timeout or None
+    reporter = None
+    if dashboard or metrics_file:
+        reporter = ProgressReporter(progress_monitor, interval=2.0 if dashboard else 10.0, dashboard=dashboard,
+                                    metrics_file=metrics_file).start()
+    try:
+        results = [result for _, result in worker.run(remux, fetcher, content_index, resolver)]
+    finally:
+        if reporter is not None:
+            reporter.stop()
+        if resolver is not None:
+            resolver.close()
+        if content_index is not None:
+            content_index.close()
+            if content_index.fetcher is not fetcher:
+                content_index.fetcher.close()
+        if fetcher is not None:
+            fetcher.close()
+
+    successful = sum(1 for r in results if r)
+    logger.info("\nWorker Summary:")
+    logger.info(f"Tasks run: {len(results)}")
+    logger.info(f"Successful: {successful}")
+    logger.info(f"Failed: {len(results) - successful}")
+    mode_stats.log_summary(logger)
+    if profile:
+        save_profile(profile)
+
+def parse_names(value):
+    """argparse type for comma-separated name fragments"""
+    return [word.strip() for word in value.split(',') if word.strip()]
+
+def main(argv=None, **defaults):
+    """Command line entry point; defaults override the argument defaults (see m3u_downloader_script.py)"""
     import argparse
     
-    parser = argparse.ArgumentParser(description='Download and encode streams from M3U file')
-    parser.add_argument('input_file', help='Input .m3u file')
-    parser.add_argument('-w', '--workers', type=int, default=3, 
-                      help='Number of concurrent downloads (default: 3). Be careful with system resources.')
+    parser = argparse.ArgumentParser(description='Download and encode streams from an M3U playlist or a name,url task file')
+    parser.add_argument('input_file', nargs='?',
+                      help='Input .m3u playlist or task file with "name,url" lines (not needed with --worker)')
+    parser.add_argument('-w', '--workers', type=parse_workers, default=3, 
+                      help="Number of concurrent downloads (default: 3), or 'auto' to adapt to CPU, memory, "
+                           "encode speed and bandwidth. Be careful with system resources.")
+    parser.add_argument('--min-workers', type=int, default=1,
+                      help='Lower bound for --workers auto (default: 1)')
+    parser.add_argument('--max-workers', type=int, default=8,
+                      help='Upper bound for --workers auto (default: 8)')
+    parser.add_argument('--transcode-all', action='store_true',
+                      help='Always re-encode instead of remuxing H.264/HEVC/AAC sources')
+    parser.add_argument('--native-fetch', action='store_true',
+                      help='Download HLS segments concurrently instead of letting ffmpeg fetch them one by one')
+    parser.add_argument('--segment-concurrency', type=int, default=4,
+                      help='Concurrent segment downloads per host with --native-fetch (default: 4)')
+    parser.add_argument('--pipe', action='store_true',
+                      help='Stream natively fetched segments straight into ffmpeg instead of writing them to '
+                           'downloads/.segments first (implies --native-fetch; interrupted streams start over)')
+    parser.add_argument('--max-bandwidth', type=float, default=None, metavar='MBPS',
+                      help='Cap the download rate of all jobs together, in Mbit/s (implies --native-fetch)')
+    parser.add_argument('--host-bandwidth', type=float, default=None, metavar='MBPS',
+                      help='Cap the download rate from any one host, in Mbit/s (implies --native-fetch)')
+    parser.add_argument('--host-jobs', type=int, default=None,
+                      help='Run at most this many entries of the same host at once (with --serve: on all '
+                           'workers together); entries of other hosts fill the remaining workers')
+    parser.add_argument('--variant', type=parse_variant_policy, default=None, metavar='POLICY',
+                      help="Pick the variant of HLS master playlists instead of leaving it to ffmpeg: highest, lowest, "
+                           "a resolution (720p), a bitrate cap (4M), 'encoder' (match the transcode profile's "
+                           "scale/bitrate) or a combination such as '720p,4M'")
+    parser.add_argument('--variant-ttl', type=float, default=VARIANT_TTL,
+                      help=f"Seconds a variant choice is reused across runs (default: {VARIANT_TTL})")
+    parser.add_argument('--order', choices=ORDERS, default='playlist',
+                      help='Processing order: playlist order, grouped by group-title, or shortest first (default: playlist)')
+    parser.add_argument('--weights', type=parse_weights, default=None,
+                      help='Comma-separated pattern=weight pairs matched against group-title and name; higher runs first')
+    parser.add_argument('--dedup-content', choices=DUPLICATE_ACTIONS, default=None,
+                      help='Fingerprint streams and hard-link (link) or drop (skip) ones whose content is '
+                           'already in downloads/')
+    parser.add_argument('--preflight', choices=PREFLIGHT_MODES, default=None,
+                      help='Probe all URLs before starting and drop (or run last) dead/unreachable ones; '
+                           'writes preflight_report.tsv')
+    parser.add_argument('--preflight-ttl', type=float, default=DEFAULT_TTL,
+                      help=f"Seconds a pre-flight result is reused across runs (default: {DEFAULT_TTL})")
+    parser.add_argument('--dashboard', action='store_true',
+                      help='Show a live table of running jobs (speed, bitrate, size, ETA) on the terminal')
+    parser.add_argument('--metrics-file', default=None,
+                      help='Write job metrics to this file: JSON lines, or Prometheus text if it ends in .prom')
+    parser.add_argument('--stall-timeout', type=float, default=DEFAULT_STALL_SECONDS,
+                      help=f"Kill ffmpeg jobs whose output hasn't advanced for this many seconds; 0 disables "
+                           f"(default: {DEFAULT_STALL_SECONDS})")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                      help=f"Re-queue jobs that failed on a stall, timeout, 5xx or connection error up to this "
+                           f"many times (default: {DEFAULT_RETRIES})")
+    parser.add_argument('--retry-delay', type=float, default=DEFAULT_RETRY_DELAY,
+                      help=f"Seconds before the first retry, doubled for each further one, with jitter "
+                           f"(default: {DEFAULT_RETRY_DELAY})")
+    parser.add_argument('--breaker-failures', type=int, default=DEFAULT_BREAKER_FAILURES,
+                      help=f"Pause a host after this many transient failures in a row; 0 disables "
+                           f"(default: {DEFAULT_BREAKER_FAILURES})")
+    parser.add_argument('--breaker-cooldown', type=float, default=DEFAULT_BREAKER_COOLDOWN,
+                      help=f"Seconds a paused host waits before one job tries it again "
+                           f"(default: {DEFAULT_BREAKER_COOLDOWN})")
+    parser.add_argument('--watch', type=float, default=None, metavar='SECONDS',
+                      help='Keep running and poll the input (a path or URL) every SECONDS; only entries that are '
+                           'new or changed since the last version are downloaded')
+    parser.add_argument('--serve', type=parse_address, default=None, metavar='HOST:PORT',
+                      help='Coordinator mode: queue the playlist and lease its entries to workers on HOST:PORT '
+                           '(PORT alone listens on 127.0.0.1 only)')
+    parser.add_argument('--worker', default=None, metavar='URL',
+                      help='Worker mode: download entries claimed from the coordinator at URL')
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE,
+                      help=f"Seconds a claimed entry stays with a worker without renewal (default: {DEFAULT_LEASE})")
+    parser.add_argument('--skip-names', type=parse_names, default=[],
+                      help='Comma-separated words; entries whose name contains one are not downloaded')
+    parser.add_argument('--encoder', default='auto',
+                      help="Encoder profiles to transcode with, in order, e.g. 'hevc_nvenc,libx265'; 'auto' picks "
+                           "the fastest working one and falls back per job (default: auto)")
+    parser.add_argument('--encoder-profiles', default=None,
+                      help='JSON file defining encoder profiles (encoder, crf, preset, bitrate, args)')
+    parser.add_argument('--profile', nargs='?', const='profile', default=None, metavar='PREFIX',
+                      help='Time every stage and the waits on the shared locks; writes PREFIX.txt and a Chrome '
+                           'trace PREFIX.trace.json (default prefix: profile)')
+    parser.add_argument('--profile-cpu', action='store_true',
+                      help='With --profile: also run cProfile (PREFIX.pstats, top functions in the report)')
+    parser.add_argument('--profile-memory', action='store_true',
+                      help='With --profile: also trace allocations with tracemalloc (slow)')
+    parser.set_defaults(**defaults)
+    
+    args = parser.parse_args(argv)
+    
+    if args.watch is not None and (args.serve or args.worker):
+        parser.error('--watch is not supported with --serve or --worker')
+    if (args.profile_cpu or args.profile_memory) and not args.profile:
+        args.profile = 'profile'
+    if args.profile and args.serve:
+        parser.error('--profile is not supported with --serve; profile the workers')
     
-    args = parser.parse_args()
+    if args.worker:
+        if args.workers == 'auto':
+            parser.error('--workers auto is not supported with --worker')
+        run_worker(args.worker, args.workers, remux=not args.transcode_all,
+                   native_fetch=args.native_fetch, segment_concurrency=args.segment_concurrency,
+                   dedup_content=args.dedup_content, dashboard=args.dashboard,
+                   metrics_file=args.metrics_file, stall_timeout=args.stall_timeout,
+                   encoder=args.encoder, encoder_profiles=args.encoder_profiles,
+                   max_bandwidth=args.max_bandwidth, host_bandwidth=args.host_bandwidth,
+                   variant_policy=args.variant, variant_ttl=args.variant_ttl, pipe=args.pipe,
+                   profile=args.profile, profile_cpu=args.profile_cpu, profile_memory=args.profile_memory)
+        return
+    
+    if not args.input_file:
+        parser.error('an input file is required unless --worker is given')
     
-    if not args.input_file.endswith('.m3u'):
-        logger.error("Input file must be a .m3u file")
-        exit(1)
+    if args.serve:
+        serve_m3u_file(args.input_file, args.serve, order=args.order, weights=args.weights, lease=args.lease,
+                       retries=args.retries, retry_delay=args.retry_delay,
+                       breaker_failures=args.breaker_failures, breaker_cooldown=args.breaker_cooldown,
+                       skip_names=args.skip_names, host_jobs=args.host_jobs)
+        return
         
-    process_m3u_file(args.input_file, args.workers) 
\ No newline at end of file
+    process_m3u_file(args.input_file, args.workers, remux=not args.transcode_all,
+                     min_workers=args.min_workers, max_auto_workers=args.max_workers,
+                     native_fetch=args.native_fetch, segment_concurrency=args.segment_concurrency,
+                     order=args.order, weights=args.weights, dedup_content=args.dedup_content,
+                     preflight=args.preflight, preflight_ttl=args.preflight_ttl,
+                     dashboard=args.dashboard, metrics_file=args.metrics_file, stall_timeout=args.stall_timeout,
+                     retries=args.retries, retry_delay=args.retry_delay,
+                     breaker_failures=args.breaker_failures, breaker_cooldown=args.breaker_cooldown,
+                     skip_names=args.skip_names, encoder=args.encoder, encoder_profiles=args.encoder_profiles,
+                     max_bandwidth=args.max_bandwidth, host_bandwidth=args.host_bandwidth, host_jobs=args.host_jobs,
+                     variant_policy=args.variant, variant_ttl=args.variant_ttl, watch=args.watch,
+                     pipe=args.pipe, profile=args.profile, profile_cpu=args.profile_cpu,
+                     profile_memory=args.profile_memory)
+
+if __name__ == "__main__":
+    main()
+ 
\ No newline at end of file
@@ -0,0 +1,168 @@
+import json
+import logging
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Sources already in these codecs are remuxed into the .mp4 without re-encoding
+COPY_VIDEO_CODECS = {'h264', 'hevc'}
+COPY_AUDIO_CODECS = {'aac'}
+
+AD_SKIP_SECONDS = 12
+PROBE_TIMEOUT_SECONDS = 60
+
+
+def probe_streams(url, timeout=PROBE_TIMEOUT_SECONDS):
+    """
+    Run ffprobe once against a URL.
+    Returns dict with 'video', 'audio' codec names and 'duration' in seconds,
+    or None if the probe failed.
+    """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name:format=duration',
+        '-of', 'json',
+        url
+    ]
+
+    try:
+        process = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8',
+                                 errors='replace', timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"ffprobe failed for {url}: {e}")
+        return None
+
+    if process.returncode != 0:
+        logger.warning(f"ffprobe failed for {url}: {process.stderr.strip()}")
+        return None
+
+    try:
+        data = json.loads(process.stdout or '{}')
+    except ValueError:
+        logger.warning(f"ffprobe returned invalid JSON for {url}")
+        return None
+
+    result = {'video': None, 'audio': None, 'duration': None}
+    for stream in data.get('streams', []):
+        codec_type = stream.get('codec_type')
+        if codec_type in ('video', 'audio') and result[codec_type] is None:
+            result[codec_type] = stream.get('codec_name')
+
+    try:
+        result['duration'] = float(data.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        pass
+
+    return result
+
+
+def can_stream_copy(probe):
+    """True if every stream in the probed source can go into the .mp4 as-is"""
+    if not probe or probe['video'] not in COPY_VIDEO_CODECS:
+        return False
+    return probe['audio'] is None or probe['audio'] in COPY_AUDIO_CODECS
+
+
+def build_ffmpeg_command(source, output_file, profile, probe=None, input_args=()):
+    """
+    Build the ffmpeg command for one entry.
+    source is the stream URL, a local file prepared by the native fetcher
+    or pipe:0 for segments streamed into ffmpeg's stdin, read with the
+    given extra input_args; profile is the EncoderProfile
+    used if the entry has to be transcoded.
+    Returns (cmd, mode) where mode is 'remux' or 'transcode'.
+    """
+    if can_stream_copy(probe):
+        # Input seek lands on the keyframe before the ad ends; a pipe can't seek,
+        # so there the ad's packets are read and dropped instead
+        seek = ['-ss', str(AD_SKIP_SECONDS)]
+        piped = str(source).startswith('pipe:')
+        cmd = [
+            'ffmpeg',
+            *([] if piped else seek),
+            *input_args,
+            '-i', str(source),
+            *(seek if piped else []),
+            '-c', 'copy',          # Source is already H.264/HEVC/AAC
+            '-y',
+            '-loglevel', 'error',
+            str(output_file)
+        ]
+        if probe['video'] == 'hevc':
+            cmd[-4:-4] = ['-tag:v', 'hvc1']  # Playable in QuickTime/Safari
+        return cmd, 'remux'
+
+    cmd = [
+        'ffmpeg',
+        *profile.input_args,   # Hardware device, if the encoder needs one
+        *input_args,
+        '-i', str(source),
+        '-ss', str(AD_SKIP_SECONDS),  # Skip the ads (frame-accurate)
+        '-c:v', profile.encoder,
+        *profile.args,         # Quality/preset of the encoder profile
+        '-c:a', 'aac',         # Audio codec
+        '-b:a', '128k',        # Audio bitrate
+        '-y',                  # Overwrite output file if exists
+        '-loglevel', 'error',  # Reduce FFmpeg output
+        str(output_file)
+    ]
+    return cmd, 'transcode'
+
+
+def describe_probe(probe):
+    if not probe:
+        return 'probe failed'
+    return f"{probe['video'] or 'no video'}/{probe['audio'] or 'no audio'}"
+
+
+class ModeStats:
+    """
+    Thread-safe record of the remux/transcode decision made for each entry,
+    used to report the decisions and the encode time saved in the run summary.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def record(self, name, mode, reason, elapsed, duration=None):
+        with self.lock:
+            self.records.append((name, mode, reason, elapsed, duration))
+
+    def transcode_ratio(self):
+        """Wall seconds spent per second of media when transcoding, or None if unknown"""
+        wall = media = 0.0
+        for _, mode, _, elapsed, duration in self.records:
+            if mode == 'transcode' and duration:
+                wall += elapsed
+                media += max(duration - AD_SKIP_SECONDS, 1)
+        return wall / media if media else None
+
+    def estimated_time_saved(self):
+        ratio = self.transcode_ratio()
+        if ratio is None:
+            return None
+        saved = 0.0
+        for _, mode, _, elapsed, duration in self.records:
+            if mode == 'remux' and duration:
+                saved += max(duration - AD_SKIP_SECONDS, 1) * ratio - elapsed
+        return saved
+
+    def log_summary(self, log):
+        with self.lock:
+            remuxed = sum(1 for r in self.records if r[1] == 'remux')
+            transcoded = sum(1 for r in self.records if r[1] == 'transcode')
+
+            log.info(f"Remuxed (stream copy): {remuxed}")
+            log.info(f"Transcoded: {transcoded}")
+            for name, mode, reason, elapsed, _ in self.records:
+                log.info(f"  {name}: {mode} ({reason}) in {elapsed:.0f}s")
+
+            saved = self.estimated_time_saved()
+            if saved is None:
+                if remuxed:
+                    log.info("Estimated encode time saved: unknown (no transcode with known duration to compare against)")
+            else:
+                log.info(f"Estimated encode time saved: {saved / 60:.1f} minutes")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+from collections import Counter
+from pathlib import Path
+
+from m3u_parser import M3UReader, make_entry
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20  # Content is hashed per MiB so a change can be located
+DIGEST_SIZE = 20      # sha1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS entries (
+    offset INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL,
+    category TEXT,
+    group_title TEXT,
+    name TEXT,
+    url TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_category ON entries (category, offset);
+CREATE INDEX IF NOT EXISTS entries_group ON entries (group_title, offset);
+"""
+
+
+def sidecar_path(playlist):
+    return Path(str(playlist) + '.index.sqlite')
+
+
+def chunk_digests(path, chunk_size=CHUNK_SIZE):
+    """Concatenated sha1 digests of each chunk of the file"""
+    digests = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digests.append(hashlib.sha1(chunk).digest())
+    return b''.join(digests)
+
+
+def split_lines(text):
+    """Split on newlines only (str.splitlines also splits on form feeds etc.), keeping the endings"""
+    lines = text.split('\n')
+    result = [line + '\n' for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+
+def first_difference(old, new):
+    """Index of the first chunk whose digest differs, or None if identical"""
+    for i in range(0, min(len(old), len(new)), DIGEST_SIZE):
+        if old[i:i + DIGEST_SIZE] != new[i:i + DIGEST_SIZE]:
+            return i // DIGEST_SIZE
+    if len(old) != len(new):
+        return min(len(old), len(new)) // DIGEST_SIZE
+    return None
+
+
+class IndexedReader:
+    """M3UReader-compatible view of selected entries, read by seeking into the playlist"""
+
+    def __init__(self, index, categories=None):
+        self.index = index
+        self.categories = categories
+        self.headers = []
+
+    def __iter__(self):
+        self.headers[:] = self.index.headers()
+        yield from self.index.iter_entries(self.categories)
+
+
+class PlaylistIndex:
+    """
+    SQLite sidecar (<playlist>.index.sqlite) holding the byte offset, size,
+    category and group of every entry of a playlist.
+
+    The index is trusted while the playlist's mtime and size are unchanged.
+    Otherwise per-chunk content hashes locate the first changed region and
+    only entries from there on are re-parsed; appends re-index just the tail.
+    """
+
+    def __init__(self, playlist, encoding='utf-8'):
+        self.playlist = Path(playlist)
+        self.encoding = encoding
+        self.db = sqlite3.connect(sidecar_path(self.playlist))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self.update()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _meta(self):
+        return dict(self.db.execute('SELECT key, value FROM meta'))
+
+    def update(self):
+        """Bring the index up to date with the playlist; returns self"""
+        stat = self.playlist.stat()
+        meta = self._meta()
+        if meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns:
+            return self
+
+        digests = chunk_digests(self.playlist)
+        old_digests = meta.get('chunks') if meta.get('encoding') == self.encoding else None
+        changed = 0 if old_digests is None else first_difference(old_digests, digests)
+
+        if changed is None:
+            logger.info(f"{self.playlist}: touched but content unchanged")
+        else:
+            self._reindex_from(changed * CHUNK_SIZE, meta)
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [
+                ('size', stat.st_size),
+                ('mtime_ns', stat.st_mtime_ns),
+                ('chunks', digests),
+                ('content_hash', hashlib.sha1(digests).hexdigest()),
+                ('encoding', self.encoding),
+            ])
+        return self
+
+    def _reindex_from(self, changed_offset, meta):
+        # Entries ending before the changed region are intact; re-parse from the end of the last one
+        resume = 0
+        if changed_offset > 0:
+            row = self.db.execute('SELECT offset + size FROM entries WHERE offset + size < ? '
+                                  'ORDER BY offset DESC LIMIT 1', (changed_offset,)).fetchone()
+            if row:
+                resume = row[0]
+            elif meta.get('header_size', 0) < changed_offset:
+                resume = meta['header_size']
+
+        reader = M3UReader(self.playlist, self.encoding, start=resume)
+        count = 0
+        with self.db:
+            self.db.execute('DELETE FROM entries WHERE offset >= ?', (resume,))
+            batch = []
+            for entry in reader:
+                batch.append((entry.offset, entry.size, entry.category, entry.group_title, entry.name, entry.url))
+                if len(batch) >= 10000:
+                    self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)', batch)
+                    count += len(batch)
+                    batch.clear()
+            self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)', batch)
+            count += len(batch)
+
+            if resume == 0:
+                self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                ('header_size', reader.header_size))
+
+        logger.info(f"{self.playlist}: indexed {count} entries from byte {resume}")
+
+    def categories(self):
+        """Counter of entries per [bracketed] category"""
+        return Counter(dict(self.db.execute(
+            'SELECT category, COUNT(*) FROM entries WHERE category IS NOT NULL GROUP BY category')))
+
+    def headers(self):
+        size = self._meta().get('header_size', 0)
+        with open(self.playlist, 'rb') as f:
+            data = f.read(size)
+        return split_lines(data.decode(self.encoding).replace('\r\n', '\n'))
+
+    def iter_entries(self, categories=None):
+        """Yield M3UEntry records in file order, optionally only for the given categories"""
+        if categories is None:
+            rows = self.db.execute('SELECT offset, size FROM entries ORDER BY offset')
+        else:
+            categories = list(categories)
+            placeholders = ','.join('?' * len(categories))
+            rows = self.db.execute(f'SELECT offset, size FROM entries WHERE category IN ({placeholders}) '
+                                   'ORDER BY offset', categories)
+
+        with open(self.playlist, 'rb') as f:
+            for offset, size in rows:
+                f.seek(offset)
+                text = f.read(size).decode(self.encoding).replace('\r\n', '\n')
+                yield make_entry(split_lines(text), offset, size)
+
+    def reader(self, categories=None):
+        return IndexedReader(self, categories)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or refresh the SQLite index of an M3U file')
+    parser.add_argument('input_file', help='Input M3U file path')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    with PlaylistIndex(args.input_file) as index:
+        total = sum(index.categories().values())
+        print(f"Index: {sidecar_path(args.input_file)} ({total} categorized entries, "
+              f"{os.path.getsize(sidecar_path(args.input_file)) / 1e6:.1f} MB)")
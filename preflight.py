@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import Counter, namedtuple
+from urllib.parse import urlsplit
+
+from hls_fetcher import ConnectionPool, HLSError, HLSUnsupported, parse_playlist
+
+logger = logging.getLogger(__name__)
+
+PREFLIGHT_MODES = ('drop', 'deprioritize')
+PLAYLIST_SUFFIXES = ('.m3u8', '.m3u')
+DEFAULT_TTL = 3600
+DEFAULT_TIMEOUT = 10
+DEFAULT_CONCURRENCY = 64
+CACHE_FILE = '.preflight_cache.sqlite'
+REPORT_FILE = 'preflight_report.tsv'
+
+# ok: the stream answered with a usable playlist/file
+# dead: it answered, but with a 4xx or something that isn't a playlist; retrying won't help soon
+# unreachable: timeout, connection failure or 5xx/429; may work later
+# unchecked: not an HTTP(S) URL, left to ffmpeg
+HealthResult = namedtuple('HealthResult', ['url', 'state', 'status', 'reason', 'elapsed', 'checked'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS health (
+    url TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    status INTEGER,
+    reason TEXT,
+    elapsed REAL,
+    checked REAL NOT NULL
+);
+"""
+
+
+class HealthCache:
+    """URL health results (.preflight_cache.sqlite) reused for ttl seconds across runs"""
+
+    def __init__(self, path=CACHE_FILE, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def get_many(self, urls):
+        """Fresh cached results for urls, as a dict"""
+        cutoff = time.time() - self.ttl
+        results = {}
+        urls = list(urls)
+        for i in range(0, len(urls), 500):
+            batch = urls[i:i + 500]
+            rows = self.db.execute(
+                f"SELECT url, state, status, reason, elapsed, checked FROM health "
+                f"WHERE checked >= ? AND url IN ({','.join('?' * len(batch))})", [cutoff, *batch])
+            results.update((row[0], HealthResult(*row)) for row in rows)
+        return results
+
+    def put_many(self, results):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?, ?, ?)',
+                                [tuple(r) for r in results if r.state != 'unchecked'])
+
+    def close(self):
+        self.db.close()
+
+
+async def probe_url(pool, url):
+    """Check one URL: playlists are fetched and parsed (variant included), anything else gets a HEAD"""
+    start = time.monotonic()
+
+    def result(state, status=None, reason=''):
+        return HealthResult(url, state, status, reason, round(time.monotonic() - start, 3), time.time())
+
+    parts = urlsplit(url)
+    if parts.scheme.lower() not in ('http', 'https') or not parts.hostname:
+        return result('unchecked', reason='not an HTTP(S) URL')
+
+    try:
+        is_playlist = parts.path.lower().endswith(PLAYLIST_SUFFIXES)
+        if not is_playlist:
+            response = await pool.request(url, method='HEAD')
+            if response.status in (405, 501):
+                # Servers that refuse HEAD: ask for the first byte instead, and don't read the body
+                # in case Range is ignored (a whole file, or a live stream that never ends)
+                response = await pool.request(url, headers={'Range': 'bytes=0-0'}, head_only=True)
+            if response.status >= 400:
+                return _status_result(result, response.status)
+            is_playlist = 'mpegurl' in response.headers.get('content-type', '').lower()
+            if not is_playlist:
+                return result('ok', response.status)
+
+        response = await pool.request(url)
+        if response.status != 200:
+            return _status_result(result, response.status)
+        playlist = _parse(response)
+        if playlist is None:
+            return result('dead', 200, 'not an M3U8 playlist')
+
+        if playlist.is_master:
+            # A master playlist is only as good as its variants; check the one ffmpeg would pick
+            variant = max(playlist.variants, key=lambda v: int(v.get('BANDWIDTH', 0) or 0))
+            response = await pool.request(variant['URI'])
+            if response.status != 200:
+                return _status_result(result, response.status, 'variant ')
+            playlist = _parse(response)
+            if playlist is None or playlist.is_master:
+                return result('dead', 200, 'variant is not a media playlist')
+
+        if not playlist.segments:
+            return result('dead', 200, 'playlist has no segments')
+        return result('ok', 200)
+    except asyncio.TimeoutError:
+        return result('unreachable', reason='timeout')
+    except HLSUnsupported as e:
+        return result('unchecked', reason=str(e))
+    except (HLSError, OSError, EOFError, ValueError) as e:
+        return result('unreachable', reason=f"{type(e).__name__}: {e}")
+
+
+def _parse(response):
+    text = response.body.decode('utf-8', errors='replace')
+    if not text.lstrip('\ufeff').startswith('#EXTM3U'):
+        return None
+    return parse_playlist(text, response.url)
+
+
+def _status_result(result, status, prefix=''):
+    reason = f"{prefix}HTTP {status}"
+    if status == 429 or status >= 500:
+        return result('unreachable', status, reason)
+    if status in (403, 451):
+        reason += ' (forbidden or geo-blocked)'
+    return result('dead', status, reason)
+
+
+async def _check_all(urls, concurrency, max_per_host, timeout):
+    pool = ConnectionPool(max_per_host=max_per_host, timeout=timeout)
+    limit = asyncio.Semaphore(concurrency)
+
+    async def check(url):
+        async with limit:
+            return await probe_url(pool, url)
+
+    try:
+        return await asyncio.gather(*(check(url) for url in urls))
+    finally:
+        await pool.close()
+
+
+def check_urls(urls, cache=None, concurrency=DEFAULT_CONCURRENCY, max_per_host=4, timeout=DEFAULT_TIMEOUT):
+    """
+    Probe every distinct URL concurrently (at most max_per_host at a time
+    per host, each request limited to timeout seconds).
+    Returns {url: HealthResult}; fresh cached results are not probed again.
+    """
+    urls = list(dict.fromkeys(urls))
+    results = cache.get_many(urls) if cache is not None else {}
+    pending = [url for url in urls if url not in results]
+    if pending:
+        logger.info(f"Pre-flight: probing {len(pending)} URLs ({len(results)} cached)")
+        probed = asyncio.run(_check_all(pending, concurrency, max_per_host, timeout))
+        if cache is not None:
+            cache.put_many(probed)
+        results.update((r.url, r) for r in probed)
+    return results
+
+
+def write_report(path, tasks, results):
+    """Tab-separated report, unhealthy entries first, then per-state counts"""
+    order = {'dead': 0, 'unreachable': 1, 'unchecked': 2, 'ok': 3}
+    rows = sorted(((results[task[1]], task[0]) for task in tasks if task[1] in results),
+                  key=lambda row: order.get(row[0].state, 4))
+    states = Counter(result.state for result, _ in rows)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("state\tstatus\telapsed\tname\turl\treason\n")
+        for result, name in rows:
+            f.write(f"{result.state}\t{result.status or ''}\t{result.elapsed}\t{name}\t{result.url}\t{result.reason}\n")
+        f.write(f"# {', '.join(f'{state}: {count}' for state, count in sorted(states.items()))}\n")
+    return states
+
+
+def deprioritize(key, unhealthy):
+    """Wrap a scheduler priority key so unhealthy URLs run after everything else"""
+    def wrapped(index, task):
+        return (task[1] in unhealthy,) + tuple(key(index, task))
+    return wrapped
+
+
+def run_preflight(tasks, mode='drop', ttl=DEFAULT_TTL, report=REPORT_FILE, cache_path=CACHE_FILE,
+                  concurrency=DEFAULT_CONCURRENCY, max_per_host=4, timeout=DEFAULT_TIMEOUT):
+    """
+    Health-check the URLs of tasks before any worker starts.
+    Returns (tasks, unhealthy_urls): with mode 'drop' unhealthy tasks are
+    removed, with 'deprioritize' they are kept for the caller to run last.
+    """
+    if mode not in PREFLIGHT_MODES:
+        raise ValueError(f"mode must be one of {', '.join(PREFLIGHT_MODES)}")
+
+    cache = HealthCache(cache_path, ttl) if cache_path else None
+    try:
+        results = check_urls((task[1] for task in tasks), cache, concurrency, max_per_host, timeout)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    unhealthy = {url for url, result in results.items() if result.state in ('dead', 'unreachable')}
+    if report:
+        states = write_report(report, tasks, results)
+        logger.info(f"Pre-flight: {', '.join(f'{s} {n}' for s, n in sorted(states.items()))}; report: {report}")
+
+    if mode == 'drop' and unhealthy:
+        kept = [task for task in tasks if task[1] not in unhealthy]
+        logger.info(f"Pre-flight: dropped {len(tasks) - len(kept)} entries with dead or unreachable URLs")
+        tasks = kept
+    return tasks, unhealthy
+
+
+def read_tasks(path):
+    """(name, url) pairs of a playlist or a task file ("name, url" per line)"""
+    if path.endswith(PLAYLIST_SUFFIXES):
+        from m3u_parser import iter_entries
+        return [(entry.name, entry.url) for entry in iter_entries(path) if entry.url]
+    with open(path, 'r', encoding='utf-8') as f:
+        return [tuple(field.strip() for field in line.split(',', 1)) for line in f if ',' in line]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check which stream URLs of a playlist or task file respond')
+    parser.add_argument('input_file', help='.m3u playlist or task file (name,url per line)')
+    parser.add_argument('-o', '--report', default=REPORT_FILE, help=f"Report path (default: {REPORT_FILE})")
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL,
+                      help=f"Reuse cached results younger than this many seconds (default: {DEFAULT_TTL})")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                      help=f"Per-request timeout in seconds (default: {DEFAULT_TIMEOUT})")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                      help=f"URLs probed at once (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument('--per-host', type=int, default=4, help='Concurrent requests per host (default: 4)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    run_preflight(read_tasks(args.input_file), report=args.report, ttl=args.ttl, timeout=args.timeout,
+                  concurrency=args.concurrency, max_per_host=args.per_host)
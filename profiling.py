@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+MAX_EVENTS = 500000  # Trace events kept; aggregates keep counting beyond this
+TRACE_LOCK_WAIT = 0.001  # Lock waits at least this long (seconds) also go into the trace
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 15
+NULL_STAGE = contextlib.nullcontext()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+class TimedLock:
+    """
+    Stands in for a threading.Lock and records how long each acquire
+    waited and how long the lock was then held.
+    """
+
+    def __init__(self, lock, name, profiler):
+        self._lock = lock
+        self.name = name
+        self.profiler = profiler
+        self._acquired = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = self.profiler.clock()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired = self.profiler.clock()
+            self.profiler.lock_wait(self.name, start, self._acquired)
+        return acquired
+
+    def release(self):
+        held, self._acquired = self._acquired, None
+        self._lock.release()
+        if held is not None:
+            self.profiler.lock_held(self.name, self.profiler.clock() - held)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class Profiler:
+    """
+    Opt-in timing of the download pipeline. While disabled, stage() is a
+    shared no-op context and job()/wrap_lock() hand back what they are given,
+    so instrumented code costs next to nothing.
+
+    Enabled, every stage is kept as a trace event (Chrome trace format,
+    one track per thread) and aggregated per name; wrapped locks record
+    wait and hold times. cpu=True runs cProfile on the job threads,
+    memory=True compares tracemalloc snapshots from enable() to finish().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.dropped = 0
+        self.durations = defaultdict(list)  # stage -> seconds
+        self.locks = defaultdict(lambda: {'acquisitions': 0, 'contended': 0, 'wait': 0.0, 'max_wait': 0.0,
+                                          'held': 0.0})
+        self.threads = {}
+        self.cpu = False
+        self.memory = False
+        self._profiles = []
+        self._local = threading.local()
+        self._snapshot = None
+
+    clock = staticmethod(time.perf_counter)
+
+    def enable(self, cpu=False, memory=False):
+        self.enabled = True
+        self.origin = self.clock()
+        self.cpu = cpu
+        self.memory = memory
+        if cpu:
+            # Before 3.12 cProfile sees only the thread that enabled it; job threads get their own
+            self._thread_profile().enable()
+        if memory:
+            tracemalloc.start(10)
+            self._snapshot = tracemalloc.take_snapshot()
+        return self
+
+    def _thread_profile(self):
+        """This thread's cProfile.Profile, or None where the one from enable() covers all threads"""
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            if self._profiles and hasattr(sys, 'monitoring'):
+                return None  # 3.12+: cProfile hooks sys.monitoring, which sees every thread
+            profile = self._local.profile = cProfile.Profile()
+            with self.lock:
+                self._profiles.append(profile)
+        return profile
+
+    def record(self, name, start, end=None, category='stage', **args):
+        """Add a finished stage that ran from start to end (clock() values)"""
+        end = self.clock() if end is None else end
+        thread = threading.current_thread()
+        with self.lock:
+            self.durations[name].append(end - start)
+            self.threads.setdefault(thread.ident, thread.name)
+            if len(self.events) >= MAX_EVENTS:
+                self.dropped += 1
+                return
+            self.events.append((name, category, start, end, thread.ident, args))
+
+    @contextlib.contextmanager
+    def _stage(self, name, args):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, start, **args)
+
+    def stage(self, name, **args):
+        """Context manager timing a stage; args (e.g. task=name) end up in the trace"""
+        if not self.enabled:
+            return NULL_STAGE
+        return self._stage(name, args)
+
+    def job(self, fn, handoff=False):
+        """
+        fn(task, *args) timed as a 'job' stage (and under cProfile with
+        cpu). With handoff, the wrapper is made at submit time and the delay
+        until a pool thread starts it is recorded as 'pool handoff'.
+        """
+        if not self.enabled:
+            return fn
+        submitted = self.clock()
+
+        def run(task, *args):
+            if handoff:
+                self.record('pool handoff', submitted)
+            profile = self._thread_profile() if self.cpu else None
+            with self._stage('job', {'task': task[0]}):
+                if profile is None:
+                    return fn(task, *args)
+                profile.enable()
+                try:
+                    return fn(task, *args)
+                finally:
+                    profile.disable()
+        return run
+
+    def wrap_lock(self, lock, name):
+        """lock itself while disabled, otherwise a TimedLock around it"""
+        return TimedLock(lock, name, self) if self.enabled else lock
+
+    def lock_wait(self, name, start, end):
+        waited = end - start
+        with self.lock:
+            stats = self.locks[name]
+            stats['acquisitions'] += 1
+            stats['wait'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+            if waited >= TRACE_LOCK_WAIT:
+                stats['contended'] += 1
+        if waited >= TRACE_LOCK_WAIT:
+            self.record(f"wait {name}", start, end, category='lock')
+
+    def lock_held(self, name, seconds):
+        with self.lock:
+            self.locks[name]['held'] += seconds
+
+    def finish(self):
+        """Stop cProfile/tracemalloc; returns (pstats.Stats or None, snapshot differences or None)"""
+        stats = differences = None
+        if self.memory and tracemalloc.is_tracing():
+            # The profiler's own bookkeeping would otherwise top the list
+            own = [tracemalloc.Filter(False, module.__file__) for module in (sys.modules[__name__], cProfile,
+                                                                              pstats, tracemalloc)]
+            snapshot = tracemalloc.take_snapshot().filter_traces(own)
+            differences = (snapshot.compare_to(self._snapshot.filter_traces(own), 'lineno'),
+                           tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        if self.cpu and self._profiles:
+            self._profiles[0].disable()
+            stats = pstats.Stats(*self._profiles, stream=io.StringIO())
+        self.enabled = False
+        return stats, differences
+
+    def report(self, stats=None, differences=None):
+        """The aggregated report as text"""
+        lines = [f"{'stage':<16} {'count':>7} {'total s':>9} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9}"]
+        with self.lock:
+            durations = {name: list(values) for name, values in self.durations.items()}
+            locks = {name: dict(values) for name, values in self.locks.items()}
+        for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            lines.append(f"{name:<16} {len(values):>7} {sum(values):9.2f} {sum(values) / len(values) * 1000:9.2f} "
+                         f"{percentile(values, 0.95) * 1000:9.2f} {max(values) * 1000:9.2f}")
+        if locks:
+            lines += ['', f"{'lock':<16} {'acquired':>9} {'waited':>7} {'wait s':>9} {'max wait ms':>12} "
+                          f"{'held s':>9}"]
+            for name, values in sorted(locks.items()):
+                lines.append(f"{name:<16} {values['acquisitions']:>9} {values['contended']:>7} {values['wait']:9.3f} "
+                             f"{values['max_wait'] * 1000:12.2f} {values['held']:9.3f}")
+        if self.dropped:
+            lines.append(f"({self.dropped} events beyond {MAX_EVENTS} are in the totals but not in the trace)")
+        if stats is not None:
+            stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+            lines += ['', stats.stream.getvalue().strip()]
+        if differences is not None:
+            changes, peak = differences
+            lines += ['', f"Memory: peak {peak / 1024 / 1024:.1f} MiB traced; largest growth since the start:"]
+            lines += [f"  {change}" for change in changes[:TOP_ALLOCATIONS]]
+        return '\n'.join(lines)
+
+    def write_trace(self, path):
+        """Chrome trace JSON (chrome://tracing, Perfetto): one complete event per stage"""
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                 for tid, name in threads.items()]
+        for name, category, start, end, tid, args in events:
+            trace.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                          'ts': round((start - self.origin) * 1e6, 1), 'dur': round((end - start) * 1e6, 1),
+                          'args': args})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def save(self, prefix):
+        """Write PREFIX.txt (report), PREFIX.trace.json and with cpu PREFIX.pstats; returns the report"""
+        stats, differences = self.finish()
+        text = self.report(stats, differences)
+        with open(f"{prefix}.txt", 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        self.write_trace(f"{prefix}.trace.json")
+        if stats is not None:
+            stats.dump_stats(f"{prefix}.pstats")
+        return text
+
+
+# Shared by the downloader, the scheduler and the work queue; enabled by --profile
+profiler = Profiler()
+
+
+def summarize_trace(path):
+    """Stage totals of a saved trace: {name: (count, seconds)}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        events = json.load(f)['traceEvents']
+    totals = defaultdict(lambda: [0, 0.0])
+    for event in events:
+        if event.get('ph') == 'X':
+            totals[event['name']][0] += 1
+            totals[event['name']][1] += event['dur'] / 1e6
+    return {name: tuple(values) for name, values in totals.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize Chrome trace files written by --profile')
+    parser.add_argument('traces', nargs='+', help='PREFIX.trace.json files')
+    args = parser.parse_args()
+
+    for path in args.traces:
+        print(path)
+        for name, (count, seconds) in sorted(summarize_trace(path).items(), key=lambda item: -item[1][1]):
+            print(f"  {name:<20} {count:>7} {seconds:10.2f} s")
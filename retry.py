@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import random
+import re
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from hls_fetcher import HLSError, HLSUnsupported, HTTPError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_DELAY = 30        # Seconds before the first retry; doubled for every further attempt
+MAX_RETRY_DELAY = 900
+DEFAULT_BREAKER_FAILURES = 5    # Transient failures in a row that open a host's circuit
+DEFAULT_BREAKER_COOLDOWN = 120  # Seconds an open circuit waits before letting one job probe the host
+MAX_BREAKER_COOLDOWN = 1800
+BREAKER_MAX_OPENS = 4           # Re-openings without a single success before the host's jobs are given up
+PROBE_WAIT = 5                  # Re-check interval for jobs queued behind a half-open circuit
+
+# ffmpeg error output that points at the network or an overloaded server rather than the stream itself
+TRANSIENT_PATTERN = re.compile(
+    r'Server returned 5\d\d|HTTP error 5\d\d|Server returned 429|HTTP error 429|'
+    r'Connection (?:refused|reset|timed out)|Operation timed out|Network is unreachable|'
+    r'Temporary failure in name resolution|Broken pipe|I/O error',
+    re.IGNORECASE)
+
+
+class Failure:
+    """
+    Result of a failed job. It is falsy like the plain False results, so
+    existing success counts keep working; transient failures are retried.
+    Permanent ones (404, a broken stream) mean the host did answer, which
+    counts as a success for its circuit breaker.
+    """
+    __slots__ = ('reason', 'transient', 'permanent')
+
+    def __init__(self, reason, transient=False, permanent=False):
+        self.reason = reason
+        self.transient = transient
+        self.permanent = permanent
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return f"Failure({self.reason!r}, transient={self.transient}, permanent={self.permanent})"
+
+
+def is_transient_output(stderr):
+    """True if ffmpeg's error output looks like a network or server problem"""
+    return bool(TRANSIENT_PATTERN.search(stderr or ''))
+
+
+def is_transient_error(error):
+    """
+    True for network errors worth retrying later: timeouts, connection
+    errors, 5xx and 429. Local faults (ffmpeg missing, an unwritable output
+    directory) are OSErrors too, but retrying them only repeats the failure.
+    """
+    if isinstance(error, HTTPError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, HLSUnsupported):
+        return False
+    return isinstance(error, (HLSError, ConnectionError, socket.timeout, socket.gaierror, EOFError,
+                              asyncio.TimeoutError))
+
+
+def host_of(url):
+    return (urlsplit(url).hostname or '').lower()
+
+
+class CircuitBreaker:
+    """
+    Failure state of one host.
+
+    closed: jobs run normally. After `failures` transient failures in a row
+    the circuit opens and no job for the host starts for `cooldown` seconds.
+    Then it is half-open: a single job probes the host; success closes the
+    circuit, another failure opens it again with twice the cooldown. A host
+    whose circuit opened more than max_opens times without a success is
+    given up on for the rest of the run.
+    """
+
+    def __init__(self, failures=DEFAULT_BREAKER_FAILURES, cooldown=DEFAULT_BREAKER_COOLDOWN,
+                 max_cooldown=MAX_BREAKER_COOLDOWN, max_opens=BREAKER_MAX_OPENS):
+        self.threshold = failures
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_opens = max_opens
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opens = 0
+        self.opened_until = 0.0
+        self.probing = False
+
+    def hold(self, now):
+        """
+        Seconds a job for this host has to wait before it may start (0: start
+        now), or None if the host has been given up on.
+        """
+        if self.state == 'dead':
+            return None
+        if self.state == 'open':
+            if now < self.opened_until:
+                return self.opened_until - now
+            self.state = 'half-open'
+        if self.state == 'half-open':
+            if self.probing:
+                return PROBE_WAIT
+            self.probing = True
+        return 0
+
+    def record(self, success, now):
+        """Record the outcome of a job; returns True if this opened the circuit"""
+        self.probing = False
+        if self.state == 'dead':
+            return False
+        if success:
+            self.state = 'closed'
+            self.failures = 0
+            self.opens = 0
+            self.cooldown = self.base_cooldown
+            return False
+
+        self.failures += 1
+        if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+            if self.state == 'half-open':
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.opens += 1
+            self.state = 'dead' if self.opens > self.max_opens else 'open'
+            self.opened_until = now + self.cooldown
+            return True
+        return False
+
+    def release(self):
+        """The job said nothing about the host (e.g. it was skipped); let another one probe"""
+        self.probing = False
+
+
+class RetryPolicy:
+    """
+    Decides what TaskScheduler does with failed tasks and which tasks may start.
+
+    Transient failures (see Failure) are re-queued up to `retries` times,
+    after an exponential backoff with jitter: attempt n waits a random time
+    between half and all of min(max_delay, delay * 2**n), so jobs that failed
+    together don't come back together. Every task also passes through the
+    circuit breaker of its URL's host, so a failing CDN parks its own jobs
+    instead of cycling them through the pool.
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES, delay=DEFAULT_RETRY_DELAY, max_delay=MAX_RETRY_DELAY,
+                 breaker_failures=DEFAULT_BREAKER_FAILURES, breaker_cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.stats = {'retried': 0, 'circuits opened': 0}
+
+    def backoff(self, attempt):
+        """Delay before retry number attempt + 1 (attempt counts from 0)"""
+        ceiling = min(self.max_delay, self.delay * 2 ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def _breaker(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+        return breaker
+
+    def hold(self, task):
+        """
+        Seconds the task has to wait for its host's circuit (0: start now), or
+        None if its host has been given up on and the task should fail.
+        """
+        if not self.breaker_failures:
+            return 0
+        with self.lock:
+            return self._breaker(host_of(task[1])).hold(time.monotonic())
+
+    def after(self, task, result, attempt):
+        """
+        Record the result of a task's attempt (counting from 0).
+        Returns the delay before it is retried, or None if the result is final.
+        """
+        host = host_of(task[1])
+        if self.breaker_failures:
+            with self.lock:
+                breaker = self._breaker(host)
+                if result or (isinstance(result, Failure) and (result.transient or result.permanent)):
+                    # Permanent failures (404, bad data) still mean the host answered
+                    transient = isinstance(result, Failure) and result.transient
+                    previous = breaker.state
+                    if breaker.record(not transient, time.monotonic()):
+                        self.stats['circuits opened'] += 1
+                        if breaker.state == 'dead':
+                            logger.warning(f"Giving up on {host}: still failing after "
+                                           f"{breaker.max_opens} pauses, its remaining jobs fail")
+                        else:
+                            logger.warning(f"Circuit open for {host}: {breaker.failures} failures in a row, "
+                                           f"pausing its jobs for {breaker.cooldown:.0f}s")
+                    elif previous != 'closed' and breaker.state == 'closed':
+                        logger.info(f"Circuit closed for {host}: it is answering again")
+                else:
+                    breaker.release()
+
+        if not (isinstance(result, Failure) and result.transient) or attempt >= self.retries:
+            return None
+        if self.breaker_failures and self.breakers[host].state == 'dead':
+            return None
+        with self.lock:
+            self.stats['retried'] += 1
+        return self.backoff(attempt)
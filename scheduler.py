@@ -0,0 +1,266 @@
+import heapq
+import logging
+import signal
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from profiling import profiler
+from retry import host_of
+
+logger = logging.getLogger(__name__)
+
+ORDERS = ('playlist', 'group', 'shortest')
+
+
+def parse_weights(text):
+    """
+    Parse user-given weights such as "体育=10,新闻=-5".
+    Each key is matched against the group-title and the name; higher runs first.
+    """
+    weights = {}
+    if not text:
+        return weights
+    for item in text.split(','):
+        key, sep, value = item.rpartition('=')
+        if not sep or not key.strip():
+            raise ValueError(f"Invalid weight '{item}', expected pattern=number")
+        weights[key.strip()] = float(value)
+    return weights
+
+
+def priority_key(order='playlist', weights=None):
+    """
+    Build the sort key used to order tasks.
+    Tasks may be plain (name, url) pairs or records with group and duration
+    fields; missing fields sort last.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Unknown order '{order}', expected one of {', '.join(ORDERS)}")
+    weights = weights or {}
+
+    def key(index, task):
+        name = task[0]
+        group = getattr(task, 'group', None) or ''
+        weight = max((w for pattern, w in weights.items() if pattern in group or pattern in name), default=0)
+
+        if order == 'group':
+            secondary = (group == '', group)
+        elif order == 'shortest':
+            duration = getattr(task, 'duration', None)
+            secondary = duration if duration and duration > 0 else float('inf')
+        else:
+            secondary = 0
+        return (-weight, secondary, index)
+
+    return key
+
+
+class ProcessTracker:
+    """Thread-safe set of running ffmpeg processes, so an abort can stop them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+
+    def add(self, process):
+        with self.lock:
+            self.processes.add(process)
+
+    def discard(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def terminate_all(self):
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+        return len(processes)
+
+
+class TaskScheduler:
+    """
+    Runs tasks on a thread pool with a bounded number in flight, in priority
+    order, and collects results as they complete instead of in submission order.
+
+    The first SIGINT drains: no new tasks start and running jobs are allowed to
+    finish. A second SIGINT aborts by calling on_abort (e.g. to terminate ffmpeg).
+
+    With a retry policy (see retry.RetryPolicy), a task may be held back
+    before it starts and re-queued with a delay after it fails; held tasks
+    wait outside the pool so they never occupy a worker.
+
+    max_per_host caps the running tasks per URL host: while a host is at
+    its cap, the next tasks of other hosts start instead, so one provider
+    isn't hit by every worker at once.
+
+    run(..., follow=True) keeps going after the queue is empty: add() feeds
+    it more tasks from another thread (e.g. a playlist watcher) until
+    close() or a drain.
+    """
+
+    def __init__(self, worker, max_workers=3, max_in_flight=None, key=None,
+                 on_abort=None, thread_name_prefix='FFmpeg', retry=None, max_per_host=None):
+        self.worker = worker
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight or max_workers
+        self.key = key or priority_key()
+        self.on_abort = on_abort
+        self.thread_name_prefix = thread_name_prefix
+        self.retry = retry
+        self.max_per_host = max_per_host
+        self.following = False
+        self._inbox = []
+        self._inbox_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.draining = False
+        self.aborted = False
+        self.total = 0
+        self.finished = 0
+
+    def set_limit(self, limit):
+        """Change how many tasks may be in flight; never more than max_workers"""
+        self.max_in_flight = max(1, min(limit, self.max_workers))
+
+    def progress(self):
+        """(finished, total) tasks of the current run"""
+        return self.finished, self.total
+
+    def drain(self):
+        self.draining = True
+        self._wake.set()
+
+    def add(self, tasks):
+        """Queue more tasks for a run(follow=True) in progress; safe from any thread"""
+        with self._inbox_lock:
+            self._inbox.extend(tasks)
+        self._wake.set()
+
+    def close(self):
+        """No more tasks will be added: a following run returns once the queued ones are done"""
+        self.following = False
+        self._wake.set()
+
+    def _handle_sigint(self, signum, frame):
+        if not self.draining:
+            self.drain()
+            logger.warning("Interrupted: finishing running jobs, no new jobs will start. Press Ctrl+C again to abort.")
+            return
+        self.aborted = True
+        stopped = self.on_abort() if self.on_abort else 0
+        logger.warning(f"Aborting: stopped {stopped or 0} running jobs")
+
+    def run(self, tasks, *args, follow=False):
+        """
+        Run worker(task, *args) for every task, and with follow for every
+        task add()ed until close().
+        Returns a list of (task, result) pairs in completion order; tasks that
+        were never started because of a drain are not included.
+        """
+        queue = [(self.key(index, task), index, task) for index, task in enumerate(tasks)]
+        heapq.heapify(queue)
+        next_index = len(queue)
+        self.following = follow
+        delayed = []  # (ready_at, key, index, task) waiting for a backoff or an open circuit
+        attempts = {}
+        running = defaultdict(int)  # host -> tasks in flight
+        parked = defaultdict(list)  # host -> heap of tasks waiting for one of its slots
+        total = self.total = len(queue)
+        ready = {}  # index -> profiler clock when the task became ready to start, if it wasn't at the start
+        started = profiler.clock()
+        self.finished = 0
+        results = []
+
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGINT, self._handle_sigint)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers,
+                                    thread_name_prefix=self.thread_name_prefix) as executor:
+                in_flight = {}
+                while True:
+                    with self._inbox_lock:
+                        added, self._inbox = self._inbox, []
+                    for task in added:
+                        heapq.heappush(queue, (self.key(next_index, task), next_index, task))
+                        ready[next_index] = profiler.clock()
+                        next_index += 1
+                    total = self.total = total + len(added)
+
+                    now = time.monotonic()
+                    while delayed and delayed[0][0] <= now:
+                        _, key, index, task = heapq.heappop(delayed)
+                        heapq.heappush(queue, (key, index, task))
+                        ready[index] = profiler.clock()
+
+                    while queue and not self.draining and len(in_flight) < self.max_in_flight:
+                        key, index, task = heapq.heappop(queue)
+                        host = host_of(task[1]) if self.max_per_host else None
+                        if self.max_per_host and running[host] >= self.max_per_host:
+                            heapq.heappush(parked[host], (key, index, task))
+                            continue
+                        hold = self.retry.hold(task) if self.retry else 0
+                        if hold is None:
+                            logger.warning(f"Not starting {task[0]}: its host was given up on")
+                            results.append((task, False))
+                            self.finished = len(results)
+                            continue
+                        if hold:
+                            heapq.heappush(delayed, (now + hold, key, index, task))
+                            continue
+                        waiting_since = ready.pop(index, started)
+                        if profiler.enabled:
+                            profiler.record('queue wait', waiting_since, task=task[0])
+                        in_flight[executor.submit(profiler.job(self.worker, handoff=True), task, *args)] = \
+                            (key, index, task)
+                        running[host] += 1
+
+                    if not in_flight:
+                        if self.draining or not (delayed or queue or self.following):
+                            break
+                        timeout = min(1.0, max(delayed[0][0] - time.monotonic(), 0)) if delayed else 1.0
+                        self._wake.wait(timeout)
+                        self._wake.clear()
+                        continue
+
+                    # Wake up periodically so a drain takes effect promptly
+                    done, _ = wait(in_flight, timeout=1.0, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key, index, task = in_flight.pop(future)
+                        host = host_of(task[1]) if self.max_per_host else None
+                        running[host] -= 1
+                        if parked[host]:
+                            # One slot of this host is free again: its best waiting task competes for it
+                            heapq.heappush(queue, heapq.heappop(parked[host]))
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            logger.error(f"Unexpected error processing {task[0]}: {e}")
+                            result = False
+
+                        attempt = attempts.get(index, 0)
+                        delay = self.retry.after(task, result, attempt) if self.retry else None
+                        if delay is not None and not self.draining:
+                            attempts[index] = attempt + 1
+                            heapq.heappush(delayed, (time.monotonic() + delay, key, index, task))
+                            logger.info(f"Retrying {task[0]} in {delay:.0f}s "
+                                        f"(attempt {attempt + 2} of {self.retry.retries + 1})")
+                            continue
+
+                        results.append((task, result))
+                        self.finished = len(results)
+                        logger.info(f"Progress: {len(results)}/{total} finished, {len(in_flight)} running")
+        finally:
+            if previous_handler is not None:
+                signal.signal(signal.SIGINT, previous_handler)
+
+        not_started = len(queue) + len(delayed) + sum(len(waiting) for waiting in parked.values())
+        if not_started:
+            logger.warning(f"Drained: {not_started} tasks were not started")
+        return results
@@ -1,55 +1,26 @@
-import re
 import argparse
-from collections import defaultdict
 
-def split_m3u_by_category(input_file):
-    """Split M3U file into category-specific files with original formatting"""
-    pattern = re.compile(r'\[(.*?)\]')
-    headers = []
-    entries = defaultdict(list)
-    current_category = None
-    current_entry = []
-    in_header = True
+from m3u_engine import OutputRule, run_rules
+from playlist_index import PlaylistIndex
 
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            # Preserve header section
-            if in_header:
-                if line.startswith('#EXTINF'):
-                    in_header = False
-                else:
-                    headers.append(line)
-                    continue
-            
-            # Process entries
-            if line.startswith('#EXTINF'):
-                # Save previous entry
-                if current_entry and current_category:
-                    entries[current_category].extend(current_entry)
-                
-                # Start new entry
-                current_entry = [line]
-                match = pattern.search(line)
-                current_category = match.group(1) if match else None
-            else:
-                if current_category:  # Only collect entries with valid categories
-                    current_entry.append(line)
+def split_m3u_by_category(input_file, max_open=64, use_index=False):
+    """Split M3U file into category-specific files with original formatting"""
+    # Streams entries to {category}.m3u in one pass with a bounded number of open files
+    rules = [OutputRule('{category}.m3u')]
 
-    # Write output files
-    for category, lines in entries.items():
-        # Sanitize filename and preserve Chinese characters
-        safe_name = re.sub(r'[\\/*?:"<>|]', '_', category)
-        filename = f"{safe_name}.m3u"
-        
-        with open(filename, 'w', encoding='utf-8', newline='') as f:
-            f.writelines(headers)
-            f.writelines(lines)
-            if lines[-1][-1] != '\n':  # Ensure proper line ending
-                f.write('\n')
+    if use_index:
+        with PlaylistIndex(input_file) as index:
+            run_rules(input_file, rules, max_open=max_open, reader=index.reader())
+    else:
+        run_rules(input_file, rules, max_open=max_open)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Split M3U file into category-specific files')
     parser.add_argument('input_file', help='Input M3U file path')
+    parser.add_argument('--max-open', type=int, default=64,
+                        help='Maximum number of output files open at once (default: 64)')
+    parser.add_argument('--index', action='store_true',
+                        help='Query the <input_file>.index.sqlite sidecar (built or refreshed as needed) instead of rescanning')
     args = parser.parse_args()
     
-    split_m3u_by_category(args.input_file) 
\ No newline at end of file
+    split_m3u_by_category(args.input_file, args.max_open, args.index) 
\ No newline at end of file
@@ -0,0 +1,72 @@
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers from server.routes: path -> (status, headers, body), or a
+    callable(handler) that writes the response itself. Requests are logged
+    to server.requests as (method, path, headers).
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        route = self.server.routes.get(self.path)
+        if callable(route):
+            return route(self)
+        status, headers, body = route or (404, {}, b'not found')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_HEAD = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.routes = {}
+        self.requests = []
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+    def hits(self, path):
+        return sum(1 for _, requested, _ in self.requests if requested == path)
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def media_playlist(segments, ended=True, duration=4):
+    """An HLS media playlist of /seg/0.ts ... /seg/<segments - 1>.ts"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f"#EXT-X-TARGETDURATION:{duration}", '#EXT-X-MEDIA-SEQUENCE:0']
+    for i in range(segments):
+        lines += [f"#EXTINF:{duration}.0,", f"/seg/{i}.ts"]
+    if ended:
+        lines.append('#EXT-X-ENDLIST')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
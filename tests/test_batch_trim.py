@@ -0,0 +1,27 @@
+import batch_trim
+from batch_trim import SAMPLE_FPS, AdDetector
+
+A, B, C, BLACK = 0x0f0f0f0f0f0f0f0f, 0x00ff00ff00ff00ff, 0x3333333333333333, 0
+SHOW, CREDITS = 0x5555555555555555, 0xffffffff00000000
+
+
+def detector_for(monkeypatch, clip, video):
+    frames = {'clip.mp4': clip, 'video.mp4': video}
+    monkeypatch.setattr(batch_trim, 'sample_hashes', lambda path, window=None: frames[str(path)])
+    return AdDetector(ad_clips=['clip.mp4'])
+
+
+def test_clip_ending_on_black_cuts_where_the_clip_ends(monkeypatch):
+    detector = detector_for(monkeypatch, [A, B, C, BLACK],
+                            [SHOW, A, B, C, BLACK, BLACK, BLACK, BLACK, SHOW, SHOW])
+    assert detector.detect('video.mp4') == (5 / SAMPLE_FPS, 'ad-clip')
+
+
+def test_later_matches_of_the_last_frame_are_ignored(monkeypatch):
+    detector = detector_for(monkeypatch, [A, B, CREDITS], [A, B, CREDITS, SHOW, SHOW, CREDITS, SHOW])
+    assert detector.detect('video.mp4') == (3 / SAMPLE_FPS, 'ad-clip')
+
+
+def test_no_clip_start_falls_back(monkeypatch):
+    detector = detector_for(monkeypatch, [A, B, BLACK], [SHOW, BLACK, BLACK, SHOW])
+    assert detector.detect('video.mp4') == (detector.default, 'fixed')
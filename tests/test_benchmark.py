@@ -0,0 +1,7 @@
+from benchmark import bench_filenames
+
+
+def test_filenames_sizes_below_and_off_the_step():
+    rows = bench_filenames([50, 120, 120, 0], step=100)
+    assert [row['size'] for row in rows] == [50, 120]
+    assert all(row['us_per_name'] > 0 and row['exists_us_per_name'] > 0 for row in rows)
@@ -0,0 +1,43 @@
+from dedup import Deduplicator, extra_token_params, normalize_url
+
+
+def test_auth_tokens_are_ignored():
+    assert (normalize_url('https://cdn3.example.com:443/live/1.m3u8?token=abc&id=1&expires=99')
+            == normalize_url('http://cdn1.example.com/live/1.m3u8?id=1&token=def'))
+
+
+def test_channel_selecting_parameters_are_kept():
+    for param in ('t', 'e', 'key', 'uid', 'sid'):
+        assert (normalize_url(f"http://panel.example.com/play.php?{param}=1")
+                != normalize_url(f"http://panel.example.com/play.php?{param}=2"))
+
+
+def test_extra_token_params_are_opt_in():
+    token_params = extra_token_params(['T', ' '])
+    assert (normalize_url('http://example.com/live.m3u8?t=1', token_params=token_params)
+            == normalize_url('http://example.com/live.m3u8?t=2', token_params=token_params))
+
+
+def test_title_matching_is_opt_in():
+    by_url = Deduplicator()
+    assert by_url.check(1, 'News 第01集', 'http://a.example.com/1') is None
+    assert by_url.check(2, 'NEWS EP1', 'http://b.example.com/2') is None
+    assert by_url.check(3, 'News', 'http://a.example.com/1?token=x').kept_line == 1
+
+    by_title = Deduplicator(('url', 'title'))
+    by_title.check(1, 'News 第01集', 'http://a.example.com/1')
+    assert by_title.check(2, 'NEWS EP1', 'http://b.example.com/2').reason == 'title'
+
+
+def test_duplicate_groups_list_every_occurrence(tmp_path):
+    from find_duplicates import duplicate_groups
+
+    path = tmp_path / 'tasks.txt'
+    path.write_text('A,http://a.example.com/1?token=x\nB,http://b.example.com/2\n'
+                    'A2,http://a.example.com/1\nB2,http://b.example.com/2\nC,http://c.example.com/3\n',
+                    encoding='utf-8')
+    groups = duplicate_groups(str(path), deduplicator=Deduplicator())
+    assert [[(m.line, m.name, m.reason) for m in group] for group in groups] == [
+        [(1, 'A', None), (3, 'A2', 'url')], [(2, 'B', None), (4, 'B2', 'url')]]
+    dropped = duplicate_groups(str(path), deduplicator=Deduplicator(), dropped_only=True)
+    assert [[m.name for m in group] for group in dropped] == [['A2'], ['B2']]
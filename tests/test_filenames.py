@@ -0,0 +1,62 @@
+import os
+
+import filenames
+from filenames import FilenameAllocator
+
+
+def populate(directory, count, name='Episode'):
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / f"{name}.mp4").touch()
+    for i in range(2, count + 1):
+        (directory / f"{name}-{i}.mp4").touch()
+
+
+def count_opens(monkeypatch):
+    """Number of os.open calls the allocator makes, i.e. the names it tries"""
+    calls = []
+    real_open = os.open
+
+    def counting_open(*args, **kwargs):
+        calls.append(args[0])
+        return real_open(*args, **kwargs)
+
+    monkeypatch.setattr(filenames.os, 'open', counting_open)
+    return calls
+
+
+def test_allocation_cost_does_not_grow_with_existing_files(tmp_path, monkeypatch):
+    # Timing is too noisy for CI; the filesystem operations per name are what used to grow
+    attempts = {}
+    for existing in (10, 1000, 5000):
+        directory = tmp_path / str(existing)
+        populate(directory, existing)
+        allocator = FilenameAllocator(directory).scan()
+        calls = count_opens(monkeypatch)
+        for _ in range(50):
+            allocator.allocate('Episode')
+        attempts[existing] = len(calls)
+        monkeypatch.undo()
+    assert attempts == {10: 50, 1000: 50, 5000: 50}
+
+
+def test_allocation_continues_after_highest_suffix(tmp_path):
+    populate(tmp_path, 3)
+    (tmp_path / 'Episode-10.mp4').touch()
+    allocator = FilenameAllocator(tmp_path)
+    assert allocator.allocate('Episode') == ('Episode-11', tmp_path / 'Episode-11.mp4')
+    assert allocator.allocate('Other') == ('Other', tmp_path / 'Other.mp4')
+
+
+def test_file_created_after_scan_is_not_reused(tmp_path):
+    allocator = FilenameAllocator(tmp_path).scan()
+    (tmp_path / 'Episode.mp4').touch()
+    assert allocator.allocate('Episode')[0] == 'Episode-2'
+
+
+def test_release_gives_the_name_back(tmp_path):
+    allocator = FilenameAllocator(tmp_path)
+    allocator.allocate('Episode')
+    name, output_file = allocator.allocate('Episode')
+    allocator.release(output_file)
+    assert not output_file.exists()
+    assert allocator.allocate('Episode')[0] == name
@@ -0,0 +1,82 @@
+import os
+import threading
+
+import pytest
+
+from conftest import media_playlist
+from hls_fetcher import HLSFetcher, PIPE_SOURCE, fetch_or_fallback, parse_playlist, stream_or_fallback
+
+MPEGTS = {'Content-Type': 'video/mp2t'}
+MPEGURL = {'Content-Type': 'application/vnd.apple.mpegurl'}
+
+
+def serve_stream(server, segments, ended=True):
+    server.routes['/index.m3u8'] = (200, MPEGURL, media_playlist(segments, ended))
+    for i in range(segments):
+        server.routes[f"/seg/{i}.ts"] = (200, MPEGTS, f"segment {i};".encode() * 100)
+    return server.url('/index.m3u8')
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = HLSFetcher(max_per_host=2, timeout=5, retries=1).start()
+    yield fetcher
+    fetcher.close()
+
+
+def test_parse_playlist_ended():
+    assert parse_playlist(media_playlist(2).decode(), 'http://h/a.m3u8').ended
+    assert not parse_playlist(media_playlist(2, ended=False).decode(), 'http://h/a.m3u8').ended
+    vod = '#EXTM3U\n#EXT-X-PLAYLIST-TYPE:VOD\n#EXTINF:4,\na.ts\n'
+    assert parse_playlist(vod, 'http://h/a.m3u8').ended
+
+
+def test_download_fetches_every_segment_once(stub_server, fetcher, tmp_path):
+    url = serve_stream(stub_server, 40)
+    source, input_args = fetch_or_fallback(fetcher, url, tmp_path)
+
+    assert input_args == ['-f', 'concat', '-safe', '0']
+    listed = [line.split("'")[1] for line in source.read_text().splitlines()[1:]]
+    assert len(listed) == 40
+    assert (tmp_path / listed[7]).read_bytes() == b'segment 7;' * 100
+    assert all(stub_server.hits(f"/seg/{i}.ts") == 1 for i in range(40))
+
+
+def test_download_resumes_from_checkpoint(stub_server, fetcher, tmp_path):
+    url = serve_stream(stub_server, 5)
+    fetcher.download(url, tmp_path)
+    (tmp_path / '000003.ts').unlink()
+    fetcher.download(url, tmp_path)
+
+    assert stub_server.hits('/seg/3.ts') == 2
+    assert stub_server.hits('/seg/0.ts') == 1
+
+
+def test_live_playlist_is_left_to_ffmpeg(stub_server, fetcher, tmp_path):
+    url = serve_stream(stub_server, 3, ended=False)
+
+    assert fetch_or_fallback(fetcher, url, tmp_path / 'work') == (url, [])
+    assert stream_or_fallback(fetcher, url) == (url, [], None)
+    assert not (tmp_path / 'work').exists()
+    assert stub_server.hits('/seg/0.ts') == 0
+
+
+def test_stream_feeds_segments_in_order(stub_server, fetcher):
+    url = serve_stream(stub_server, 12)
+    source, input_args, feed = stream_or_fallback(fetcher, url)
+    assert (source, input_args) == (PIPE_SOURCE, ['-f', 'mpegts'])
+
+    read_fd, write_fd = os.pipe()
+    received = []
+    reader = threading.Thread(target=lambda: received.append(b''.join(iter(lambda: os.read(read_fd, 65536), b''))))
+    reader.start()
+    try:
+        size = feed(write_fd)
+    finally:
+        os.close(write_fd)
+    reader.join()
+    os.close(read_fd)
+
+    expected = b''.join(f"segment {i};".encode() * 100 for i in range(12))
+    assert received[0] == expected
+    assert size == len(expected)
@@ -0,0 +1,100 @@
+import time
+
+from conftest import media_playlist
+from preflight import HealthCache, check_urls, read_tasks, run_preflight
+
+MPEGURL = {'Content-Type': 'application/vnd.apple.mpegurl'}
+
+
+def endless_stream(handler):
+    """Refuses HEAD; answers GET with a stream that never ends, ignoring Range"""
+    if handler.command == 'HEAD':
+        handler.send_response(405)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+        return
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'video/mp2t')
+    handler.end_headers()
+    try:
+        while True:
+            handler.wfile.write(b'\x47' * 65536)
+    except OSError:
+        pass
+
+
+def serve_channels(server):
+    master = f"#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=800000\n{server.url('/gone/index.m3u8')}\n"
+    server.routes.update({
+        '/ok/index.m3u8': (200, MPEGURL, media_playlist(3)),
+        '/ok/movie.mp4': (200, {'Content-Type': 'video/mp4'}, b'mp4'),
+        '/missing/index.m3u8': (404, {}, b''),
+        '/busy/index.m3u8': (503, {}, b''),
+        '/html/index.m3u8': (200, {'Content-Type': 'text/html'}, b'<html></html>'),
+        '/master/index.m3u8': (200, MPEGURL, master.encode()),
+        '/live.ts': endless_stream,
+    })
+
+
+def test_states(stub_server):
+    serve_channels(stub_server)
+    url = stub_server.url
+    results = check_urls([url('/ok/index.m3u8'), url('/ok/movie.mp4'), url('/missing/index.m3u8'),
+                          url('/busy/index.m3u8'), url('/html/index.m3u8'), url('/master/index.m3u8'),
+                          'rtmp://example.com/live'], timeout=5)
+
+    states = {u: (r.state, r.status, r.reason) for u, r in results.items()}
+    assert states[url('/ok/index.m3u8')] == ('ok', 200, '')
+    assert states[url('/ok/movie.mp4')] == ('ok', 200, '')
+    assert states[url('/missing/index.m3u8')] == ('dead', 404, 'HTTP 404')
+    assert states[url('/busy/index.m3u8')] == ('unreachable', 503, 'HTTP 503')
+    assert states[url('/html/index.m3u8')] == ('dead', 200, 'not an M3U8 playlist')
+    assert states[url('/master/index.m3u8')] == ('dead', 404, 'variant HTTP 404')
+    assert states['rtmp://example.com/live'][0] == 'unchecked'
+
+
+def test_range_fallback_does_not_read_an_endless_body(stub_server):
+    serve_channels(stub_server)
+    start = time.monotonic()
+    result = check_urls([stub_server.url('/live.ts')], timeout=5)[stub_server.url('/live.ts')]
+
+    assert (result.state, result.status) == ('ok', 200)
+    assert time.monotonic() - start < 3
+    methods = [(method, headers.get('Range')) for method, path, headers in stub_server.requests]
+    assert methods == [('HEAD', None), ('GET', 'bytes=0-0')]
+
+
+def test_cached_results_are_not_probed_again(stub_server, tmp_path):
+    serve_channels(stub_server)
+    urls = [stub_server.url('/ok/index.m3u8'), stub_server.url('/missing/index.m3u8')]
+    for _ in range(2):
+        cache = HealthCache(tmp_path / 'cache.sqlite', ttl=60)
+        try:
+            results = check_urls(urls, cache, timeout=5)
+        finally:
+            cache.close()
+        assert [results[u].state for u in urls] == ['ok', 'dead']
+    assert len(stub_server.requests) == 2
+
+
+def test_drop_and_deprioritize(stub_server, tmp_path):
+    serve_channels(stub_server)
+    tasks = [('Good', stub_server.url('/ok/index.m3u8')), ('Gone', stub_server.url('/missing/index.m3u8'))]
+    report = tmp_path / 'report.tsv'
+
+    kept, unhealthy = run_preflight(tasks, 'drop', report=str(report), cache_path=None, timeout=5)
+    assert kept == tasks[:1]
+    assert unhealthy == {tasks[1][1]}
+    assert report.read_text().splitlines()[1].startswith('dead\t404\t')
+
+    kept, unhealthy = run_preflight(tasks, 'deprioritize', report=None, cache_path=None, timeout=5)
+    assert kept == tasks
+    assert unhealthy == {tasks[1][1]}
+
+
+def test_task_file_fields_are_stripped(tmp_path):
+    path = tmp_path / 'tasks.txt'
+    path.write_text('News, http://example.com/news.m3u8\n  Sports ,http://example.com/a,b.m3u8 \nno url\n',
+                    encoding='utf-8')
+    assert read_tasks(str(path)) == [('News', 'http://example.com/news.m3u8'),
+                                     ('Sports', 'http://example.com/a,b.m3u8')]
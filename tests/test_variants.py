@@ -0,0 +1,45 @@
+from conftest import media_playlist
+from variants import VariantResolver, parse_variant_policy
+
+MPEGURL = {'Content-Type': 'application/vnd.apple.mpegurl'}
+
+
+def serve_master(server, token, bom=''):
+    server.routes['/master.m3u8'] = (200, MPEGURL, (
+        f'{bom}#EXTM3U\n'
+        f'#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080\n/1080/index.m3u8?token={token}\n'
+        f'#EXT-X-STREAM-INF:BANDWIDTH=3000000,RESOLUTION=1280x720\n/720/index.m3u8?token={token}\n'
+        f'#EXT-X-STREAM-INF:BANDWIDTH=1000000,RESOLUTION=640x360\n/360/index.m3u8?token={token}\n').encode())
+
+
+def test_cached_choice_gets_the_current_signed_uri(stub_server, tmp_path):
+    resolver = VariantResolver(parse_variant_policy('720p'), path=str(tmp_path / 'cache.sqlite'))
+    try:
+        serve_master(stub_server, 'first')
+        assert resolver.resolve(stub_server.url('/master.m3u8')) == stub_server.url('/720/index.m3u8?token=first')
+
+        serve_master(stub_server, 'second')
+        assert resolver.resolve(stub_server.url('/master.m3u8')) == stub_server.url('/720/index.m3u8?token=second')
+        assert resolver.stats == {'resolved': 1, 'cached': 1}
+    finally:
+        resolver.close()
+
+
+def test_media_playlists_are_not_fetched_again(stub_server, tmp_path):
+    stub_server.routes['/media.m3u8'] = (200, MPEGURL, media_playlist(3))
+    resolver = VariantResolver(parse_variant_policy('720p'), path=str(tmp_path / 'cache.sqlite'))
+    try:
+        url = stub_server.url('/media.m3u8')
+        assert [resolver.resolve(url) for _ in range(3)] == [url] * 3
+        assert stub_server.hits('/media.m3u8') == 1
+    finally:
+        resolver.close()
+
+
+def test_master_playlist_with_a_bom(stub_server, tmp_path):
+    serve_master(stub_server, 'first', bom='\ufeff')
+    resolver = VariantResolver(parse_variant_policy('720p'), path=str(tmp_path / 'cache.sqlite'))
+    try:
+        assert resolver.resolve(stub_server.url('/master.m3u8')) == stub_server.url('/720/index.m3u8?token=first')
+    finally:
+        resolver.close()
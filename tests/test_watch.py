@@ -0,0 +1,110 @@
+import os
+
+from watch import PlaylistWatcher
+
+
+def read_tasks(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [tuple(field.strip() for field in line.split(',', 1)) for line in f if ',' in line]
+
+
+def make_watcher(location, tmp_path):
+    batches = []
+    watcher = PlaylistWatcher(location, read_tasks, batches.append, state_path=str(tmp_path / 'state.sqlite'))
+    return watcher, batches
+
+
+def dispatched(batches):
+    tasks = [task for batch in batches for task in batch]
+    del batches[:]
+    return tasks
+
+
+def test_local_playlist_only_new_and_changed_entries(tmp_path):
+    playlist = tmp_path / 'list.txt'
+    playlist.write_text('One, http://example.com/1.m3u8?token=a\nTwo, http://example.com/2.m3u8\n', encoding='utf-8')
+    watcher, batches = make_watcher(str(playlist), tmp_path)
+    try:
+        assert watcher.poll().added == 2
+        assert [name for name, _ in dispatched(batches)] == ['One', 'Two']
+
+        assert watcher.poll() is None
+        assert batches == []
+
+        # A refreshed token is the same entry; a renamed one changed; Three is new; Two is gone
+        playlist.write_text('One, http://example.com/1.m3u8?token=b\nThree, http://example.com/3.m3u8\n'
+                            'Renamed, http://example.com/4.m3u8\n', encoding='utf-8')
+        os.utime(playlist, ns=(0, 1))
+        diff = watcher.poll()
+        assert (diff.added, diff.changed, diff.unchanged, diff.removed) == (2, 0, 1, 1)
+        assert [name for name, _ in dispatched(batches)] == ['Three', 'Renamed']
+
+        playlist.write_text('One, http://example.com/1.m3u8?token=b\nThree, http://example.com/3.m3u8\n'
+                            'Renamed again, http://example.com/4.m3u8\n', encoding='utf-8')
+        os.utime(playlist, ns=(0, 2))
+        assert watcher.poll().changed == 1
+        assert [name for name, _ in dispatched(batches)] == ['Renamed again']
+    finally:
+        watcher.stop()
+
+
+def test_restart_hands_over_every_entry_again(tmp_path):
+    playlist = tmp_path / 'list.txt'
+    playlist.write_text('One, http://example.com/1.m3u8\n', encoding='utf-8')
+    for _ in range(2):
+        watcher, batches = make_watcher(str(playlist), tmp_path)
+        try:
+            watcher.poll()
+        finally:
+            watcher.stop()
+        assert [name for name, _ in dispatched(batches)] == ['One']
+
+
+def test_url_is_fetched_conditionally(stub_server, tmp_path):
+    body = [b'One, http://example.com/1.m3u8\n']
+
+    def playlist(handler):
+        etag = f'"{len(body[0])}"'
+        if handler.headers.get('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+        handler.send_response(200)
+        handler.send_header('ETag', etag)
+        handler.send_header('Content-Length', str(len(body[0])))
+        handler.end_headers()
+        handler.wfile.write(body[0])
+
+    stub_server.routes['/list.m3u'] = playlist
+    watcher, batches = make_watcher(stub_server.url('/list.m3u'), tmp_path)
+    try:
+        watcher.poll()
+        assert [name for name, _ in dispatched(batches)] == ['One']
+
+        assert watcher.poll() is None
+        assert stub_server.requests[-1][2].get('If-None-Match') == f'"{len(body[0])}"'
+
+        body[0] += b'Two, http://example.com/2.m3u8\n'
+        assert watcher.poll().added == 1
+        assert [name for name, _ in dispatched(batches)] == ['Two']
+    finally:
+        watcher.stop()
+
+
+def test_url_is_read_with_the_downloader_parser(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # Importing the downloader opens download_log.log in the working directory
+    from m3u_parser_downloader import iter_tasks
+
+    stub_server.routes['/list'] = (200, {}, b'One, http://example.com/1.m3u8\nTwo, http://example.com/2.m3u8\n')
+    stub_server.routes['/get.php?type=m3u'] = (200, {}, (
+        '﻿#EXTM3U\n#EXTINF:-1 group-title="News",Three\nhttp://example.com/3.m3u8\n').encode('utf-8'))
+    for path, expected in (('/list', ['One', 'Two']), ('/get.php?type=m3u', ['News-Three'])):
+        batches = []
+        watcher = PlaylistWatcher(stub_server.url(path), iter_tasks, batches.append,
+                                  state_path=str(tmp_path / 'state.sqlite'))
+        try:
+            watcher.poll()
+        finally:
+            watcher.stop()
+        assert [task[0] for task in dispatched(batches)] == expected
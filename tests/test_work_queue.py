@@ -0,0 +1,133 @@
+import threading
+
+import pytest
+
+import work_queue
+from jobs import JobStore
+from retry import Failure, RetryPolicy
+from work_queue import (CLAIM_BATCH, Coordinator, CoordinatorClient, QueueWorker, RemoteLedger, WorkQueue,
+                        parse_address)
+
+
+def in_order(index, task):
+    return (index,)
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), policy=RetryPolicy(retries=1, delay=0, breaker_failures=0))
+    yield queue
+    queue.close()
+
+
+def test_tasks_are_claimed_in_order_once(queue):
+    tasks = [(f"Show {i}", f"http://cdn{i}.example.com/{i}.m3u8") for i in range(3)]
+    assert queue.add_tasks(tasks, in_order) == 3
+    assert queue.add_tasks(tasks[:1], in_order) == 0
+
+    claimed = [queue.claim('a')['name'] for _ in range(3)]
+    assert claimed == ['Show 0', 'Show 1', 'Show 2']
+    assert queue.claim('a') == 'wait'
+    assert queue.counts() == {'pending': 0, 'leased': 3, 'done': 0, 'failed': 0}
+
+
+def test_results(queue):
+    queue.add_tasks([('Good', 'http://a.example.com/1'), ('Flaky', 'http://b.example.com/2'),
+                     ('Broken', 'http://c.example.com/3')], in_order)
+    good, flaky, broken = (queue.claim('a')['id'] for _ in range(3))
+
+    assert queue.complete(good, 'a', True) == 'done'
+    assert queue.complete(broken, 'a', Failure('HTTP 404', permanent=True)) == 'failed'
+    assert queue.complete(flaky, 'b', Failure('reset', transient=True)) is None  # Not b's lease
+    assert queue.complete(flaky, 'a', Failure('reset', transient=True)) == 'pending'
+
+    retry = queue.claim('b')
+    assert (retry['id'], retry['attempt']) == (flaky, 1)
+    assert queue.complete(flaky, 'b', Failure('reset', transient=True)) == 'failed'
+    assert queue.claim('b') is None
+
+
+def test_expired_lease_goes_to_the_next_worker(queue):
+    queue.add_tasks([('Show', 'http://a.example.com/1')], in_order)
+    queue.lease = -1  # Expired as soon as it is taken
+    first = queue.claim('a')
+    queue.lease = 60
+    second = queue.claim('b')
+
+    assert first['id'] == second['id']
+    assert not queue.renew(first['id'], 'a')
+    assert queue.renew(second['id'], 'b')
+    assert queue.complete(first['id'], 'a', True) == 'done'  # Finished work is kept
+
+
+def test_host_cap(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), policy=RetryPolicy(breaker_failures=0), max_per_host=1)
+    try:
+        queue.add_tasks([('A', 'http://a.example.com/1'), ('B', 'http://a.example.com/2'),
+                         ('C', 'http://c.example.com/3')], in_order)
+        assert [queue.claim('w')['name'], queue.claim('w')['name'], queue.claim('w')] == ['A', 'C', 'wait']
+    finally:
+        queue.close()
+
+
+def test_claim_pages_past_held_back_tasks(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), policy=RetryPolicy(breaker_failures=0), max_per_host=1)
+    try:
+        busy = [(f"Busy {i}", f"http://busy.example.com/{i}") for i in range(CLAIM_BATCH * 2 + 5)]
+        queue.add_tasks(busy + [('Other', 'http://other.example.com/1')], in_order)
+        assert queue.claim('w')['name'] == 'Busy 0'
+        assert queue.claim('w')['name'] == 'Other'
+        assert queue.claim('w') == 'wait'
+    finally:
+        queue.close()
+
+
+def test_address_defaults_to_this_machine():
+    assert parse_address('8700') == ('127.0.0.1', 8700)
+    assert parse_address(':8700') == ('127.0.0.1', 8700)
+    assert parse_address('0.0.0.0:8700') == ('0.0.0.0', 8700)
+
+
+def test_workers_drain_the_queue_through_the_coordinator(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, 'IDLE_WAIT', 0.05)
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), policy=RetryPolicy(retries=1, delay=0))
+    jobs = JobStore(tmp_path / 'jobs.sqlite', legacy_ledger=None).load()
+    tasks = [(f"Show {i}", f"http://cdn.example.com/{i}.m3u8") for i in range(20)]
+    queue.add_tasks(tasks, in_order)
+    coordinator = Coordinator(queue, jobs, port=0).start()
+
+    ran = []
+    lock = threading.Lock()
+
+    def download(task, ledger):
+        ledger.mark_started(task[0], task[1])
+        with lock:
+            ran.append(task)
+            first_try = ran.count(task) == 1
+        if task[0] == 'Show 3' and first_try:
+            ledger.mark_failed(task[1], 'connection reset')
+            return Failure('connection reset', transient=True)
+        ledger.mark_completed(task[0], task[1], output=f"downloads/{task[0]}.mp4", mode='remux')
+        return True
+
+    try:
+        workers = []
+        for name in ('one', 'two'):
+            ledger = RemoteLedger()
+            client = CoordinatorClient(coordinator.address, worker=name)
+            workers.append(threading.Thread(
+                target=QueueWorker(client, download, max_workers=2, ledger=ledger).run, args=(ledger,)))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=30)
+        assert not any(worker.is_alive() for worker in workers)
+    finally:
+        coordinator.stop()
+        queue.close()
+
+    assert sorted(ran) == sorted(tasks + [tasks[3]])
+    assert len(jobs) == 20
+    done = jobs.query(status='done')
+    assert {job['output'] for job in done} == {f"downloads/Show {i}.mp4" for i in range(20)}
+    jobs.close()
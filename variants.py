@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import re
+import sqlite3
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+
+from hls_fetcher import USER_AGENT, HLSError, parse_attributes, parse_playlist
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = '.variant_cache.sqlite'
+DEFAULT_TTL = 3600
+FETCH_TIMEOUT = 15
+MAX_PLAYLIST_BYTES = 4 * 1024 * 1024
+SOURCE_HEADROOM = 1.5  # A source needs about this much more bitrate than an encode made from it
+
+RESOLUTION_PATTERN = re.compile(r'^(?:(\d+)x)?(\d+)p?$', re.IGNORECASE)
+BITRATE_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)([km]?)(?:bps)?$', re.IGNORECASE)
+SCALE_PATTERN = re.compile(r'scale=(?:w=)?-?\d+:(?:h=)?(\d+)')
+
+# height: smallest variant at least this tall; max_bitrate: bits per second;
+# lowest: the cheapest variant instead of the best; encoder: targets taken from the transcode profile
+VariantPolicy = namedtuple('VariantPolicy', ['height', 'max_bitrate', 'lowest', 'encoder'])
+
+# variant is the signature of the chosen variant, NULL when the URL itself is handed on
+# (not a master playlist, or separate audio)
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS choices (
+    url TEXT NOT NULL,
+    policy TEXT NOT NULL,
+    variant TEXT,
+    reason TEXT,
+    resolved REAL NOT NULL,
+    PRIMARY KEY (url, policy)
+);
+"""
+
+
+def parse_bitrate(text):
+    """'4M', '2500k' or '800000' in bits per second"""
+    match = BITRATE_PATTERN.match(text.strip())
+    if not match:
+        raise ValueError(f"Invalid bitrate '{text}'")
+    value, unit = match.groups()
+    return int(float(value) * {'': 1, 'k': 1000, 'm': 1000000}[unit.lower()])
+
+
+def parse_variant_policy(text):
+    """
+    Parse a policy such as "720p", "4M", "720p,4M", "lowest" or "encoder,1080p".
+    highest (the default) is what ffmpeg picks on its own.
+    """
+    height = max_bitrate = None
+    lowest = encoder = False
+    for item in text.split(','):
+        item = item.strip().lower()
+        if not item or item == 'highest':
+            continue
+        if item == 'lowest':
+            lowest = True
+        elif item == 'encoder':
+            encoder = True
+        elif RESOLUTION_PATTERN.match(item) and (item.endswith('p') or 'x' in item):
+            height = int(RESOLUTION_PATTERN.match(item).group(2))
+        else:
+            try:
+                max_bitrate = parse_bitrate(item)
+            except ValueError:
+                raise ValueError(f"Invalid variant policy '{item}', expected highest, lowest, encoder, "
+                                 f"a resolution (720p, 1280x720) or a bitrate (4M)") from None
+    return VariantPolicy(height, max_bitrate, lowest, encoder)
+
+
+def describe_policy(policy):
+    parts = ['lowest' if policy.lowest else 'highest']
+    if policy.encoder:
+        parts.append('encoder')
+    if policy.height:
+        parts.append(f"{policy.height}p")
+    if policy.max_bitrate:
+        parts.append(f"{policy.max_bitrate}")
+    return ','.join(parts)
+
+
+def profile_targets(profile):
+    """(height, bitrate) a transcode profile produces, each None if the profile doesn't fix it"""
+    args = list(profile.args)
+    height = bitrate = None
+    for option, value in zip(args, args[1:]):
+        if option in ('-vf', '-filter:v'):
+            match = SCALE_PATTERN.search(value)
+            if match:
+                height = int(match.group(1))
+        elif option == '-s' and 'x' in value:
+            height = int(value.split('x')[1])
+        elif option in ('-b:v', '-maxrate'):
+            try:
+                bitrate = parse_bitrate(value)
+            except ValueError:
+                pass
+    return height, bitrate
+
+
+def variant_height(variant):
+    _, _, height = variant.get('RESOLUTION', '').partition('x')
+    return int(height) if height.isdigit() else None
+
+
+def variant_bitrate(variant):
+    return int(variant.get('AVERAGE-BANDWIDTH') or variant.get('BANDWIDTH') or 0)
+
+
+def variant_signature(variant):
+    """Identifies a variant across fetches of its master playlist, whose URIs may carry fresh tokens"""
+    return '|'.join(variant.get(name, '') for name in ('BANDWIDTH', 'RESOLUTION', 'CODECS', 'AUDIO'))
+
+
+def choose_variant(variants, height=None, max_bitrate=None, lowest=False):
+    """
+    Pick a variant: the best one (or the lowest) within max_bitrate, and
+    with a height the smallest one that is at least that tall (the tallest
+    if none is). Nothing fits the bitrate: the cheapest variant.
+    """
+    candidates = list(variants)
+    if max_bitrate:
+        candidates = ([v for v in candidates if variant_bitrate(v) <= max_bitrate]
+                      or [min(candidates, key=variant_bitrate)])
+    if height:
+        sized = [v for v in candidates if variant_height(v)]
+        tall_enough = [v for v in sized if variant_height(v) >= height]
+        if tall_enough:
+            target = min(variant_height(v) for v in tall_enough)
+            candidates = [v for v in tall_enough if variant_height(v) == target]
+        elif sized:
+            target = max(variant_height(v) for v in sized)
+            candidates = [v for v in sized if variant_height(v) == target]
+    return (min if lowest else max)(candidates, key=variant_bitrate)
+
+
+def separate_audio(text, variant):
+    """True if the variant's audio is a rendition of its own, which a media playlist alone would lose"""
+    group = variant.get('AUDIO')
+    if not group:
+        return False
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-MEDIA:'):
+            media = parse_attributes(line.split(':', 1)[1])
+            if media.get('TYPE') == 'AUDIO' and media.get('GROUP-ID') == group and media.get('URI'):
+                return True
+    return False
+
+
+def fetch_playlist(url, timeout=FETCH_TIMEOUT):
+    """(text, final URL) of the playlist at url, or None if it isn't an HLS playlist (only 10 bytes are read then)"""
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        head = response.read(10)
+        if head.startswith(b'\xef\xbb\xbf'):
+            head = head[3:]
+        if not head.startswith(b'#EXTM3U'):
+            return None
+        return (head + response.read(MAX_PLAYLIST_BYTES)).decode('utf-8', errors='replace'), response.geturl()
+
+
+class VariantResolver:
+    """
+    Replaces HLS master playlist URLs by the media playlist of the variant
+    the policy picks, so ffmpeg (or the native fetcher) doesn't pull the top
+    bitrate just for it to be encoded down again.
+
+    Choices are kept in .variant_cache.sqlite for ttl seconds, per URL and
+    policy. Variant URIs are often signed and short-lived, so a master
+    playlist is read again every time and only the choice is reused; URLs
+    that aren't master playlists are not fetched again while cached. A
+    variant whose audio is a separate rendition keeps the master URL.
+    """
+
+    def __init__(self, policy, path=CACHE_FILE, ttl=DEFAULT_TTL):
+        self.policy = policy
+        self.key = describe_policy(policy)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.stats = {'resolved': 0, 'cached': 0}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def targets(self, profile=None):
+        """(height, max_bitrate) for a job, with the encoder profile's output taking precedence"""
+        height, max_bitrate = self.policy.height, self.policy.max_bitrate
+        if self.policy.encoder and profile is not None:
+            profile_height, profile_bitrate = profile_targets(profile)
+            height = profile_height or height
+            if profile_bitrate:
+                max_bitrate = int(profile_bitrate * SOURCE_HEADROOM)
+        return height, max_bitrate
+
+    def resolve(self, url, profile=None):
+        """URL to hand to ffmpeg for url: the chosen media playlist, or url itself"""
+        key = self.key if not self.policy.encoder or profile is None else f"{self.key}:{profile.name}"
+        with self.lock:
+            row = self.db.execute('SELECT variant FROM choices WHERE url = ? AND policy = ? AND resolved >= ?',
+                                  (url, key, time.time() - self.ttl)).fetchone()
+        if row is not None and row[0] is None:
+            with self.lock:
+                self.stats['cached'] += 1
+            return url
+
+        try:
+            fetched = fetch_playlist(url)
+            if fetched is None:
+                choice, media_url, reason = None, url, 'not a playlist'
+            else:
+                text, final_url = fetched
+                playlist = parse_playlist(text, final_url)
+                if not playlist.is_master:
+                    choice, media_url, reason = None, url, 'media playlist'
+                else:
+                    if row is not None:
+                        # Same variant as before, with the URI the master lists now
+                        for variant in playlist.variants:
+                            if variant_signature(variant) == row[0]:
+                                with self.lock:
+                                    self.stats['cached'] += 1
+                                return variant['URI']
+                    variant = choose_variant(playlist.variants, *self.targets(profile), lowest=self.policy.lowest)
+                    reason = (f"{variant.get('RESOLUTION', 'unknown size')} at "
+                              f"{variant_bitrate(variant) / 1e6:.1f} Mbps of {len(playlist.variants)} variants")
+                    if separate_audio(text, variant):
+                        choice, media_url = None, url
+                        reason = 'audio is a separate rendition, ffmpeg picks the variant'
+                    else:
+                        choice, media_url = variant_signature(variant), variant['URI']
+                    logger.info(f"Variant for {url}: {reason}")
+        except (OSError, ValueError, HLSError) as e:
+            # Not cached: ffmpeg gets the original URL and reports the problem itself
+            logger.warning(f"Could not resolve variants of {url}: {e}")
+            return url
+
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO choices VALUES (?, ?, ?, ?, ?)',
+                                (url, key, choice, reason, time.time()))
+            self.stats['resolved'] += 1
+        return media_url
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the variants of HLS master playlists and the one a policy picks')
+    parser.add_argument('urls', nargs='+', help='Master playlist URLs')
+    parser.add_argument('--variant', type=parse_variant_policy, default=parse_variant_policy('highest'),
+                        help="Policy: highest, lowest, a resolution (720p), a bitrate cap (4M), or a combination")
+    args = parser.parse_args()
+
+    for url in args.urls:
+        fetched = fetch_playlist(url)
+        if fetched is None:
+            print(f"{url}: not an HLS playlist")
+            continue
+        playlist = parse_playlist(*fetched)
+        if not playlist.is_master:
+            print(f"{url}: media playlist, {len(playlist.segments)} segments")
+            continue
+        chosen = choose_variant(playlist.variants, args.variant.height, args.variant.max_bitrate,
+                                args.variant.lowest)
+        print(url)
+        for variant in sorted(playlist.variants, key=variant_bitrate, reverse=True):
+            marker = '*' if variant is chosen else ' '
+            print(f" {marker} {variant.get('RESOLUTION', '?'):>10} {variant_bitrate(variant) / 1e6:6.2f} Mbps  "
+                  f"{variant['URI']}")
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from pathlib import Path
+
+from dedup import normalize_url
+from hls_fetcher import USER_AGENT
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = '.watch_state.sqlite'
+DEFAULT_INTERVAL = 900
+FETCH_TIMEOUT = 60
+DISPATCH_BATCH = 500  # Entries handed to the scheduler at a time while a version is read
+
+# Outcome of one poll: entries new to the snapshot, entries whose metadata changed,
+# entries still there unchanged, and entries that disappeared
+PlaylistDiff = namedtuple('PlaylistDiff', ['added', 'changed', 'unchanged', 'removed'])
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    generation INTEGER NOT NULL DEFAULT 0,
+    polled REAL
+);
+CREATE TABLE IF NOT EXISTS snapshot (
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    PRIMARY KEY (source, key)
+);
+"""
+
+
+def entry_key(task):
+    """Entries are the same entry across refreshes if their URLs match without auth tokens"""
+    return normalize_url(task[1])
+
+
+def entry_digest(task):
+    """Changes when the entry's name, group, duration or (token-less) URL does"""
+    fields = (task[0], getattr(task, 'group', None) or '', str(getattr(task, 'duration', None)), entry_key(task))
+    return hashlib.sha1('\t'.join(fields).encode('utf-8')).hexdigest()
+
+
+class PlaylistSnapshot:
+    """
+    The entries of each watched playlist as of its last poll
+    (.watch_state.sqlite), and the validators of the last download.
+
+    diff() streams the new version past the stored snapshot one entry at a
+    time, so neither version is held in memory, and stores it as the new
+    snapshot in the same pass.
+    """
+
+    def __init__(self, path=STATE_FILE):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def validators(self, source):
+        """(etag, last_modified, mtime_ns, size) of the version the snapshot was taken from"""
+        row = self.db.execute('SELECT etag, last_modified, mtime_ns, size FROM sources WHERE source = ?',
+                              (source,)).fetchone()
+        return row or (None, None, None, None)
+
+    def diff(self, source, tasks, validators, on_entry=None):
+        """
+        Compare tasks (any iterable) with the snapshot of source and replace it.
+        on_entry(task, state) is called for every 'added' or 'changed' task.
+        Returns a PlaylistDiff of counts.
+        """
+        counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+        with self.db:
+            row = self.db.execute('SELECT generation FROM sources WHERE source = ?', (source,)).fetchone()
+            generation = (row[0] if row else 0) + 1
+            for task in tasks:
+                key, digest = entry_key(task), entry_digest(task)
+                previous = self.db.execute('SELECT digest, generation FROM snapshot WHERE source = ? AND key = ?',
+                                           (source, key)).fetchone()
+                if previous is not None and previous[1] == generation:
+                    continue  # Listed twice in this version
+                state = 'added' if previous is None else 'changed' if previous[0] != digest else 'unchanged'
+                counts[state] += 1
+                self.db.execute('INSERT OR REPLACE INTO snapshot (source, key, digest, generation) '
+                                'VALUES (?, ?, ?, ?)', (source, key, digest, generation))
+                if state != 'unchanged' and on_entry is not None:
+                    on_entry(task, state)
+            removed = self.db.execute('DELETE FROM snapshot WHERE source = ? AND generation < ?',
+                                      (source, generation)).rowcount
+            self.db.execute('INSERT OR REPLACE INTO sources (source, etag, last_modified, mtime_ns, size, '
+                            'generation, polled) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (source, *validators, generation, time.time()))
+        return PlaylistDiff(counts['added'], counts['changed'], counts['unchanged'], removed)
+
+
+def download_suffix(path):
+    """'.m3u' for a downloaded playlist, '.txt' for a "name,url" task file; URLs often name neither"""
+    with open(path, 'rb') as f:
+        head = f.read(16)
+    return '.m3u' if head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'#EXTM3U') else '.txt'
+
+
+def is_url(location):
+    return location.startswith(('http://', 'https://'))
+
+
+class PlaylistSource:
+    """
+    A playlist file or URL that is only read again when it changed:
+    files are compared by modification time and size, URLs are fetched
+    with If-None-Match/If-Modified-Since and a 304 means no change.
+    """
+
+    def __init__(self, location, snapshot, download_dir='.'):
+        self.location = location
+        self.snapshot = snapshot
+        name = hashlib.sha1(location.encode('utf-8')).hexdigest()[:12]
+        # The suffix is picked per download from the content, since readers go by it
+        self.download_path = Path(download_dir) / f".watch_{name}"
+
+    def fetch(self, force=False):
+        """
+        (path, validators) of the current version, or None if it is the
+        version the snapshot was taken from (and not force).
+        """
+        etag, last_modified, mtime_ns, size = self.snapshot.validators(self.location)
+        if not is_url(self.location):
+            stat = os.stat(self.location)
+            if not force and (stat.st_mtime_ns, stat.st_size) == (mtime_ns, size):
+                return None
+            return self.location, (None, None, stat.st_mtime_ns, stat.st_size)
+
+        headers = {'User-Agent': USER_AGENT}
+        if not force and etag:
+            headers['If-None-Match'] = etag
+        if not force and last_modified:
+            headers['If-Modified-Since'] = last_modified
+        request = urllib.request.Request(self.location, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+                tmp_path = self.download_path.with_name(self.download_path.name + '.part')
+                with open(tmp_path, 'wb') as f:
+                    shutil.copyfileobj(response, f)
+                validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'), None, None)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        suffix = download_suffix(tmp_path)
+        path = self.download_path.with_suffix(suffix)
+        os.replace(tmp_path, path)
+        for other in {'.m3u', '.txt'} - {suffix}:
+            self.download_path.with_suffix(other).unlink(missing_ok=True)
+        return str(path), validators
+
+
+class PlaylistWatcher:
+    """
+    Polls a playlist every interval seconds and passes the entries that are
+    new or changed since the previous version to dispatch(tasks). The first
+    poll after start() reads the playlist even if it didn't change and hands
+    over every entry, so entries left unfinished by an earlier run aren't lost.
+
+    read_tasks(path) turns a downloaded version into tasks one at a time.
+    """
+
+    def __init__(self, location, read_tasks, dispatch, interval=DEFAULT_INTERVAL, state_path=STATE_FILE):
+        self.location = location
+        self.read_tasks = read_tasks
+        self.dispatch = dispatch
+        self.interval = interval
+        self.snapshot = PlaylistSnapshot(state_path)
+        self.source = PlaylistSource(location, self.snapshot, Path(state_path).parent)
+        self.polls = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """Check the playlist once; returns the PlaylistDiff, or None if it didn't change"""
+        first = self.polls == 0
+        self.polls += 1
+        fetched = self.source.fetch(force=first)
+        if fetched is None:
+            logger.info(f"Playlist unchanged: {self.location}")
+            return None
+        path, validators = fetched
+
+        batch = []
+
+        def collect(task, state=None):
+            batch.append(task)
+            if len(batch) >= DISPATCH_BATCH:
+                self.dispatch(batch[:])
+                del batch[:]
+
+        tasks = self.read_tasks(path)
+        if first:
+            # Everything is handed over once; the skip check weeds out what is already done
+            tasks = (collect(task) or task for task in tasks)
+        diff = self.snapshot.diff(self.location, tasks, validators, on_entry=None if first else collect)
+        if batch:
+            self.dispatch(batch)
+        logger.info(f"Playlist {self.location}: {diff.added} added, {diff.changed} changed, "
+                    f"{diff.unchanged} unchanged, {diff.removed} removed")
+        return diff
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='Watch', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.snapshot.close()
+
+    def _loop(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                # A provider outage or a half-written file shouldn't end the watch
+                logger.error(f"Could not poll {self.location}: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+
+if __name__ == '__main__':
+    from m3u_parser_downloader import iter_tasks
+
+    parser = argparse.ArgumentParser(description='Show what changed in a playlist since the last check')
+    parser.add_argument('location', help='Playlist path or URL')
+    parser.add_argument('--state', default=STATE_FILE, help=f"Snapshot database (default: {STATE_FILE})")
+    parser.add_argument('--list', action='store_true', help='Print the added and changed entries')
+    args = parser.parse_args()
+
+    snapshot = PlaylistSnapshot(args.state)
+    try:
+        fetched = PlaylistSource(args.location, snapshot, Path(args.state).parent).fetch()
+        if fetched is None:
+            print('Unchanged since the last check')
+        else:
+            path, validators = fetched
+            show = (lambda task, state: print(f"{state:>8}  {task[0]}  {task[1]}")) if args.list else None
+            diff = snapshot.diff(args.location, iter_tasks(path), validators, on_entry=show)
+            print(f"{diff.added} added, {diff.changed} changed, {diff.unchanged} unchanged, {diff.removed} removed")
+    finally:
+        snapshot.close()
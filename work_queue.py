@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+import argparse
+import ipaddress
+import json
+import logging
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from jobs import checkpoint_urls
+from profiling import profiler
+from retry import Failure, RetryPolicy, host_of
+
+logger = logging.getLogger(__name__)
+
+QUEUE_FILE = '.work_queue.sqlite'
+DEFAULT_PORT = 8700
+DEFAULT_LEASE = 120       # Seconds a claimed task stays with a worker unless renewed
+IDLE_WAIT = 5             # Seconds a worker waits when nothing is claimable right now
+REQUEST_TIMEOUT = 30
+CLAIM_BATCH = 100         # Claimable tasks read at a time, in rank order
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    group_title TEXT,
+    duration REAL,
+    rank INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    reason TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_state_rank ON tasks (state, rank);
+"""
+
+# Pending and expired tasks after a rank, each side walked in index order and merged,
+# so a claim reads a page of the queue instead of sorting all of it
+CLAIMABLE = """
+SELECT id, name, url, group_title, duration, attempts, state, worker, rank FROM tasks
+WHERE state = 'pending' AND not_before <= ? AND rank > ?
+UNION ALL
+SELECT id, name, url, group_title, duration, attempts, state, worker, rank FROM tasks
+WHERE state = 'leased' AND lease_until < ? AND rank > ?
+ORDER BY rank LIMIT ?
+"""
+
+
+class WorkQueue:
+    """
+    Tasks of a distributed run (.work_queue.sqlite), handed out as leases.
+
+    A task is pending, leased to one worker until lease_until, done or
+    failed. A lease that isn't renewed in time expires and the task goes
+    to the next worker that asks, so a worker that dies loses nothing.
+    The queue survives a coordinator restart. max_per_host caps the live
+    leases per URL host across all workers.
+    """
+
+    def __init__(self, path=QUEUE_FILE, policy=None, lease=DEFAULT_LEASE, max_per_host=None):
+        self.path = path
+        self.policy = policy or RetryPolicy()
+        self.lease = lease
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def add_tasks(self, tasks, key):
+        """Queue tasks in priority order; URLs already in the queue keep their state. Returns the number added."""
+        ordered = sorted(enumerate(tasks), key=lambda item: key(*item))
+        with self.lock, self.db:
+            start = self.db.execute('SELECT COALESCE(MAX(rank), -1) + 1 FROM tasks').fetchone()[0]
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO tasks (url, name, group_title, duration, rank, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(task[1], task[0], getattr(task, 'group', None), getattr(task, 'duration', None),
+                  start + rank, time.time()) for rank, (_, task) in enumerate(ordered)])
+            return self.db.total_changes - before
+
+    def claim(self, worker):
+        """
+        Lease the first claimable task to worker.
+        Returns a task dict, 'wait' if tasks are pending, leased or held back
+        by a host's circuit breaker or lease cap, or None when everything is finished.
+        """
+        now = time.time()
+        claimed, given_up = None, []
+        with self.lock, self.db:
+            busy = Counter()
+            if self.max_per_host:
+                busy.update(host_of(url) for url, in self.db.execute(
+                    "SELECT url FROM tasks WHERE state = 'leased' AND lease_until >= ?", (now,)))
+            after = -1
+            while claimed is None:
+                rows = self.db.execute(CLAIMABLE, (now, after, now, after, CLAIM_BATCH)).fetchall()
+                # Tasks of hosts behind an open circuit are passed over, not claimed
+                for task_id, name, url, group, duration, attempts, state, previous, after in rows:
+                    if self.max_per_host and busy[host_of(url)] >= self.max_per_host:
+                        continue
+                    hold = self.policy.hold((name, url))
+                    if hold is None:
+                        given_up.append(task_id)
+                    elif not hold:
+                        if state == 'leased':
+                            logger.warning(f"Lease of {name} by {previous} expired, handing it to {worker}")
+                        claimed = {'id': task_id, 'name': name, 'url': url, 'group': group, 'duration': duration,
+                                   'attempt': attempts, 'lease': self.lease}
+                        break
+                if len(rows) < CLAIM_BATCH:
+                    break
+
+            for task_id in given_up:
+                self._set(task_id, 'failed', reason='host given up on')
+            if claimed is not None:
+                self.db.execute("UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, updated = ? "
+                                "WHERE id = ?", (worker, now + self.lease, now, claimed['id']))
+                return claimed
+            unfinished = self.db.execute(
+                "SELECT 1 FROM tasks WHERE state IN ('pending', 'leased') LIMIT 1").fetchone()
+        return 'wait' if unfinished else None
+
+    def renew(self, task_id, worker):
+        """Extend a lease; False if the worker no longer holds it"""
+        now = time.time()
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "UPDATE tasks SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (now + self.lease, now, task_id, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, task_id, worker, result):
+        """
+        Record a worker's result (True, False or a Failure). Transient
+        failures go back to pending after the policy's backoff.
+        Returns the task's new state, or None if the report was stale.
+        """
+        with self.lock, self.db:
+            row = self.db.execute('SELECT name, url, state, worker, attempts FROM tasks WHERE id = ?',
+                                  (task_id,)).fetchone()
+            if row is None:
+                return None
+            name, url, state, holder, attempts = row
+            if result:
+                # Finished work is kept even if the lease had already moved on
+                if state != 'done':
+                    self.policy.after((name, url), result, attempts)
+                    self._set(task_id, 'done')
+                return 'done'
+            if state != 'leased' or holder != worker:
+                return None
+
+            delay = self.policy.after((name, url), result, attempts)
+            reason = result.reason if isinstance(result, Failure) else 'failed'
+            if delay is None:
+                self._set(task_id, 'failed', reason=reason)
+                return 'failed'
+            self.db.execute("UPDATE tasks SET state = 'pending', worker = NULL, not_before = ?, "
+                            "attempts = attempts + 1, reason = ?, updated = ? WHERE id = ?",
+                            (time.time() + delay, reason, time.time(), task_id))
+            logger.info(f"Retrying {name} in {delay:.0f}s (attempt {attempts + 2} of {self.policy.retries + 1})")
+            return 'pending'
+
+    def _set(self, task_id, state, reason=None):
+        self.db.execute('UPDATE tasks SET state = ?, worker = NULL, reason = COALESCE(?, reason), updated = ? '
+                        'WHERE id = ?', (state, reason, time.time(), task_id))
+
+    def counts(self):
+        with self.lock:
+            counts = dict(self.db.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+        return {state: counts.get(state, 0) for state in ('pending', 'leased', 'done', 'failed')}
+
+    def workers(self):
+        """Tasks currently leased, per worker"""
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT worker, COUNT(*) FROM tasks WHERE state = 'leased' AND lease_until >= ? GROUP BY worker",
+                (time.time(),)))
+
+
+class Coordinator:
+    """
+    Serves a WorkQueue over HTTP with JSON bodies:
+
+    POST /claim    {worker}                    -> {task} | {wait} | {done}
+    POST /renew    {worker, id}                -> {ok}
+    POST /complete {worker, id, ok, transient, reason, report}
+    GET  /status                               -> task counts and active workers
+
+    Leases, completions and failures reported by workers are recorded in
+    the coordinator's job store.
+    """
+
+    def __init__(self, queue, jobs, host='127.0.0.1', port=DEFAULT_PORT):
+        self.queue = queue
+        self.jobs = jobs
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/status':
+                    return self._reply(404, {'error': 'not found'})
+                self._reply(200, {'tasks': coordinator.queue.counts(), 'workers': coordinator.queue.workers()})
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                    response = coordinator.handle(self.path, request)
+                except (ValueError, KeyError, TypeError) as e:
+                    return self._reply(400, {'error': str(e)})
+                if response is None:
+                    return self._reply(404, {'error': 'not found'})
+                self._reply(200, response)
+
+            def _reply(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handle(self, path, request):
+        worker = str(request['worker'])
+        if path == '/claim':
+            task = self.queue.claim(worker)
+            if task is None:
+                return {'done': True}
+            if task == 'wait':
+                return {'wait': IDLE_WAIT}
+            logger.info(f"Leased {task['name']} to {worker}")
+            self.jobs.mark_started(task['name'], task['url'], task['group'], worker)
+            return {'task': task}
+        if path == '/renew':
+            return {'ok': self.queue.renew(int(request['id']), worker)}
+        if path == '/complete':
+            if request.get('ok'):
+                result = True
+            elif request.get('transient') or request.get('permanent'):
+                result = Failure(request.get('reason') or 'failed', transient=bool(request.get('transient')),
+                                 permanent=bool(request.get('permanent')))
+            else:
+                result = False
+            state = self.queue.complete(int(request['id']), worker, result)
+            report = request.get('report')
+            if report and state == 'done' and report.get('status') == 'done':
+                self.jobs.mark_completed(report['name'], report['url'], report.get('content_hash'),
+                                         output=report.get('output'), mode=report.get('mode'))
+            elif report and state in ('failed', 'pending'):
+                self.jobs.mark_failed(report['url'], report.get('error') or request.get('reason'))
+            return {'state': state}
+        return None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='Coordinator', daemon=True)
+        self._thread.start()
+        logger.info(f"Coordinator listening on {self.address}")
+        if not ipaddress.ip_address(socket.gethostbyname(self.server.server_address[0])).is_loopback:
+            logger.warning("The coordinator API has no authentication: anyone who can reach it can claim "
+                           "entries or mark them done, so only listen on a trusted network")
+        return self
+
+    def wait(self, interval=10.0, stop=None):
+        """Block until no task is pending or leased (or stop is set), logging progress every interval"""
+        last = None
+        while stop is None or not stop.is_set():
+            counts = self.queue.counts()
+            if counts != last:
+                logger.info(f"Queue: {counts['done']} done, {counts['failed']} failed, "
+                            f"{counts['leased']} running, {counts['pending']} pending")
+                last = counts
+            if not counts['pending'] and not counts['leased']:
+                return counts
+            time.sleep(interval)
+        return self.queue.counts()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.jobs.flush()
+
+
+def parse_address(value):
+    """argparse type for HOST:PORT, or just PORT (or :PORT) for this machine only"""
+    host, _, port = value.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got '{value}'")
+
+
+class CoordinatorClient:
+    """Worker side of the coordinator protocol"""
+
+    def __init__(self, url, worker=None, timeout=REQUEST_TIMEOUT):
+        self.url = url.rstrip('/')
+        if not self.url.startswith(('http://', 'https://')):
+            self.url = f"http://{self.url}"
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        self.timeout = timeout
+
+    def _post(self, path, payload):
+        data = json.dumps({'worker': self.worker, **payload}).encode('utf-8')
+        request = urllib.request.Request(self.url + path, data=data,
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def claim(self):
+        return self._post('/claim', {})
+
+    def renew(self, task_id):
+        return self._post('/renew', {'id': task_id}).get('ok', False)
+
+    def complete(self, task_id, result, report=None, attempts=3):
+        """Report a result, retrying briefly; if it never arrives the lease expires and the task is redone"""
+        payload = {'id': task_id, 'ok': bool(result),
+                   'transient': isinstance(result, Failure) and result.transient,
+                   'permanent': isinstance(result, Failure) and result.permanent,
+                   'reason': result.reason if isinstance(result, Failure) else None,
+                   'report': report}
+        for attempt in range(attempts):
+            try:
+                return self._post('/complete', payload).get('state')
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not report task {task_id} to the coordinator: {e}")
+                time.sleep(2 ** attempt)
+        return None
+
+
+class RemoteLedger:
+    """
+    The job store as a worker sees it. Skip checks come from the coordinator,
+    which only leases streams that aren't done; a job's completion or error
+    is held until its result is reported, which carries it into the
+    coordinator's jobs.sqlite. Segment checkpoints stay local, as before.
+    """
+
+    def __init__(self, partial_dir=None, lock=None):
+        self.partial_dir = partial_dir
+        self.lock = lock or threading.Lock()
+        self.urls = set()
+        self.partial_urls = set()
+        self.reports = {}
+        self._loaded = False
+
+    def load(self):
+        with self.lock:
+            if not self._loaded:
+                self.partial_urls.update(checkpoint_urls(self.partial_dir))
+                self._loaded = True
+        return self
+
+    def status(self, url):
+        """Return 'done', 'partial' or None for a stream URL"""
+        with self.lock:
+            if url in self.urls:
+                return 'done'
+            return 'partial' if url in self.partial_urls else None
+
+    def mark_partial(self, url):
+        with self.lock:
+            if url not in self.urls:
+                self.partial_urls.add(url)
+
+    def mark_started(self, name, url, group=None, worker=None):
+        with self.lock:
+            self.reports[url] = {'name': name, 'url': url}
+
+    def mark_completed(self, name, url, content_hash=None, output=None, mode=None):
+        with self.lock:
+            self.urls.add(url)
+            self.partial_urls.discard(url)
+            self.reports.setdefault(url, {'url': url}).update(
+                status='done', name=name, content_hash=content_hash, output=str(output) if output else None,
+                mode=mode)
+
+    def mark_failed(self, url, error):
+        with self.lock:
+            self.reports.setdefault(url, {'url': url}).update(status='failed', error=error)
+
+    def take_report(self, url):
+        with self.lock:
+            return self.reports.pop(url, None)
+
+    def close(self):
+        pass
+
+
+class LeaseKeeper:
+    """Renews the leases of running tasks every interval seconds in the background"""
+
+    def __init__(self, client, interval):
+        self.client = client
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.leases = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, task_id, name):
+        with self.lock:
+            self.leases[task_id] = name
+
+    def discard(self, task_id):
+        with self.lock:
+            self.leases.pop(task_id, None)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='Leases', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            with self.lock:
+                leases = list(self.leases.items())
+            for task_id, name in leases:
+                try:
+                    if not self.client.renew(task_id):
+                        logger.warning(f"Lost the lease on {name}; another worker may be running it too")
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Could not renew the lease on {name}: {e}")
+
+
+class QueueWorker:
+    """
+    Runs worker(task, *args) on max_workers threads for tasks claimed from a
+    coordinator until it reports the queue finished.
+
+    SIGINT behaves like TaskScheduler: the first stops claiming and lets
+    running jobs finish, the second calls on_abort. Leases of aborted jobs
+    simply expire and the coordinator hands the tasks out again.
+    """
+
+    def __init__(self, client, worker, max_workers=3, make_task=None, ledger=None, on_abort=None,
+                 thread_name_prefix='FFmpeg'):
+        self.client = client
+        self.worker = worker
+        self.max_workers = max_workers
+        self.make_task = make_task or (lambda task: (task['name'], task['url']))
+        self.ledger = ledger
+        self.on_abort = on_abort
+        self.thread_name_prefix = thread_name_prefix
+        self.draining = threading.Event()
+        self.lock = threading.Lock()
+        self.results = []
+        self.keeper = None
+
+    def _handle_sigint(self, signum, frame):
+        if not self.draining.is_set():
+            self.draining.set()
+            logger.warning("Interrupted: finishing running jobs, no new tasks will be claimed. "
+                           "Press Ctrl+C again to abort.")
+            return
+        stopped = self.on_abort() if self.on_abort else 0
+        logger.warning(f"Aborting: stopped {stopped or 0} running jobs")
+
+    def run(self, *args):
+        """Returns (task, result) pairs of the tasks this process ran"""
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGINT, self._handle_sigint)
+
+        threads = [threading.Thread(target=self._loop, args=(args,), name=f"{self.thread_name_prefix}_{i}")
+                   for i in range(self.max_workers)]
+        self.keeper = LeaseKeeper(self.client, DEFAULT_LEASE / 3).start()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                # Joined with a timeout so SIGINT is handled promptly on the main thread
+                while thread.is_alive():
+                    thread.join(timeout=1.0)
+        finally:
+            self.keeper.stop()
+            if previous_handler is not None:
+                signal.signal(signal.SIGINT, previous_handler)
+        return self.results
+
+    def _loop(self, args):
+        while not self.draining.is_set():
+            try:
+                with profiler.stage('claim'):
+                    response = self.client.claim()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Coordinator unreachable ({e}), retrying in {IDLE_WAIT}s")
+                self.draining.wait(IDLE_WAIT)
+                continue
+            if response.get('done'):
+                return
+            if 'task' not in response:
+                self.draining.wait(response.get('wait', IDLE_WAIT))
+                continue
+
+            claimed = response['task']
+            task = self.make_task(claimed)
+            # Renew well within the coordinator's lease, whatever it is configured to
+            self.keeper.interval = min(self.keeper.interval, claimed['lease'] / 3)
+            self.keeper.add(claimed['id'], task[0])
+            try:
+                result = profiler.job(self.worker)(task, *args)
+            except Exception as e:
+                logger.error(f"Unexpected error processing {task[0]}: {e}")
+                result = False
+            finally:
+                self.keeper.discard(claimed['id'])
+
+            report = self.ledger.take_report(task[1]) if self.ledger is not None else None
+            with profiler.stage('report'):
+                self.client.complete(claimed['id'], result, report)
+            with self.lock:
+                self.results.append((task, result))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the state of a distributed download run')
+    parser.add_argument('coordinator', help='Coordinator address, e.g. http://127.0.0.1:8700')
+    args = parser.parse_args()
+
+    url = args.coordinator if args.coordinator.startswith('http') else f"http://{args.coordinator}"
+    with urllib.request.urlopen(url.rstrip('/') + '/status', timeout=REQUEST_TIMEOUT) as response:
+        status = json.loads(response.read())
+    print(', '.join(f"{state}: {count}" for state, count in status['tasks'].items()))
+    for worker, count in sorted(status['workers'].items()):
+        print(f"  {worker}: {count} running")